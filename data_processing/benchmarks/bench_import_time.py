@@ -0,0 +1,146 @@
+"""
+Benchmark: import time of the functions package (what every notebook kernel and every cohort_cli worker pays before
+doing any work), and the time to start a pool of worker processes that each import cohort_cli.
+
+Each import is timed in a fresh process started in the package folder (median of several repeats) and the heavy
+packages that ended up imported are listed, so a module that pulls scipy, nolds, Tkinter or plotly in at import time
+shows up. NOTE: the pool workers re-import this script (spawn), so pandas is already imported before they time theirs.
+
+Usage (from the data_processing folder):
+    python benchmarks/bench_import_time.py
+    # also time the functions package from an older commit as the 'before'
+    python benchmarks/bench_import_time.py --before-ref <commit>
+"""
+# Packages
+import argparse
+import multiprocessing
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import pandas as pd
+
+DATA_PROCESSING_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+IMPORTS = [
+    'functions',
+    'functions.data_prep',
+    'functions.peak_detection',
+    'functions.stats',
+    'functions.stride_variables',
+    'functions.low_back_measures',
+    'functions.file_import_gui',
+    'functions.cohort_cli',
+]
+HEAVY_PACKAGES = ['scipy', 'nolds', 'tkinter', 'plotly', 'seaborn', 'matplotlib']
+REPEATS = 5
+
+# Child process ----------------------------------------------------------
+
+
+CHILD_CODE = """
+import sys, time
+sys.path.insert(0, {package_dir!r})
+start = time.perf_counter()
+try:
+    import {module}
+    elapsed = time.perf_counter() - start
+    heavy = [name for name in {heavy!r} if name in sys.modules]
+    print(f"{{elapsed}},{{' '.join(heavy)}}")
+except Exception as e:
+    print(f"nan,failed: {{type(e).__name__}}")
+"""
+
+
+def time_import(package_dir, module):
+    """
+    Median import time (secs) of 'module' in fresh processes and the heavy packages it imported.
+    """
+    times = []
+    for _ in range(REPEATS):
+        output = subprocess.run([sys.executable, '-c', CHILD_CODE.format(package_dir=package_dir, module=module,
+                                                                         heavy=HEAVY_PACKAGES)],
+                                cwd=package_dir, capture_output=True, text=True, check=True).stdout.strip().splitlines()[-1]
+        elapsed, heavy = output.split(',', 1)
+        times.append(float(elapsed))
+    return statistics.median(times), heavy
+
+# Worker pool start up ----------------------------------------------------------
+
+
+def _worker_import(package_dir, module, results):
+    sys.path.insert(0, package_dir)
+    start = time.perf_counter()
+    __import__(module)
+    results.put(time.perf_counter() - start)
+
+
+def time_pool_start(package_dir, n_workers, module='functions.cohort_cli'):
+    """
+    Wall time to start 'n_workers' fresh (spawned) processes that each import 'module', like the cohort_cli pool,
+    and the median import time inside a worker.
+    """
+    context = multiprocessing.get_context('spawn')
+    results = context.Queue()
+    workers = [context.Process(target=_worker_import, args=(package_dir, module, results))
+               for _ in range(n_workers)]
+    start = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    import_times = [results.get() for _ in workers]
+    elapsed = time.perf_counter() - start
+    for worker in workers:
+        worker.join()
+    return elapsed, statistics.median(import_times)
+
+# Benchmark ----------------------------------------------------------
+
+
+def export_package(ref, destination):
+    """
+    Writes the functions package as it was at git commit 'ref' into 'destination'.
+    """
+    archive = subprocess.run(['git', 'archive', ref, 'functions'], cwd=DATA_PROCESSING_DIR,
+                             capture_output=True, check=True).stdout
+    subprocess.run(['tar', '-x', '-C', destination], input=archive, check=True)
+
+
+def run_benchmark(code, package_dir, pool_workers):
+    rows = []
+    for module in IMPORTS:
+        elapsed, heavy = time_import(package_dir, module)
+        rows.append({'code': code, 'import': module, 'time_ms': elapsed * 1000, 'heavy packages imported': heavy})
+    if pool_workers:
+        wall, median_import = time_pool_start(package_dir, pool_workers)
+        rows.append({'code': code, 'import': f'pool of {pool_workers} workers (cohort_cli)', 'time_ms': wall * 1000,
+                     'heavy packages imported': f'median import per worker {median_import * 1000:.0f} ms'})
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--before-ref', default=None,
+                        help='git commit to time as the "before"')
+    parser.add_argument('--pool-workers', type=int, default=32,
+                        help='worker processes to start for the pool timing (0 to skip)')
+    args = parser.parse_args()
+
+    rows = []
+    if args.before_ref:
+        before_dir = tempfile.mkdtemp()
+        try:
+            export_package(args.before_ref, before_dir)
+            rows.extend(run_benchmark(args.before_ref, before_dir, args.pool_workers))
+        finally:
+            shutil.rmtree(before_dir)
+    rows.extend(run_benchmark('current', DATA_PROCESSING_DIR, args.pool_workers))
+
+    print(f'median of {REPEATS} fresh processes per import, {os.cpu_count()} CPUs')
+    print(pd.DataFrame(rows).round(1).to_string(index=False))
+
+
+if __name__ == '__main__':
+    main()
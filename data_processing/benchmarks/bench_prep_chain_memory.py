@@ -0,0 +1,167 @@
+"""
+Benchmark: peak memory (RSS) of the data prep -> peaks -> stride time -> validation window chain on a 20 run cohort,
+for the current functions package and (optionally) an older commit, to check the copies removed from
+calc_stride_times, remove_outliers and peak_and_window_data.
+
+Each version runs in a fresh process so the peak RSS of one doesn't carry over to the other.
+The runs are synthetic (1125hz, 5 mins plus 10 secs to crop) so no data files are needed.
+
+Usage (from the data_processing folder):
+    python benchmarks/bench_prep_chain_memory.py
+    # also run the functions package from an older commit as the 'before'
+    python benchmarks/bench_prep_chain_memory.py --before-ref <commit>
+"""
+# Packages
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import numpy as np
+import pandas as pd
+import psutil
+
+DATA_PROCESSING_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+N_RUNS = 20
+SAMPLE_FREQ = 1125
+RUN_SECS = 310
+
+# Peak RSS sampling ----------------------------------------------------------
+
+
+class PeakRssSampler:
+    """
+    Samples the RSS of this process in a background thread and keeps the highest value.
+    """
+
+    def __init__(self, interval_s=0.01):
+        self.interval_s = interval_s
+        self.process = psutil.Process()
+        self.peak = self.process.memory_info().rss
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.peak = max(self.peak, self.process.memory_info().rss)
+            time.sleep(self.interval_s)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, self.process.memory_info().rss)
+        return False
+
+# Synthetic cohort ----------------------------------------------------------
+
+
+def make_cohort(n_runs=N_RUNS, sample_freq=SAMPLE_FREQ, run_secs=RUN_SECS, seed=0):
+    rng = np.random.default_rng(seed)
+    n = sample_freq * run_secs
+    time_s = np.arange(n) / sample_freq
+    dfs = {}
+    for run in range(n_runs):
+        impacts = 12 * np.maximum(0, np.sin(2 * np.pi * 1.4 * time_s)) ** 8
+        # Keys in the IMU validation format so peak_and_window_data can parse them
+        side = 'right_tibia' if run % 2 == 0 else 'left_tibia'
+        dfs[f'imu_val_{run // 2:03d}_time1_og_run_{side}_trial1'] = pd.DataFrame({
+            'timestamp': time_s,
+            'time_s': time_s,
+            'ax_m/s/s': 9.81 + impacts + rng.normal(0, 1, n),
+            'ay_m/s/s': rng.normal(0, 1, n),
+            'az_m/s/s': 0.5 * impacts + rng.normal(0, 1, n),
+        })
+    return dfs
+
+# One benchmark run ----------------------------------------------------------
+
+
+def run_chain():
+    import functions.data_prep as prep
+    import functions.peak_detection as peaks
+    import functions.stats as stats
+    import functions.stride_variables as stride
+
+    dfs = make_cohort()
+    offset_times_df = pd.DataFrame({'imu': ['right_tibia', 'left_tibia'], 'trial_num': [1, 1], 'offset': [2.0, 2.0]})
+    baseline = psutil.Process().memory_info().rss
+
+    with PeakRssSampler() as sampler:
+        start = time.perf_counter()
+        prep.crop_df_five_mins(dfs, sample_freq=SAMPLE_FREQ)
+        prep.add_resultant_column(dfs, 'ax_m/s/s', 'ay_m/s/s', 'az_m/s/s', 'res_m/s/s')
+        prep.accel_to_gs_columns(dfs)
+        prep.shift_time_s_to_zero(dfs)
+        _, dfs_peak_values = peaks.calc_avg_positive_peaks(
+            dfs, ['res_g'], time_column='time_s_scaled', min_samples_between_peaks=562)
+        dfs_stride_times = stride.calc_stride_times(dfs_peak_values, 'time_s_scaled')
+        summary_tbl = stats.create_summary_tbl(dfs_stride_times, ['stride_times'])
+        stats.remove_outliers(dfs_stride_times, 'stride_times', summary_tbl, 'id', 'lower_bound_k', 'upper_bound_k')
+        prep.peak_and_window_data(dfs, offset_times_df, sampling_rate=SAMPLE_FREQ)
+        elapsed = time.perf_counter() - start
+
+    return {
+        'baseline_rss_mb': baseline / 1e6,
+        'peak_rss_mb': sampler.peak / 1e6,
+        'peak_increase_mb': (sampler.peak - baseline) / 1e6,
+        'time_s': elapsed,
+    }
+
+
+def export_package(ref, destination):
+    """
+    Writes the functions package as it was at git commit 'ref' into 'destination'.
+    """
+    archive = subprocess.run(['git', 'archive', ref, 'functions'], cwd=DATA_PROCESSING_DIR,
+                             capture_output=True, check=True).stdout
+    subprocess.run(['tar', '-x', '-C', destination], input=archive, check=True)
+
+
+def run_child(package_dir):
+    output = subprocess.run([sys.executable, __file__, '--child', '--package-dir', package_dir],
+                            capture_output=True, text=True, check=True).stdout.strip().splitlines()[-1]
+    baseline, peak, increase, elapsed = output.split(',')
+    return {'baseline_rss_mb': float(baseline), 'peak_rss_mb': float(peak),
+            'peak_increase_mb': float(increase), 'time_s': float(elapsed)}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--before-ref', default=None,
+                        help='git commit to run as the "before"')
+    parser.add_argument('--child', action='store_true',
+                        help='(internal) run the chain in this process')
+    parser.add_argument('--package-dir', default=DATA_PROCESSING_DIR,
+                        help='(internal) folder containing the functions package')
+    args = parser.parse_args()
+
+    if args.child:
+        sys.path.insert(0, args.package_dir)
+        result = run_chain()
+        print(','.join(str(value) for value in result.values()))
+        return
+
+    rows = []
+    if args.before_ref:
+        before_dir = tempfile.mkdtemp()
+        try:
+            export_package(args.before_ref, before_dir)
+            rows.append({'code': args.before_ref, **run_child(before_dir)})
+        finally:
+            shutil.rmtree(before_dir)
+    rows.append({'code': 'current', **run_child(DATA_PROCESSING_DIR)})
+
+    print(f'{N_RUNS} runs x {SAMPLE_FREQ}hz x {RUN_SECS} s')
+    print(pd.DataFrame(rows).round(2).to_string(index=False))
+
+
+if __name__ == '__main__':
+    main()
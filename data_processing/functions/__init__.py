@@ -0,0 +1,56 @@
+"""
+Functions for processing the IMU data of the dissertation (used by the notebooks, cohort_cli and the benchmarks)
+
+Submodules are imported the first time they are used (PEP 562), so 'import functions' is cheap:
+    import functions
+    functions.data_prep.add_resultant_column(...)   # data_prep is imported here
+'import functions.data_prep as prep' (what the notebooks do) works the same as before.
+
+Heavy dependencies (scipy, nolds) are also only imported when a function that needs them runs, and the GUI
+(Tkinter) and plotting (plotly, seaborn, matplotlib) packages are optional extras, see _lazy.EXTRAS.
+benchmarks/bench_import_time.py measures the import times.
+"""
+# Packages
+import importlib
+
+SUBMODULES = (
+    'agreement',
+    'bilateral',
+    'bootstrap',
+    'cohort_cli',
+    'custom_plots',
+    'data_prep',
+    'entropy',
+    'event_alignment',
+    'file_import_gui',
+    'gait_segmentation',
+    'heart_rate',
+    'imu_archive',
+    'instrumentation',
+    'low_back_measures',
+    'parameter_sweep',
+    'peak_detection',
+    'pipeline',
+    'precision',
+    'quality_control',
+    'scheduler',
+    'sensor_fusion',
+    'spectral',
+    'stats',
+    'stride_variables',
+    'training_load',
+    'watcher',
+)
+
+__all__ = list(SUBMODULES)
+
+
+def __getattr__(name):
+    if name in SUBMODULES:
+        # import_module also sets the submodule as an attribute of the package, so this only runs once per module
+        return importlib.import_module(f'.{name}', __name__)
+    raise AttributeError(f"module '{__name__}' has no attribute '{name}'")
+
+
+def __dir__():
+    return sorted(set(globals()) | set(SUBMODULES))
@@ -0,0 +1,62 @@
+"""
+Lazy imports for heavy and optional dependencies
+
+A module imported with lazy_module is only really imported the first time one of its attributes is used, so
+importing a functions module (e.g. in every worker of a process pool) doesn't pay for scipy, nolds, plotting or
+Tkinter unless a function that needs them runs.
+
+Optional extras (not needed for processing, only for the notebooks):
+ - gui: Tkinter file dialogs (file_import_gui.read_csv_files_gui...), needs a display
+ - plots: plotly, seaborn and matplotlib (custom_plots)
+"""
+# Packages
+import importlib
+
+EXTRAS = {
+    'gui': "Tkinter (comes with most Python installers, 'apt install python3-tk' on Debian/Ubuntu) and a display. "
+           "On a headless machine use file_import_gui.read_csv_files_from_dir instead",
+    'plots': "the plotting packages: pip install plotly seaborn matplotlib",
+}
+
+
+class LazyModule:
+    """
+    Stands in for a module until one of its attributes is used, then imports it (once).
+    """
+
+    def __init__(self, name, extra=None):
+        self.__dict__['_name'] = name
+        self.__dict__['_extra'] = extra
+        self.__dict__['_module'] = None
+
+    def _load(self):
+        module = self.__dict__['_module']
+        if module is None:
+            try:
+                module = importlib.import_module(self._name)
+            except ImportError as e:
+                if self._extra is None:
+                    raise
+                raise ImportError(
+                    f"'{self._name}' is needed for this function ({self._extra} extra). "
+                    f"Install {EXTRAS[self._extra]}.") from e
+            self.__dict__['_module'] = module
+        return module
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+    def __dir__(self):
+        return dir(self._load())
+
+    def __repr__(self):
+        state = 'imported' if self.__dict__['_module'] is not None else 'not imported yet'
+        return f"<lazy module '{self._name}' ({state})>"
+
+
+def lazy_module(name, extra=None):
+    """
+    Returns a stand-in for module 'name' that imports it on first use.
+    'extra' names the optional extra (see EXTRAS) for a helpful error message if it is not installed.
+    """
+    return LazyModule(name, extra)
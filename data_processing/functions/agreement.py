@@ -0,0 +1,197 @@
+"""
+Functions for agreement statistics between measurement methods (e.g. IMU vs force plate) or time points (reliability)
+ - Intraclass correlation coefficients (Shrout & Fleiss 1979 / McGraw & Wong 1996):
+   ICC(1,1), ICC(2,1), ICC(3,1) and the average measures versions ICC(1,k), ICC(2,k), ICC(3,k), with 95% CIs
+ - Bland-Altman bias and limits of agreement
+ - Lin's concordance correlation coefficient (CCC)
+
+Works on the long format tables exported by this package (sub_id, run_type, sensor, variable, value) with a column
+that says which method (or time point) each value comes from. Every statistic is calculated for all variables at once
+from grouped sums (pandas groupby), not with a loop over variables.
+
+Read only: returns new tables.
+"""
+# Packages
+import numpy as np
+import pandas as pd
+
+from ._lazy import lazy_module
+
+# scipy.stats is imported the first time a confidence interval is computed
+stats = lazy_module('scipy.stats')
+
+# Combining tables ----------------------------------------------------------
+
+
+def stack_methods(tables, method_column='method'):
+    """
+    Stacks long format tables from different methods into one table with a method column.
+
+    Arguments:
+    - tables: a dictionary of {method name: long format table}, e.g. {'force_plate': fp_df, 'imu': imu_df}.
+    """
+    return pd.concat([table.assign(**{method_column: method}) for method, table in tables.items()],
+                     ignore_index=True)
+
+
+def _wide_by_method(df, subject_column, group_columns, method_column, methods):
+    """
+    One row per group and subject with one column per method. Subjects missing a method are dropped.
+    """
+    wide = df.pivot_table(index=group_columns + [subject_column], columns=method_column, values='value',
+                          aggfunc='mean')
+    if methods is None:
+        methods = list(wide.columns)
+    return wide[list(methods)].dropna(), list(methods)
+
+# ICC ----------------------------------------------------------
+
+
+def _icc_from_mean_squares(msr, msc, mse, msw, n, k, alpha=0.05):
+    """
+    ICC estimates and F based confidence intervals from the two-way ANOVA mean squares (arrays, one value per group).
+    The ICC(2,1) interval is the one used by psych::ICC (McGraw & Wong 1996).
+    """
+    with np.errstate(divide='ignore', invalid='ignore'):
+        results = {
+            'icc1': (msr - msw) / (msr + (k - 1) * msw),
+            'icc2': (msr - mse) / (msr + (k - 1) * mse + k * (msc - mse) / n),
+            'icc3': (msr - mse) / (msr + (k - 1) * mse),
+            'icc1k': (msr - msw) / msr,
+            'icc2k': (msr - mse) / (msr + (msc - mse) / n),
+            'icc3k': (msr - mse) / msr,
+        }
+
+        # ICC(1,1): F = MSR / MSW with (n - 1, n(k - 1)) df
+        f1 = msr / msw
+        f1_lower = f1 / stats.f.ppf(1 - alpha / 2, n - 1, n * (k - 1))
+        f1_upper = f1 * stats.f.ppf(1 - alpha / 2, n * (k - 1), n - 1)
+        results['icc1_ci_lower'] = (f1_lower - 1) / (f1_lower + k - 1)
+        results['icc1_ci_upper'] = (f1_upper - 1) / (f1_upper + k - 1)
+
+        # ICC(3,1): F = MSR / MSE with (n - 1, (n - 1)(k - 1)) df
+        f3 = msr / mse
+        f3_lower = f3 / stats.f.ppf(1 - alpha / 2, n - 1, (n - 1) * (k - 1))
+        f3_upper = f3 * stats.f.ppf(1 - alpha / 2, (n - 1) * (k - 1), n - 1)
+        results['icc3_ci_lower'] = (f3_lower - 1) / (f3_lower + k - 1)
+        results['icc3_ci_upper'] = (f3_upper - 1) / (f3_upper + k - 1)
+
+        # ICC(2,1): Satterthwaite df
+        icc2 = results['icc2']
+        a = k * icc2 / (n * (1 - icc2))
+        b = 1 + k * icc2 * (n - 1) / (n * (1 - icc2))
+        v = (a * msc + b * mse) ** 2 / \
+            ((a * msc) ** 2 / (k - 1) + (b * mse) ** 2 / ((n - 1) * (k - 1)))
+        f2_lower = stats.f.ppf(1 - alpha / 2, n - 1, v)
+        f2_upper = stats.f.ppf(1 - alpha / 2, v, n - 1)
+        results['icc2_ci_lower'] = n * (msr - f2_lower * mse) / \
+            (f2_lower * (k * msc + (k * n - k - n) * mse) + n * msr)
+        results['icc2_ci_upper'] = n * (f2_upper * msr - mse) / \
+            (k * msc + (k * n - k - n) * mse + n * f2_upper * msr)
+
+    return results
+
+
+def icc_tbl(wide, group_columns, methods, ci=0.95):
+    """
+    ICCs for every group of a wide table (rows = group and subject, columns = methods) from one set of grouped sums.
+    """
+    k = len(methods)
+    values = wide[methods].to_numpy(dtype=np.float64)
+    groups = wide.index.droplevel(-1)
+
+    # Two-way ANOVA sums of squares for every group at once
+    row_means = values.mean(axis=1)
+    frame = pd.DataFrame(values, columns=methods, index=groups)
+    frame['_row_mean'] = row_means
+    grouped = frame.groupby(level=list(range(len(group_columns))))
+    n = grouped.size().to_numpy(dtype=np.float64)
+    grand = grouped['_row_mean'].mean()
+    column_means = grouped[methods].mean()
+
+    grand_per_row = grand.reindex(groups).to_numpy()
+    ss_total = pd.Series(((values - grand_per_row[:, None]) ** 2).sum(axis=1), index=groups) \
+        .groupby(level=list(range(len(group_columns)))).sum().to_numpy()
+    ss_rows = k * pd.Series((row_means - grand_per_row) ** 2, index=groups) \
+        .groupby(level=list(range(len(group_columns)))).sum().to_numpy()
+    ss_columns = n * ((column_means.to_numpy() -
+                      grand.to_numpy()[:, None]) ** 2).sum(axis=1)
+    ss_error = ss_total - ss_rows - ss_columns
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        msr = ss_rows / (n - 1)
+        msc = ss_columns / (k - 1)
+        mse = ss_error / ((n - 1) * (k - 1))
+        msw = (ss_columns + ss_error) / (n * (k - 1))
+
+    results = pd.DataFrame(_icc_from_mean_squares(
+        msr, msc, mse, msw, n, k, alpha=1 - ci), index=grand.index)
+    results.insert(0, 'n', n.astype(int))
+    return results
+
+# Bland-Altman and CCC ----------------------------------------------------------
+
+
+def bland_altman_ccc_tbl(wide, group_columns, reference, test, loa_z=1.96):
+    """
+    Bland-Altman bias (test - reference), SD of the differences, limits of agreement and Lin's CCC for every group.
+    """
+    x = wide[reference].to_numpy(dtype=np.float64)
+    y = wide[test].to_numpy(dtype=np.float64)
+    groups = wide.index.droplevel(-1)
+    frame = pd.DataFrame({'x': x, 'y': y, 'diff': y - x,
+                         'xx': x * x, 'yy': y * y, 'xy': x * y}, index=groups)
+    grouped = frame.groupby(level=list(range(len(group_columns))))
+    means = grouped.mean()
+
+    bias = means['diff']
+    sd_diff = grouped['diff'].std(ddof=1)
+
+    # Lin's CCC with the population (1/n) variances and covariance
+    var_x = means['xx'] - means['x'] ** 2
+    var_y = means['yy'] - means['y'] ** 2
+    cov_xy = means['xy'] - means['x'] * means['y']
+    ccc = 2 * cov_xy / (var_x + var_y + (means['x'] - means['y']) ** 2)
+
+    return pd.DataFrame({
+        'ba_bias': bias,
+        'ba_sd': sd_diff,
+        'ba_loa_lower': bias - loa_z * sd_diff,
+        'ba_loa_upper': bias + loa_z * sd_diff,
+        'ccc': ccc,
+    })
+
+# Agreement table ----------------------------------------------------------
+
+
+def create_agreement_tbl(df, method_column='method', subject_column='sub_id', group_columns=('run_type', 'variable'),
+                         methods=None, ci=0.95):
+    """
+    This function calculates agreement statistics for every variable in a long format table.
+
+    Arguments:
+    - df: long format table with a value column, e.g. the combined export of the IMU and force plate
+      (use stack_methods to combine them) or one variable measured at two time points.
+    - method_column: column saying which method (or time point) each value comes from, default is 'method'.
+    - subject_column: column identifying the subject (rows of the ICC), default is 'sub_id'.
+    - group_columns: columns that identify one variable to assess, default is ('run_type', 'variable').
+    - methods: the methods to compare, in order (reference first). Default is all methods in the table.
+      Bland-Altman and CCC compare the first two (differences are second - first).
+    - ci: confidence level of the ICC intervals, default is 0.95.
+
+    Values are averaged if a subject has more than one value for a method and variable. Subjects without a value for
+    every method are left out of that variable.
+
+    The function returns one row per group with n, ICC(1,1), ICC(2,1), ICC(3,1) (with CIs), ICC(1,k), ICC(2,k), ICC(3,k),
+    the Bland-Altman bias, SD and limits of agreement, and Lin's CCC.
+    """
+    group_columns = list(group_columns)
+    wide, methods = _wide_by_method(
+        df, subject_column, group_columns, method_column, methods)
+    if len(methods) < 2:
+        raise ValueError('At least two methods are needed')
+
+    results = icc_tbl(wide, group_columns, methods, ci=ci)
+    results = results.join(bland_altman_ccc_tbl(
+        wide, group_columns, methods[0], methods[1]))
+    return results.reset_index()
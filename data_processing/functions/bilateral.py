@@ -0,0 +1,201 @@
+"""
+Functions for comparing the left and right tibia IMUs of the same run
+ - Pairs the left and right dfs by key (same run, different sensor)
+ - Lines the two sensors up on their timestamps
+ - Finds the impact peaks (foot strikes) of both legs in one call
+ - Symmetry index per stride for peak acceleration and stride time, plus a summary per run
+
+This replaces running every function separately on dfs_lt_lowg and dfs_rt_lowg and comparing them by hand afterwards.
+
+Symmetry index (Robinson et al. 1987): SI = (left - right) / (0.5 x (left + right)) x 100
+ - 0 is perfect symmetry, positive means the left value is higher
+
+Read only: the dfs passed in are not modified.
+"""
+# Packages
+import re
+import numpy as np
+import pandas as pd
+import warnings
+
+from .gait_segmentation import detect_foot_strikes
+
+# Pairing left and right runs ----------------------------------------------------------
+
+
+# The keys of the left and right runs only differ in the sensor id (5 digits, e.g. 00917 vs 00925) and/or the
+# location ('left_tibia' vs 'right_tibia'), so the run key is the key with those taken out.
+SIDE_PATTERN = re.compile(r'(?<!\d)_?\d{5}(?=_|$)|_?(left|right)_tibia')
+
+
+def run_key(key):
+    return SIDE_PATTERN.sub('', key)
+
+
+def pair_left_right_keys(left_dfs, right_dfs):
+    """
+    Pairs the keys of the left and right dictionaries by run key.
+
+    Returns a list of (run_key, left_key, right_key). Runs missing from either side are skipped with a warning.
+    """
+    left_runs = {run_key(key): key for key in left_dfs.keys()}
+    right_runs = {run_key(key): key for key in right_dfs.keys()}
+
+    pairs = []
+    for run, left_key in left_runs.items():
+        if run in right_runs:
+            pairs.append((run, left_key, right_runs[run]))
+        else:
+            warnings.warn(f"No right tibia run found for '{left_key}'")
+    for run, right_key in right_runs.items():
+        if run not in left_runs:
+            warnings.warn(f"No left tibia run found for '{right_key}'")
+    return pairs
+
+# Symmetry ----------------------------------------------------------
+
+
+def symmetry_index(left, right):
+    left = np.asarray(left, dtype=np.float64)
+    right = np.asarray(right, dtype=np.float64)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return (left - right) / (0.5 * (left + right)) * 100
+
+
+def overlapping_rows(left_times, right_times):
+    """
+    Row ranges (start, stop) of each side that cover only the time both sensors recorded (searchsorted on the sorted times).
+    """
+    start = max(left_times[0], right_times[0])
+    end = min(left_times[-1], right_times[-1])
+    left_rows = (np.searchsorted(left_times, start, side='left'),
+                 np.searchsorted(left_times, end, side='right'))
+    right_rows = (np.searchsorted(right_times, start, side='left'),
+                  np.searchsorted(right_times, end, side='right'))
+    return left_rows, right_rows
+
+
+def match_strides(left_strike_times, right_strike_times):
+    """
+    Matches each left stride (left strike i to left strike i + 1) with the right stride that starts during it.
+
+    Returns (left_idx, right_idx): the left and right stride numbers of every matched pair.
+    """
+    n_left = len(left_strike_times) - 1
+    n_right = len(right_strike_times) - 1
+    if n_left < 1 or n_right < 1:
+        return np.empty(0, dtype=np.intp), np.empty(0, dtype=np.intp)
+
+    left_idx = np.arange(n_left)
+    # First right strike at or after each left strike
+    right_idx = np.searchsorted(
+        right_strike_times, left_strike_times[:-1], side='left')
+    # Keep the pairs where that right strike is before the next left strike and starts a complete right stride
+    valid = right_idx < n_right
+    valid[valid] &= right_strike_times[right_idx[valid]
+                                       ] < left_strike_times[1:][valid]
+    return left_idx[valid], right_idx[valid]
+
+# Left vs right for each pair of runs ----------------------------------------------------------
+
+
+def compare_left_right(left_dfs, right_dfs, resultant_column, sample_freq, time_column='time_s',
+                       min_peak_height=None, max_peak_height=None, min_secs_between_peaks=0.5):
+    """
+    This function compares the left and right tibia of each run stride by stride.
+
+    Arguments:
+    - left_dfs, right_dfs: dictionaries of pandas dataframes (e.g. dfs_lt_lowg and dfs_rt_lowg).
+    - resultant_column: column the impact peaks are found in (e.g. 'res_g').
+    - sample_freq: sample rate (hz) of both sides.
+    - time_column: sensor timestamps (secs) used to line the two sides up, default is 'time_s'.
+    - min_peak_height, max_peak_height, min_secs_between_peaks: impact peak settings (same for both legs).
+
+    If 'resultant_column' or the time column does not exist in a dataframe, a warning message is issued and the run is skipped.
+
+    The function returns:
+    - summary_df: per run (key is the run key) in the long format (key, variable, value): mean left and right peak,
+      mean left and right stride time, mean symmetry index of each and the number of matched strides.
+    - stride_df: one row per matched stride (key, stride, left_time_s, right_time_s, left_peak, right_peak, peak_si,
+      left_stride_time, right_stride_time, stride_time_si).
+    """
+    results = []
+    stride_tables = []
+
+    for run, left_key, right_key in pair_left_right_keys(left_dfs, right_dfs):
+        missing = False
+        for key, df in ((left_key, left_dfs[left_key]), (right_key, right_dfs[right_key])):
+            for col in (resultant_column, time_column):
+                if col not in df.columns:
+                    warnings.warn(
+                        f"The column '{col}' does not exist in '{key}'")
+                    missing = True
+        if missing:
+            continue
+
+        left_times = left_dfs[left_key][time_column].to_numpy(dtype=np.float64)
+        right_times = right_dfs[right_key][time_column].to_numpy(
+            dtype=np.float64)
+        (left_start, left_stop), (right_start, right_stop) = overlapping_rows(
+            left_times, right_times)
+        if left_stop <= left_start or right_stop <= right_start:
+            warnings.warn(f"'{left_key}' and '{right_key}' don't overlap in time")
+            continue
+
+        # Impact peaks of both legs over the same stretch of time
+        sides = {}
+        for side, df, start, stop, times in (('left', left_dfs[left_key], left_start, left_stop, left_times),
+                                             ('right', right_dfs[right_key], right_start, right_stop, right_times)):
+            signal = df[resultant_column].to_numpy(dtype=np.float64)[
+                start:stop]
+            _, impact_peaks = detect_foot_strikes(
+                signal, sample_freq, min_peak_height=min_peak_height, max_peak_height=max_peak_height,
+                min_secs_between_peaks=min_secs_between_peaks, pre_strike_secs=0)
+            sides[side] = (times[start:stop][impact_peaks],
+                           signal[impact_peaks])
+
+        left_strike_times, left_peaks = sides['left']
+        right_strike_times, right_peaks = sides['right']
+        left_idx, right_idx = match_strides(
+            left_strike_times, right_strike_times)
+        if len(left_idx) == 0:
+            warnings.warn(
+                f"No matching strides found for '{left_key}' and '{right_key}'")
+            continue
+
+        left_stride_time = np.diff(left_strike_times)[left_idx]
+        right_stride_time = np.diff(right_strike_times)[right_idx]
+        peak_si = symmetry_index(left_peaks[left_idx], right_peaks[right_idx])
+        stride_time_si = symmetry_index(left_stride_time, right_stride_time)
+
+        stride_tables.append(pd.DataFrame({
+            'key': run,
+            'stride': np.arange(len(left_idx)),
+            'left_time_s': left_strike_times[left_idx],
+            'right_time_s': right_strike_times[right_idx],
+            'left_peak': left_peaks[left_idx],
+            'right_peak': right_peaks[right_idx],
+            'peak_si': peak_si,
+            'left_stride_time': left_stride_time,
+            'right_stride_time': right_stride_time,
+            'stride_time_si': stride_time_si,
+        }))
+
+        for variable, value in (
+            (f'{resultant_column}_left_avg_peak', np.mean(left_peaks[left_idx])),
+            (f'{resultant_column}_right_avg_peak', np.mean(right_peaks[right_idx])),
+            (f'{resultant_column}_peak_si', np.nanmean(peak_si)),
+            ('left_stride_times_mean', np.mean(left_stride_time)),
+            ('right_stride_times_mean', np.mean(right_stride_time)),
+            ('stride_times_si', np.nanmean(stride_time_si)),
+            ('matched_strides', len(left_idx)),
+        ):
+            results.append({
+                'key': run,
+                'variable': variable,
+                'value': value
+            })
+
+    summary_df = pd.DataFrame(results)
+    stride_df = pd.concat(stride_tables, ignore_index=True) if stride_tables else pd.DataFrame()
+    return summary_df, stride_df
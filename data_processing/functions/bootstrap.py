@@ -0,0 +1,233 @@
+"""
+Functions for bootstrap confidence intervals of per-run variables
+ - mean, SD and CV of a column (e.g. peak values or stride times) for each run
+ - fractal scaling index (FSI) via Detrended Fluctuation Analysis (DFA) of the stride times
+
+How the work is batched:
+ - All bootstrap resamples of a run are drawn at once as one (resamples x samples) index matrix, and the mean, SD and
+   CV of every resample come from reductions along one axis of that matrix (no loop over resamples).
+ - DFA is also calculated for a whole batch of resamples at once (batched_dfa). Batches are spread over a process pool,
+   each with its own seeded random stream (numpy SeedSequence.spawn), so the results are the same whatever the number
+   of workers.
+
+NOTE: resampling single strides at random would destroy the correlations between consecutive strides that DFA
+measures (every resample would give an FSI of ~0.5). DFA resamples are drawn in blocks of consecutive strides instead
+(moving block bootstrap), with blocks as long as the largest DFA window by default.
+
+Read only: the dfs passed in are not modified.
+"""
+# Packages
+import os
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+import warnings
+from numpy.lib.stride_tricks import sliding_window_view
+
+# Resample indices ----------------------------------------------------------
+
+
+def bootstrap_indices(n_samples, n_resamples, rng, block_length=None):
+    """
+    Index matrix (resamples x samples) of bootstrap resamples.
+    With block_length, blocks of consecutive samples are drawn (moving block bootstrap) instead of single samples.
+    """
+    if block_length is None or block_length <= 1:
+        return rng.integers(0, n_samples, size=(n_resamples, n_samples))
+    block_length = min(block_length, n_samples)
+    n_blocks = -(-n_samples // block_length)
+    block_starts = rng.integers(
+        0, n_samples - block_length + 1, size=(n_resamples, n_blocks))
+    indices = block_starts[:, :, None] + np.arange(block_length)
+    return indices.reshape(n_resamples, -1)[:, :n_samples]
+
+
+def percentile_ci(estimates, ci=0.95):
+    """
+    Percentile confidence interval along the last axis (NaNs are left out).
+    """
+    alpha = (1 - ci) / 2
+    return np.nanquantile(estimates, [alpha, 1 - alpha], axis=-1)
+
+# Mean, SD and CV ----------------------------------------------------------
+
+
+def bootstrap_basic_stats(values, n_resamples=2000, rng=None, max_elements=20_000_000):
+    """
+    Mean, SD and CV (%) of every bootstrap resample of 'values'.
+
+    The resamples are drawn in as few batches as fit in 'max_elements' (resamples x samples) so long signals don't use
+    too much memory. Returns a dictionary of arrays (one value per resample).
+    """
+    values = np.asarray(values, dtype=np.float64)
+    rng = np.random.default_rng() if rng is None else rng
+    batch_size = max(1, min(n_resamples, max_elements // max(len(values), 1)))
+
+    means, sds = [], []
+    for start in range(0, n_resamples, batch_size):
+        indices = bootstrap_indices(
+            len(values), min(batch_size, n_resamples - start), rng)
+        samples = values[indices]
+        means.append(samples.mean(axis=1))
+        sds.append(samples.std(axis=1, ddof=1))
+    mean = np.concatenate(means)
+    sd = np.concatenate(sds)
+    return {'mean': mean, 'sd': sd, 'cv': sd / mean * 100}
+
+# DFA ----------------------------------------------------------
+
+
+def dfa_window_sizes(n_samples):
+    # Same window sizes nolds.dfa uses by default
+    if n_samples > 70:
+        sizes = [4]
+        max_i = int(np.floor(np.log(0.1 * n_samples / 4) / np.log(1.2)))
+        for i in range(max_i + 1):
+            size = int(np.floor(4 * (1.2 ** i)))
+            if size > sizes[-1]:
+                sizes.append(size)
+        return sizes
+    if n_samples > 10:
+        return [4, 5, 6, 7, 8, 9]
+    return [n_samples - 2, n_samples - 1]
+
+
+def batched_dfa(data, window_sizes=None):
+    """
+    DFA (order 1, overlapping windows) of every row of a (series x samples) array at once.
+
+    Same calculation as nolds.dfa with its default settings and fit_exp='poly'
+    (nolds uses a RANSAC fit for the last step when scikit-learn is installed, which is random and can differ slightly).
+    Returns the scaling exponent of each row.
+    """
+    data = np.atleast_2d(np.asarray(data, dtype=np.float64))
+    window_sizes = dfa_window_sizes(
+        data.shape[1]) if window_sizes is None else window_sizes
+
+    # Profile: cumulative sum of the deviations from the mean
+    walk = np.cumsum(data - data.mean(axis=1, keepdims=True), axis=1)
+    log_fluctuations = np.empty((data.shape[0], len(window_sizes)))
+
+    for j, n in enumerate(window_sizes):
+        # Windows of n samples moving n // 2 each time (series x windows x n)
+        starts = np.arange(0, data.shape[1] - n, n // 2)
+        windows = sliding_window_view(walk, n, axis=1)[:, starts]
+        # Residuals of a straight line fit in every window at once (projection onto an orthonormal [1, x] basis)
+        x = np.arange(n) - (n - 1) / 2
+        x /= np.sqrt(np.sum(x ** 2))
+        residuals = windows - windows.mean(axis=2, keepdims=True)
+        residuals = residuals - \
+            np.einsum('swn,n->sw', residuals, x)[:, :, None] * x
+        fluctuation = np.sqrt(np.mean(np.sum(residuals ** 2, axis=2) / n, axis=1))
+        with np.errstate(divide='ignore'):
+            log_fluctuations[:, j] = np.log(fluctuation)
+
+    # Slope of log(F(n)) vs log(n) for each row, leaving out zero fluctuations (like nolds)
+    log_n = np.log(np.asarray(window_sizes, dtype=np.float64))
+    valid = np.isfinite(log_fluctuations)
+    count = valid.sum(axis=1)
+    log_fluctuations = np.where(valid, log_fluctuations, 0.0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean_x = (valid * log_n).sum(axis=1) / count
+        mean_y = log_fluctuations.sum(axis=1) / count
+        dx = np.where(valid, log_n - mean_x[:, None], 0.0)
+        slope = (dx * (log_fluctuations - mean_y[:, None])).sum(axis=1) / \
+            (dx ** 2).sum(axis=1)
+    slope[count < 2] = np.nan
+    return slope
+
+
+def _dfa_task(values, n_resamples, seed, block_length):
+    # One batch of DFA resamples with its own random stream (runs in a worker process)
+    rng = np.random.default_rng(seed)
+    indices = bootstrap_indices(len(values), n_resamples, rng, block_length)
+    return batched_dfa(values[indices])
+
+# Bootstrap for specified columns for each df in a dictionary ----------------------------------------------------------
+
+
+def apply_bootstrap_to_dfs(dfs, columns, n_resamples=2000, ci=0.95, seed=None, dfa=False, dfa_block_length=None,
+                           workers=None, batch_size=250):
+    """
+    This function calculates bootstrap confidence intervals for the mean, SD, CV (and optionally the FSI via DFA) of the
+    specified columns in each dataframe in the input dictionary (e.g. the peak_values or stride_times columns).
+
+    Arguments:
+    - dfs: a dictionary of pandas dataframes. The keys are the names of the dataframes and the values are the dataframes themselves.
+    - columns: a list of column names.
+    - n_resamples: number of bootstrap resamples, default is 2000.
+    - ci: confidence level of the percentile intervals, default is 0.95.
+    - seed: seed for reproducible results (each run/column gets its own stream spawned from it).
+    - dfa: also bootstrap the fractal scaling index (DFA), default is False.
+    - dfa_block_length: block length for the DFA resamples, default is the largest DFA window (10% of the samples).
+    - workers: number of processes for DFA (default: all CPUs). 1 runs everything in this process.
+    - batch_size: DFA resamples per task.
+
+    If a column in 'columns' does not exist in a dataframe, a warning message is issued and the column is skipped.
+
+    The function returns a dataframe in the long format (key, variable, value), e.g. for the column 'stride_times':
+    'stride_times_mean', 'stride_times_mean_ci_lower', 'stride_times_mean_ci_upper', and the same for _sd, _cv and _fsi.
+    The point estimates are calculated on the original data (same as calc_stride_times_vars).
+    """
+    results = []
+    jobs = []
+    root_seed = np.random.SeedSequence(seed)
+
+    for key in dfs.keys():
+        df = dfs[key]
+
+        for col in columns:
+            if col not in df.columns:
+                warnings.warn(f"The column '{col}' does not exist in '{key}'")
+                continue
+            values = df[col].dropna().to_numpy(dtype=np.float64)
+            # Separate streams for the basic stats and the DFA batches of this run/column
+            basic_seed, dfa_seed = root_seed.spawn(2)
+
+            estimates = {
+                'mean': np.mean(values),
+                'sd': np.std(values, ddof=1),
+            }
+            estimates['cv'] = estimates['sd'] / estimates['mean'] * 100
+            resampled = bootstrap_basic_stats(
+                values, n_resamples, np.random.default_rng(basic_seed))
+            for stat in ('mean', 'sd', 'cv'):
+                lower, upper = percentile_ci(resampled[stat], ci)
+                results.extend([
+                    {'key': key, 'variable': f'{col}_{stat}', 'value': estimates[stat]},
+                    {'key': key, 'variable': f'{col}_{stat}_ci_lower', 'value': lower},
+                    {'key': key, 'variable': f'{col}_{stat}_ci_upper', 'value': upper},
+                ])
+
+            if dfa:
+                block_length = dfa_block_length or max(
+                    dfa_window_sizes(len(values)))
+                n_batches = -(-n_resamples // batch_size)
+                batch_seeds = dfa_seed.spawn(n_batches)
+                batches = [(values, min(batch_size, n_resamples - i * batch_size), batch_seeds[i], block_length)
+                           for i in range(n_batches)]
+                jobs.append((key, col, values, batches))
+
+    if jobs:
+        workers = workers or os.cpu_count() or 1
+        tasks = [batch for _, _, _, batches in jobs for batch in batches]
+        if workers > 1:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                outputs = list(executor.map(_dfa_task, *zip(*tasks)))
+        else:
+            outputs = [_dfa_task(*task) for task in tasks]
+
+        position = 0
+        for key, col, values, batches in jobs:
+            resampled = np.concatenate(
+                outputs[position:position + len(batches)])
+            position += len(batches)
+            lower, upper = percentile_ci(resampled, ci)
+            results.extend([
+                {'key': key, 'variable': f'{col}_fsi', 'value': batched_dfa(values)[0]},
+                {'key': key, 'variable': f'{col}_fsi_ci_lower', 'value': lower},
+                {'key': key, 'variable': f'{col}_fsi_ci_upper', 'value': upper},
+            ])
+
+    result_df = pd.DataFrame(results)
+    return result_df
@@ -0,0 +1,570 @@
+"""
+Command line entry point for processing a whole cohort without the notebooks
+
+Runs the same steps as the notebooks for:
+ - ch3_tibia: chapter 3 IMU validation, left and right tibia (peak acceleration and stride time variables)
+ - ch3_low_back: chapter 3 IMU validation, low back (RMS, RMS ratios and peak acceleration)
+ - ch4_control_entropy: chapter 4 low back control entropy
+
+Usage (from the data_processing folder so the data/ paths match the notebooks):
+    python -m functions.cohort_cli cohort.json --workers 8 --resume
+    # only start jobs while their estimated memory fits in 12GB (see scheduler)
+    python -m functions.cohort_cli cohort.json --workers 8 --memory-budget 12GB
+    # check the data quality of the input files first and move the failing ones out of the way (see quality_control)
+    python -m functions.cohort_cli cohort.json --qc quarantine
+
+Example cohort manifest (JSON):
+{
+    "data_dir": "data/five_min_runs",
+    "output_dir": "data/processed_variables/cohort_runs",
+    "results_file": "data/processed_variables/imu_training_load_variables.xlsx",
+    "sheet_name": "variables",
+    "jobs": [
+        {"pipeline": "ch3_tibia", "subjects": ["imu_val_002"], "time_pts": ["time1", "time2"], "run_types": ["run", "walk"],
+         "sample_rate": 500, "min_samples_between_peaks": {"run": 250, "walk": 350}, "k": 4, "z": 4},
+        {"pipeline": "ch3_low_back", "subjects": ["imu_val_002"], "time_pts": ["time2"], "run_types": ["run"],
+         "sample_rate": 500, "min_samples_between_peaks": {"run": 125, "walk": 175}},
+        {"pipeline": "ch4_control_entropy", "subjects": ["run014"], "sample_rate": 1125}
+    ]
+}
+Any setting left out of a job uses the notebook value (see PIPELINE_DEFAULTS).
+The measured memory of each job is kept in 'memory_history_file' (default: memory_history.json in 'output_dir').
+The QC report and quarantined files go in 'qc_dir' (default: qc in 'output_dir').
+"""
+# Packages
+import argparse
+import hashlib
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import pandas as pd
+
+from . import data_prep as prep
+from . import file_import_gui as gui
+from . import low_back_measures as back
+from . import peak_detection as peaks
+from . import quality_control as qc
+from . import scheduler
+from . import stats
+from . import stride_variables as stride
+
+# Pipeline settings ----------------------------------------------------------
+
+
+DEFAULT_DATA_DIR = 'data/five_min_runs'
+DEFAULT_OUTPUT_DIR = 'data/processed_variables/cohort_runs'
+
+# Values used in the notebooks
+# NOTE: 'path_template' is relative to 'data_dir' in the manifest
+PIPELINE_DEFAULTS = {
+    'ch3_tibia': {
+        'path_template': 'imu_validation_study/{sub_id}/{time_pt}/{sensor}/{run_type}',
+        'sensors': {'left_tibia': 'lt', 'right_tibia': 'rt'},
+        'sample_rate': 500,
+        'min_samples_between_peaks': {'run': 250, 'walk': 350},
+        'k': 4,
+        'z': 4,
+        'stride_k': 3,
+        'stride_z': 3,
+        'remove_stride_outliers': False,
+        'total_run_time_mins': 5,
+    },
+    'ch3_low_back': {
+        'path_template': 'imu_validation_study/{sub_id}/{time_pt}/{sensor}/{run_type}',
+        'sensors': {'low_back': 'back'},
+        'sample_rate': 500,
+        'min_samples_between_peaks': {'run': 125, 'walk': 175},
+        'k': 4,
+        'z': 4,
+        'cutoff': 50,
+        'order': 4,
+    },
+    'ch4_control_entropy': {
+        'path_template': '{sub_id}/lowg_1125hz/{sensor}',
+        'sensors': {'back': 'back'},
+        'sample_rate': 1125,
+        'column': 'res_m/s/s',
+        'window_size': 750,
+        'overlap': 375,
+        'emb_dim': 2,
+        'tolerance': 0.15,
+    },
+}
+
+# Chapter 3 files use these column names
+CH3_ACCEL_COLUMNS = ['accel_x (m/s2)', 'accel_y (m/s2)', 'accel_z (m/s2)']
+# Chapter 4 files use these column names
+CH4_ACCEL_COLUMNS = ['ax_m/s/s', 'ay_m/s/s', 'az_m/s/s']
+
+# Time and acceleration columns checked by the QC stage
+QC_COLUMNS = {
+    'ch3_tibia': ('timestamp', CH3_ACCEL_COLUMNS),
+    'ch3_low_back': ('timestamp', CH3_ACCEL_COLUMNS),
+    'ch4_control_entropy': ('time_s', CH4_ACCEL_COLUMNS),
+}
+
+# Building the list of jobs from the manifest ----------------------------------------------------------
+
+
+def load_manifest(file_path):
+    with open(file_path) as f:
+        return json.load(f)
+
+
+def expand_jobs(manifest):
+    """
+    Turns the manifest into a list of jobs.
+    There is one job for every pipeline x subject x time point x run type combination.
+    """
+    data_dir = manifest.get('data_dir', DEFAULT_DATA_DIR)
+    output_dir = manifest.get('output_dir', DEFAULT_OUTPUT_DIR)
+
+    jobs = []
+    for job_spec in manifest['jobs']:
+        pipeline = job_spec['pipeline']
+        if pipeline not in PIPELINE_DEFAULTS:
+            raise ValueError(
+                f"Unknown pipeline '{pipeline}'. Options are: {', '.join(PIPELINE_DEFAULTS)}")
+
+        # Manifest values override the notebook defaults
+        params = dict(PIPELINE_DEFAULTS[pipeline])
+        params.update({name: value for name, value in job_spec.items() if name not in (
+            'pipeline', 'subjects', 'time_pts', 'run_types')})
+
+        for sub_id in job_spec['subjects']:
+            for time_pt in job_spec.get('time_pts', [None]):
+                for run_type in job_spec.get('run_types', [None]):
+                    input_dirs = {
+                        sensor: os.path.join(data_dir, params['path_template'].format(
+                            sub_id=sub_id, time_pt=time_pt, sensor=sensor, run_type=run_type))
+                        for sensor in params['sensors']
+                    }
+                    job_id = '_'.join(
+                        part for part in [sub_id, time_pt, run_type] if part is not None)
+
+                    jobs.append({
+                        'pipeline': pipeline,
+                        'job_id': job_id,
+                        'sub_id': sub_id,
+                        'time_pt': time_pt,
+                        'run_type': run_type,
+                        'input_dirs': input_dirs,
+                        'output_path': os.path.join(output_dir, pipeline, f'{job_id}.csv'),
+                        'params': params,
+                    })
+
+    return jobs
+
+# Resume mode ----------------------------------------------------------
+
+
+def _input_files(job):
+    # Jobs made outside the manifest (e.g. the watcher's HR jobs) can list their files instead of folders
+    if 'input_files' in job:
+        return [file_path for file_path in job['input_files'] if os.path.exists(file_path)]
+    files = []
+    for directory in job['input_dirs'].values():
+        if os.path.isdir(directory):
+            files.extend(gui.data_files_in_dir(directory))
+    return files
+
+
+def job_fingerprint(job):
+    """
+    Fingerprint of everything that would change a job's output: the pipeline settings
+    plus the name, size and modified time of every input file.
+    """
+    h = hashlib.sha256()
+    h.update(json.dumps(job['params'], sort_keys=True).encode())
+    for file_path in _input_files(job):
+        file_stat = os.stat(file_path)
+        h.update(f'{file_path}|{file_stat.st_size}|{file_stat.st_mtime_ns}'.encode())
+    return h.hexdigest()
+
+
+def _stamp_path(job):
+    return job['output_path'].replace('.csv', '.json')
+
+
+def is_up_to_date(job):
+    """
+    A job is up to date when its output exists and the stamp written next to it matches the current fingerprint.
+    """
+    stamp_path = _stamp_path(job)
+    if not (os.path.exists(job['output_path']) and os.path.exists(stamp_path)):
+        return False
+    with open(stamp_path) as f:
+        stamp = json.load(f)
+    return stamp.get('fingerprint') == job_fingerprint(job)
+
+
+def write_stamp(job, fingerprint):
+    with open(_stamp_path(job), 'w') as f:
+        json.dump({'job_id': job['job_id'], 'pipeline': job['pipeline'],
+                  'fingerprint': fingerprint}, f, indent=2)
+
+# Quality control ----------------------------------------------------------
+
+
+def qc_job(job):
+    """
+    QC report (quality_control.qc_report) of every input file of a job, with a file_path column.
+    """
+    time_column, accel_columns = QC_COLUMNS[job['pipeline']]
+    reports = []
+    for file_path in _input_files(job):
+        dfs, _ = gui.read_csv_files([file_path])
+        report = qc.qc_report(dfs, job['params']['sample_rate'], time_column=time_column,
+                              accel_columns=accel_columns, limits=job['params'].get('qc_limits'))
+        report.insert(0, 'job_id', job['job_id'])
+        report.insert(1, 'pipeline', job['pipeline'])
+        report['file_path'] = file_path
+        reports.append(report)
+    return pd.concat(reports, ignore_index=True) if reports else pd.DataFrame()
+
+
+def run_qc(jobs, workers=None, qc_dir=None, quarantine=False):
+    """
+    Checks the input files of every job before any processing (reading the files is all the work, so this is quick
+    next to the pipelines) and writes the report to '{qc_dir}/qc_report.csv'.
+
+    - quarantine: False leaves out the jobs with a failing file. True moves the failing files to '{qc_dir}/quarantine'
+      and keeps the jobs that still have files.
+
+    Returns (jobs that passed, status rows of the jobs that didn't).
+    """
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        reports = list(executor.map(qc_job, jobs))
+    non_empty = [report for report in reports if not report.empty]
+    qc_df = pd.concat(non_empty, ignore_index=True) if non_empty else pd.DataFrame()
+
+    if qc_dir is not None:
+        os.makedirs(qc_dir, exist_ok=True)
+        qc_df.to_csv(os.path.join(qc_dir, 'qc_report.csv'), index=False)
+
+    passed = []
+    statuses = []
+    for job, report in zip(jobs, reports):
+        failed = report[report['status'] == 'fail'] if not report.empty else report
+        if quarantine and not failed.empty:
+            qc.quarantine_files(failed, dict(zip(failed['key'], failed['file_path'])),
+                                os.path.join(qc_dir or '.', 'quarantine'))
+        if failed.empty or (quarantine and len(failed) < len(report)):
+            passed.append(job)
+        else:
+            reasons = '; '.join(f"{key}: {reason}" for key, reason in zip(failed['key'], failed['reasons']))
+            print(f"QC failed for {job['pipeline']} {job['job_id']}. {reasons}")
+            statuses.append({'job_id': job['job_id'], 'pipeline': job['pipeline'],
+                            'status': f'failed qc: {reasons}', 'rows': None})
+
+    return passed, statuses
+
+# Pipelines ----------------------------------------------------------
+
+
+def _min_samples_between_peaks(params, run_type):
+    # Can be one value for all run types or a {run_type: value} lookup
+    value = params['min_samples_between_peaks']
+    if isinstance(value, dict):
+        if run_type not in value:
+            raise ValueError(
+                f"No min_samples_between_peaks for run_type '{run_type}'.")
+        return value[run_type]
+    return value
+
+
+def _prep_ch3(dfs, sample_rate):
+    prep.crop_df_five_mins(dfs, sample_freq=sample_rate)
+    prep.add_resultant_column(
+        dfs, column_x=CH3_ACCEL_COLUMNS[0], column_y=CH3_ACCEL_COLUMNS[1], column_z=CH3_ACCEL_COLUMNS[2], name_of_res_column='res_m/s/s')
+    prep.accel_to_gs_columns(
+        dfs, column_x=CH3_ACCEL_COLUMNS[0], column_y=CH3_ACCEL_COLUMNS[1], column_z=CH3_ACCEL_COLUMNS[2], name_of_res_column='res_m/s/s')
+    prep.shift_time_s_to_zero(dfs, time_col='timestamp')
+
+
+def _thresholded_peaks(dfs, min_samples_between_peaks, k, z):
+    # STEP 1: peaks with no thresholds
+    _, dfs_peak_values_no_threshold = peaks.calc_avg_positive_peaks(
+        dfs, columns=['res_g'], time_column='time_s_scaled',
+        min_peak_height=None, max_peak_height=None,
+        min_samples_between_peaks=min_samples_between_peaks)
+    # STEP 2: individual thresholds
+    summary_tbl = stats.create_summary_tbl(
+        dfs_peak_values_no_threshold, ['peak_values'], k=k, z=z)
+    # STEP 3: peaks using the individual thresholds
+    return peaks.calc_avg_positive_peaks_from_tbl(
+        dfs, ['res_g'], time_column='time_s_scaled',
+        summary_table=summary_tbl, id_column='id', min_peak_height_column='lower_bound_k', max_peak_height_column='upper_bound_k',
+        min_samples_between_peaks=min_samples_between_peaks)
+
+
+def run_ch3_tibia(job):
+    params = job['params']
+    sample_rate = params['sample_rate']
+    min_samples_between_peaks = _min_samples_between_peaks(
+        params, job['run_type'])
+
+    tables = []
+    for sensor, side in params['sensors'].items():
+        dfs, _ = gui.read_csv_files_from_dir(job['input_dirs'][sensor])
+        if not dfs:
+            continue
+        _prep_ch3(dfs, sample_rate)
+
+        # Peak acceleration
+        res_peak_accel_df, dfs_peak_values = _thresholded_peaks(
+            dfs, min_samples_between_peaks, params['k'], params['z'])
+        res_peak_accel_df['variable'] = res_peak_accel_df['variable'] + \
+            f'_{side}_{sample_rate}hz'
+        tables.append(prep.export_tbl_imu_val(res_peak_accel_df))
+
+        # Stride times
+        dfs_stride_times = stride.calc_stride_times(
+            dfs=dfs_peak_values, time_column='time_s_scaled')
+        if params['remove_stride_outliers']:
+            st_summary_tbl = stats.create_summary_tbl(
+                dfs_stride_times, ['stride_times'], k=params['stride_k'], z=params['stride_z'])
+            dfs_stride_times, _ = stats.remove_outliers(
+                dfs_stride_times, 'stride_times', st_summary_tbl, id_column='id',
+                lower_threshold_column='lower_bound_k', upper_threshold_column='upper_bound_k')
+        st_vars_df = stride.calc_stride_times_vars(
+            dfs_stride_times, 'stride_times', total_run_time_mins=params['total_run_time_mins'])
+        st_vars_df['variable'] = st_vars_df['variable'] + \
+            f'_{side}_{sample_rate}hz'
+        tables.append(prep.export_tbl_imu_val(st_vars_df))
+
+    return pd.concat(tables, ignore_index=True) if tables else pd.DataFrame()
+
+
+def _rms_ratios(rms_df, columns, res_column):
+    # Same as the RMS ratio cells in the notebooks
+    rms_wide = rms_df.pivot(index='key', columns='variable', values='value')
+    for axis in columns:
+        rms_wide[axis + '_ratio'] = rms_wide[axis] / rms_wide[res_column]
+    rms_wide = rms_wide[[col for col in rms_wide.columns if 'ratio' in col]]
+    return rms_wide.reset_index().melt(id_vars='key', var_name='variable', value_name='value')
+
+
+def run_ch3_low_back(job):
+    params = job['params']
+    sample_rate = params['sample_rate']
+    min_samples_between_peaks = _min_samples_between_peaks(
+        params, job['run_type'])
+    suffix = f'_{sample_rate}hz'
+
+    tables = []
+    for sensor, location in params['sensors'].items():
+        dfs, _ = gui.read_csv_files_from_dir(job['input_dirs'][sensor])
+        if not dfs:
+            continue
+        _prep_ch3(dfs, sample_rate)
+
+        # Mean shift
+        prep.calc_mean_shift(dfs, CH3_ACCEL_COLUMNS + ['ax_g', 'ay_g', 'az_g'])
+        prep.add_resultant_column(
+            dfs, column_x=CH3_ACCEL_COLUMNS[0] + '_meanshift', column_y=CH3_ACCEL_COLUMNS[1] + '_meanshift',
+            column_z=CH3_ACCEL_COLUMNS[2] + '_meanshift', name_of_res_column='res_m/s/s_meanshift')
+        prep.add_resultant_column(
+            dfs, column_x='ax_g_meanshift', column_y='ay_g_meanshift', column_z='az_g_meanshift', name_of_res_column='res_g_meanshift')
+
+        # Filter
+        raw_columns = CH3_ACCEL_COLUMNS + \
+            ['res_m/s/s', 'ax_g', 'ay_g', 'az_g', 'res_g']
+        meanshift_columns = [col + '_meanshift' for col in raw_columns]
+        prep.apply_butter_lowpass_filter_to_dfs(
+            dfs, raw_columns, sample_rate, params['cutoff'], params['order'])
+        prep.apply_butter_lowpass_filter_to_dfs(
+            dfs, meanshift_columns, sample_rate, params['cutoff'], params['order'])
+
+        # RMS
+        accel_res_columns = CH3_ACCEL_COLUMNS + ['res_m/s/s']
+        columns_for_rms = accel_res_columns + \
+            [col + '_filtered' for col in accel_res_columns] + \
+            [col + '_meanshift_filtered' for col in accel_res_columns]
+        rms_df = back.apply_rms_to_dfs(dfs, columns_for_rms)
+        rms_df['variable'] = rms_df['variable'] + suffix
+        tables.append(prep.export_tbl_imu_val(rms_df))
+
+        # RMS ratios
+        rms_ratio_df = pd.concat([
+            _rms_ratios(rms_df, [f'{col}_filtered_rms{suffix}' for col in CH3_ACCEL_COLUMNS],
+                        f'res_m/s/s_filtered_rms{suffix}'),
+            _rms_ratios(rms_df, [f'{col}_meanshift_filtered_rms{suffix}' for col in CH3_ACCEL_COLUMNS],
+                        f'res_m/s/s_meanshift_filtered_rms{suffix}'),
+        ], axis=0, ignore_index=True)
+        tables.append(prep.export_tbl_imu_val(rms_ratio_df))
+
+        # Peak acceleration
+        res_peak_accel_df, _ = _thresholded_peaks(
+            dfs, min_samples_between_peaks, params['k'], params['z'])
+        res_peak_accel_df['variable'] = res_peak_accel_df['variable'] + \
+            f'_{location}{suffix}'
+        tables.append(prep.export_tbl_imu_val(res_peak_accel_df))
+
+    return pd.concat(tables, ignore_index=True) if tables else pd.DataFrame()
+
+
+def run_ch4_control_entropy(job):
+    params = job['params']
+
+    tables = []
+    for sensor in params['sensors']:
+        dfs, _ = gui.read_csv_files_from_dir(job['input_dirs'][sensor])
+        if not dfs:
+            continue
+        prep.crop_df_five_mins(dfs, sample_freq=params['sample_rate'])
+        prep.add_resultant_column(
+            dfs, column_x=CH4_ACCEL_COLUMNS[0], column_y=CH4_ACCEL_COLUMNS[1], column_z=CH4_ACCEL_COLUMNS[2], name_of_res_column='res_m/s/s')
+        prep.accel_to_gs_columns(dfs)
+        prep.shift_time_s_to_zero(dfs)
+
+        control_entropy_df = back.apply_control_entropy_to_dfs(
+            dfs, [params['column']], window_size=params['window_size'], overlap=params['overlap'],
+            emb_dim=params['emb_dim'], tolerance=params['tolerance'])
+        # NOTE: the notebook exported this variable as 'control entropy' (the Shiny app uses this name)
+        control_entropy_df['variable'] = 'control entropy'
+        tables.append(prep.export_tbl(control_entropy_df))
+
+    return pd.concat(tables, ignore_index=True) if tables else pd.DataFrame()
+
+
+PIPELINES = {
+    'ch3_tibia': run_ch3_tibia,
+    'ch3_low_back': run_ch3_low_back,
+    'ch4_control_entropy': run_ch4_control_entropy,
+}
+
+# Running jobs ----------------------------------------------------------
+
+
+def run_job(job):
+    """
+    Runs a single job and writes its export table to job['output_path'].
+    This runs in a worker process, so it only returns small things (the table and the fingerprint).
+    """
+    # Fingerprint before processing so a file changing mid-run is picked up next time
+    fingerprint = job_fingerprint(job)
+    df_export = PIPELINES[job['pipeline']](job)
+
+    output_dir = os.path.dirname(job['output_path'])
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    df_export.to_csv(job['output_path'], index=False)
+
+    return df_export, fingerprint
+
+
+def _run_pool(jobs, workers):
+    # Yields (job, result, error) as the jobs finish
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(run_job, job): job for job in jobs}
+        for future in as_completed(futures):
+            try:
+                yield futures[future], future.result(), None
+            except Exception as e:
+                yield futures[future], None, e
+
+
+def run_cohort(jobs, workers=None, resume=False, results_file=None, sheet_name='variables',
+               memory_budget=None, memory_history_file=None, qc=None, qc_dir=None):
+    """
+    Runs all jobs across worker processes.
+
+    - resume: skip jobs whose output is already up to date (see is_up_to_date).
+    - results_file: Excel file the new results are written to (the same results store the notebooks use). Rows of
+      the same sub_id/run_type/sensor/variable already in it are replaced (prep.upsert_df_to_excel).
+      This is written once by the main process after all jobs finish, so workers never write to it at the same time.
+    - memory_budget: bytes. If given, jobs are only started while their estimated memory fits (see scheduler).
+    - memory_history_file: JSON file of the measured memory of earlier jobs, used and updated with memory_budget.
+    - qc: None, 'report' or 'quarantine'. Checks the input files before processing (see run_qc), the report
+      and quarantined files go in qc_dir.
+
+    Returns a table with one row per job (job_id, pipeline, status, rows).
+    """
+    statuses = []
+    to_run = []
+    for job in jobs:
+        if resume and is_up_to_date(job):
+            statuses.append({'job_id': job['job_id'], 'pipeline': job['pipeline'],
+                            'status': 'up to date', 'rows': None})
+        else:
+            to_run.append(job)
+
+    if qc is not None:
+        to_run, qc_statuses = run_qc(
+            to_run, workers=workers, qc_dir=qc_dir, quarantine=qc == 'quarantine')
+        statuses.extend(qc_statuses)
+
+    if memory_budget is None:
+        completed = _run_pool(to_run, workers)
+    else:
+        completed = scheduler.run_within_budget(
+            to_run, run_job, memory_budget, workers=workers, history_file=memory_history_file)
+
+    finished = []
+    for job, result, error in completed:
+        if error is not None:
+            print(f"Failed to process {job['pipeline']} {job['job_id']}. Error: {error}")
+            statuses.append({'job_id': job['job_id'], 'pipeline': job['pipeline'],
+                            'status': f'failed: {error}', 'rows': None})
+            continue
+        df_export, fingerprint = result
+        finished.append((job, df_export, fingerprint))
+        statuses.append({'job_id': job['job_id'], 'pipeline': job['pipeline'],
+                        'status': 'processed', 'rows': len(df_export)})
+        print(f"Processed {job['pipeline']} {job['job_id']} ({len(df_export)} rows)")
+
+    # Write everything new to the results store in one write (replacing the earlier results of re-run jobs)
+    new_tables = [df_export for _, df_export, _ in finished if not df_export.empty]
+    if results_file is not None and new_tables:
+        prep.upsert_df_to_excel(pd.concat(
+            new_tables, ignore_index=True), results_file, sheet_name)
+
+    # Only stamp jobs as done once their results are in the results store
+    for job, _, fingerprint in finished:
+        write_stamp(job, fingerprint)
+
+    return pd.DataFrame(statuses)
+
+# Command line ----------------------------------------------------------
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Process a cohort of IMU runs without the notebooks.')
+    parser.add_argument('manifest', help='path to the cohort manifest (JSON)')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='number of worker processes (default: number of CPUs)')
+    parser.add_argument('--resume', action='store_true',
+                        help='skip jobs whose outputs are already up to date')
+    parser.add_argument('--pipelines', nargs='+', choices=sorted(PIPELINES),
+                        help='only run these pipelines')
+    parser.add_argument('--memory-budget', default=None,
+                        help="only start jobs while their estimated memory fits, e.g. '12GB', '500MB' or 'auto' "
+                             "(80%% of the available memory)")
+    parser.add_argument('--qc', choices=['report', 'quarantine'], default=None,
+                        help='check the data quality of the input files first. report: leave out jobs with a failing '
+                             'file, quarantine: move the failing files to the qc folder and run the rest')
+    args = parser.parse_args(argv)
+
+    manifest = load_manifest(args.manifest)
+    jobs = expand_jobs(manifest)
+    if args.pipelines:
+        jobs = [job for job in jobs if job['pipeline'] in args.pipelines]
+
+    memory_budget = scheduler.parse_memory(
+        args.memory_budget) if args.memory_budget else None
+    memory_history_file = manifest.get('memory_history_file', os.path.join(
+        manifest.get('output_dir', DEFAULT_OUTPUT_DIR), 'memory_history.json'))
+    qc_dir = manifest.get('qc_dir', os.path.join(
+        manifest.get('output_dir', DEFAULT_OUTPUT_DIR), 'qc'))
+
+    status_df = run_cohort(
+        jobs, workers=args.workers, resume=args.resume,
+        results_file=manifest.get('results_file'), sheet_name=manifest.get('sheet_name', 'variables'),
+        memory_budget=memory_budget, memory_history_file=memory_history_file, qc=args.qc, qc_dir=qc_dir)
+    print(status_df.to_string(index=False))
+
+
+if __name__ == '__main__':
+    main()
@@ -2,18 +2,25 @@
 Functions for Plots
 """
 # Packages ---
-import plotly.graph_objects as go
-from plotly.subplots import make_subplots
-import plotly.express as px
-import seaborn as sns
-import matplotlib.pyplot as plt
+from ._lazy import lazy_module
+
+# The plotting packages are an optional extra ('plots'), imported the first time a plot is made
+go = lazy_module('plotly.graph_objects', extra='plots')
+plotly_subplots = lazy_module('plotly.subplots', extra='plots')
+px = lazy_module('plotly.express', extra='plots')
+sns = lazy_module('seaborn', extra='plots')
+plt = lazy_module('matplotlib.pyplot', extra='plots')
 
 # Line Plot w/ Plotly ---
 
 # Creates line plots for each dataframe in a dictionary and stores them in another dictionary
 
 
-def create_line_plots(dfs, x_col, y_cols, color_discrete_sequence=px.colors.qualitative.Set2):
+def create_line_plots(dfs, x_col, y_cols, color_discrete_sequence=None):
+    # Default colours (px.colors.qualitative.Set2), looked up here so plotly isn't imported with the module
+    if color_discrete_sequence is None:
+        color_discrete_sequence = px.colors.qualitative.Set2
+
     # Create a dictionary to store the plots
     plots = {}
 
@@ -87,7 +94,7 @@ def plot_trial_data(dfs_trials_separate, trial_number, column_name, timestamp_co
     trial_dfs = dfs_trials_separate[trial_number]
 
     # Create a subplot
-    fig = make_subplots(specs=[[{"secondary_y": True}]])
+    fig = plotly_subplots.make_subplots(specs=[[{"secondary_y": True}]])
 
     # Colors for each IMU location
     color_map = {
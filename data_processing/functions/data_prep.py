@@ -1,13 +1,36 @@
 """
 Functions for prepping IMU data for calculations
+
+What each function does to the dictionary of dfs passed in:
+ - crop_df_five_mins: replaces each df with a new df of the last 5 mins of rows (a copy, so the columns added
+   later never write into a slice of the uncropped df)
+ - resample_dfs: replaces each df with a new df of the resampled columns
+ - rebuild_time_base: replaces each df with a new df on a uniform time base (plus a gap mask column) and returns a
+   summary table
+ - add_resultant_column, accel_to_gs_columns, shift_time_s_to_zero, apply_butter_lowpass_filter_to_dfs,
+   calc_mean_shift, reorient_to_body_axes: add new columns to the *original* dfs (nothing existing is changed or copied)
+ - filter_out_dfs: deletes keys from the dictionary passed in and returns that same dictionary
+ - remove_trials_from_dfs: returns a new dictionary holding the *same* dfs (no dfs are copied)
+ - export_tbl, export_tbl_imu_val, peak_and_window_data: read only, return new tables
+ - butter_lowpass_filter, resample_signals: read only, return a new array
+
+Only these prep functions change the dictionary of dfs passed in. The functions in the other modules (peak_detection,
+low_back_measures, stride_variables, stats, ...) are read only and return new tables.
 """
 # Packages
 import numpy as np
 import pandas as pd
-from scipy.signal import butter, filtfilt
+from fractions import Fraction
+from functools import lru_cache
 import warnings
 import re
 
+from ._lazy import lazy_module
+from .precision import get_float_dtype, same_float_dtype
+
+# scipy.signal is imported the first time a filter or resampling function runs
+scipy_signal = lazy_module('scipy.signal')
+
 # Five min crop data ----------------------------------------------------------
 
 
@@ -51,12 +74,241 @@ def crop_df_five_mins(dfs, sample_freq):
         # Remove excess rows from the dataframe if necessary
         # NOTE: removes rows at the beginning of run
         excess_rows = len(df) - rows_needed
+        # NOTE: copied so the cropped df owns its data (columns added later would otherwise go into a slice)
         if excess_rows > 0:
-            df = df.iloc[excess_rows:]
+            df = df.iloc[excess_rows:].copy()
 
         # Update the dictionary with the modified dataframe of 5 mins
         dfs[key] = df
 
+# Resample to a common rate ----------------------------------------------------------
+
+
+# Runs come in at 500hz (chapter 3 IMU validation), 1125hz (low-g) and 1600hz (high-g).
+# Resampling them all to one rate means the sample based parameters (peak spacing, windows) only need tuning once,
+# and downsampling the 1600hz data early makes every later stage cheaper.
+
+# Steps:
+# 1) Rate change as a fraction up / down (e.g. 1600hz -> 1125hz is 45 / 64)
+# 2) Polyphase resampling (scipy resample_poly) with the anti-aliasing FIR filter for that fraction.
+#    The filter design is cached, so all the runs (and columns) with the same rates share one design
+# 3) Runs with the same number of samples are stacked (runs x samples x columns) and resampled in one call
+
+
+def resample_ratio(fs, target_fs):
+    """
+    Returns (up, down) for resampling from 'fs' to 'target_fs'.
+    """
+    ratio = Fraction(target_fs / fs).limit_denominator(1000)
+    return ratio.numerator, ratio.denominator
+
+
+@lru_cache(maxsize=None)
+def resample_filter(up, down, window=('kaiser', 5.0)):
+    """
+    The anti-aliasing FIR filter resample_poly designs for (up, down) with its default settings (cached).
+    """
+    max_rate = max(up, down)
+    half_len = 10 * max_rate
+    h = scipy_signal.firwin(2 * half_len + 1, 1.0 / max_rate, window=window)
+    # Read only so the cached filter can't be changed by accident
+    h.flags.writeable = False
+    return h
+
+
+def resample_signals(values, fs, target_fs, axis=0):
+    """
+    Resamples an array from 'fs' to 'target_fs' along 'axis' (any number of runs/columns in the other axes).
+    The result is float64 (float32 input gives float32).
+    """
+    up, down = resample_ratio(fs, target_fs)
+    values = np.asarray(values)
+    if up == down:
+        return values
+    # NOTE: padtype='line' extends the signal as a straight line at the edges (instead of zeros) to avoid edge dips
+    resampled = scipy_signal.resample_poly(values, up, down, axis=axis,
+                              window=resample_filter(up, down), padtype='line')
+    if values.dtype == np.float32:
+        resampled = resampled.astype(np.float32)
+    return resampled
+
+
+def resample_dfs(dfs, columns, fs, target_fs, time_col='time_s'):
+    """
+    This function resamples the specified columns of each dataframe in the input dictionary from 'fs' to 'target_fs'.
+
+    Arguments:
+    - dfs: a dictionary of pandas dataframes. The keys are the names of the dataframes and the values are the dataframes themselves.
+    - columns: a list of strings, where each string is a column name in the dataframes that should be resampled.
+    - fs: the sampling rate of the dfs.
+    - target_fs: the new sampling rate.
+    - time_col: time column (secs), rebuilt as the first time value + sample / target_fs if it exists.
+
+    Each df in the dictionary is *replaced* with a new df holding only the time column and the resampled columns
+    (other columns, e.g. peak markers, can't be resampled and are left out).
+    If a column in 'columns' does not exist in a dataframe, a warning message is issued and the column is skipped.
+    """
+    # Runs are grouped by length (and columns found) so each group can be resampled in one batched call
+    groups = {}
+    for key in dfs.keys():
+        df = dfs[key]
+        key_columns = []
+        for col in columns:
+            if col in df.columns:
+                key_columns.append(col)
+            else:
+                warnings.warn(f"The column '{col}' does not exist in '{key}'")
+        groups.setdefault((len(df), tuple(key_columns)), []).append(key)
+
+    for (n_samples, key_columns), keys in groups.items():
+        key_columns = list(key_columns)
+        dtype = np.result_type(
+            *[dfs[key][col].dtype for key in keys for col in key_columns])
+        stacked = np.empty((len(keys), n_samples, len(key_columns)), dtype=dtype)
+        for i, key in enumerate(keys):
+            stacked[i] = dfs[key][key_columns].to_numpy(dtype=dtype)
+
+        resampled = resample_signals(stacked, fs, target_fs, axis=1)
+
+        for i, key in enumerate(keys):
+            new_df = {}
+            if time_col in dfs[key].columns:
+                new_df[time_col] = dfs[key][time_col].iloc[0] + \
+                    np.arange(resampled.shape[1]) / target_fs
+            for j, col in enumerate(key_columns):
+                # Each column keeps its own dtype (float32 stays float32)
+                new_df[col] = resampled[i, :, j].astype(
+                    dfs[key][col].dtype, copy=False)
+            # Update the dictionary with the resampled dataframe
+            dfs[key] = pd.DataFrame(new_df)
+
+# Uniform time base and gap repair ----------------------------------------------------------
+
+
+# Everything after data prep works in samples (min_samples_between_peaks, window sizes, offset_time * sampling_rate
+# in peak_and_window_data), which is only right if row i is at time_0 + i / fs. Dropped samples and time stamp jitter
+# break that, so this rebuilds the time column on an exact grid and puts the samples on it.
+
+# Steps (one pass of NumPy calls per run, no loop over samples):
+# 1) Rows with a NaN time or value are left out, and if the time column goes backwards or repeats the rows are sorted
+#    and only the first of each repeated time stamp is kept
+# 2) Uniform grid from the first to the last time stamp at 1 / fs
+# 3) Every column is put on the grid with np.interp (linear), which also fills the short gaps
+# 4) Gaps longer than 'max_gap_s' are marked in a boolean mask column (True = no real data here). The grid rows inside
+#    them are found with np.searchsorted and the mask is built from a cumulative sum of +1 / -1 at the gap edges
+# The mask_column option of the peak, RMS and entropy functions leaves the masked rows out.
+
+
+def rebuild_time_base(dfs, columns, sample_freq, time_col='time_s', max_gap_s=0.1, gap_factor=1.5, mask_column='gap_mask'):
+    """
+    This function rebuilds a uniform time base for each dataframe in the input dictionary and repairs short gaps.
+
+    Arguments:
+    - dfs: a dictionary of pandas dataframes. The keys are the names of the dataframes and the values are the dataframes themselves.
+    - columns: a list of strings, where each string is a column name in the dataframes that should be put on the new time base.
+    - sample_freq: the sampling rate (hz) of the new time base.
+    - time_col: time column (secs), default is 'time_s' (ch.3 files use 'timestamp').
+    - max_gap_s: gaps up to this long are filled by linear interpolation, longer ones are masked. Default is 0.1 secs.
+    - gap_factor: a time step over gap_factor / sample_freq counts as a gap (anything shorter is jitter), default is 1.5.
+    - mask_column: name of the boolean column marking the rows inside long gaps, default is 'gap_mask'.
+
+    Each df in the dictionary is *replaced* with a new df holding only the time column, the columns (same dtype for
+    float columns) and the mask column, so row i is at time_0 + i / sample_freq.
+    If a column in 'columns' does not exist in a dataframe, a warning message is issued and the column is skipped.
+
+    The function returns a dataframe with one row per run: key, samples_in, samples_out, n_unsorted (time stamps that
+    went backwards or repeated), max_jitter_s, n_short_gaps, filled_samples, n_long_gaps and masked_samples.
+    """
+    summary = []
+
+    for key in dfs.keys():
+        df = dfs[key]
+        key_columns = []
+        for col in columns:
+            if col in df.columns:
+                key_columns.append(col)
+            else:
+                warnings.warn(f"The column '{col}' does not exist in '{key}'")
+
+        # 1) Rows with a time and all values, in time order
+        time = df[time_col].to_numpy(dtype=np.float64)
+        values = df[key_columns].to_numpy(dtype=np.float64)
+        rows = np.flatnonzero(np.isfinite(time) & np.isfinite(values).all(axis=1))
+        steps = np.diff(time[rows])
+        n_unsorted = int((steps <= 0).sum())
+        if n_unsorted:
+            warnings.warn(f"'{key}' has {n_unsorted} time stamps that go backwards or repeat, they were sorted")
+            rows = rows[np.argsort(time[rows], kind='stable')]
+            rows = rows[np.concatenate([[True], np.diff(time[rows]) > 0])]
+            steps = np.diff(time[rows])
+        time = time[rows]
+
+        # 2) Uniform grid
+        n_samples = int(round((time[-1] - time[0]) * sample_freq)) + 1
+        grid = time[0] + np.arange(n_samples) / sample_freq
+
+        # Jitter: how far the time stamps are from the nearest grid time
+        jitter = np.abs(time - (time[0] + np.round((time - time[0]) * sample_freq) / sample_freq))
+
+        # 4) Gaps and the mask of the long ones
+        gaps = steps > gap_factor / sample_freq
+        long_gaps = gaps & (steps > max_gap_s)
+        gap_starts = np.searchsorted(grid, time[:-1][long_gaps], side='right')
+        gap_ends = np.searchsorted(grid, time[1:][long_gaps], side='left')
+        edges = np.zeros(n_samples + 1, dtype=np.int64)
+        np.add.at(edges, gap_starts, 1)
+        np.add.at(edges, gap_ends, -1)
+        mask = np.cumsum(edges[:-1]) > 0
+
+        # 3) Columns on the grid
+        new_df = {time_col: grid}
+        for j, col in enumerate(key_columns):
+            dtype = df[col].dtype if np.issubdtype(df[col].dtype, np.floating) else np.float64
+            new_df[col] = np.interp(grid, time, values[rows, j]).astype(dtype, copy=False)
+        new_df[mask_column] = mask
+
+        short_gaps = gaps & ~long_gaps
+        summary.append({
+            'key': key,
+            'samples_in': len(df),
+            'samples_out': n_samples,
+            'n_unsorted': n_unsorted,
+            'max_jitter_s': float(jitter.max()) if len(jitter) else 0.0,
+            'n_short_gaps': int(short_gaps.sum()),
+            'filled_samples': int((np.round(steps[short_gaps] * sample_freq) - 1).sum()),
+            'n_long_gaps': int(long_gaps.sum()),
+            'masked_samples': int(mask.sum()),
+        })
+
+        # Update the dictionary with the rebuilt dataframe
+        dfs[key] = pd.DataFrame(new_df)
+
+    summary_df = pd.DataFrame(summary)
+    return summary_df
+
+
+def masked_rows(df, mask_column, key):
+    """
+    The boolean mask column of a df as an array (True = leave the row out), or None if 'mask_column' is None.
+    If the column does not exist, a warning message is issued and None is returned (nothing is masked).
+    """
+    if mask_column is None:
+        return None
+    if mask_column not in df.columns:
+        warnings.warn(f"The column '{mask_column}' does not exist in '{key}'")
+        return None
+    return df[mask_column].to_numpy(dtype=bool)
+
+
+def windows_with_masked_rows(mask, starts, window):
+    """
+    True for each window (first row 'starts', 'window' rows long, one length or one per window) that has any masked
+    row in it.
+    """
+    masked_count = np.concatenate([[0], np.cumsum(mask, dtype=np.int64)])
+    starts = np.asarray(starts)
+    return (masked_count[starts + window] - masked_count[starts]) > 0
+
 
 # Add resultant column ----------------------------------------------------------
 
@@ -155,8 +407,13 @@ Finally, the function applies the filter to the data and returns the filtered da
 def butter_lowpass_filter(data, cutoff, fs, order):
     nyq = 0.5 * fs
     normal_cutoff = cutoff / nyq
-    b, a = butter(order, normal_cutoff, btype='low', analog=False)
-    filtered_data = filtfilt(b, a, data)
+    b, a = scipy_signal.butter(order, normal_cutoff, btype='low', analog=False)
+    filtered_data = scipy_signal.filtfilt(b, a, data)
+    # NOTE: the filter itself runs in float64 (the poles of a low cutoff IIR filter are too close to the unit circle for float32)
+    # but float32 data is returned as float32 so the new column stays float32
+    data_dtype = getattr(data, 'dtype', None)
+    if data_dtype is not None and data_dtype == np.float32:
+        filtered_data = filtered_data.astype(np.float32)
     return filtered_data
 
 # Function for applying Butterworth filter ----------------------------------------------------------
@@ -209,11 +466,114 @@ def calc_mean_shift(dfs, column_names):
         for column_name in column_names:
             # Ensure the column exists in the dataframe
             if column_name in df.columns:
-                mean_value = df[column_name].mean()
-                df[column_name + '_meanshift'] = df[column_name] - mean_value
+                # NOTE: the mean is accumulated in float64 and then subtracted in the column's own precision
+                mean_value = df[column_name].to_numpy().mean(dtype=np.float64)
+                df[column_name + '_meanshift'] = df[column_name] - \
+                    same_float_dtype(mean_value, df[column_name])
         # Update the dictionary with the modified dataframe
         dfs[key] = df
 
+# Reorient sensor axes to body axes ----------------------------------------------------------
+
+
+# The low back sensor is never mounted exactly the same way, so the raw x/y/z axes are only roughly VT/ML/AP.
+# This corrects the tilt of the sensor (Moe-Nilssen 1998): gravity is estimated from the mean acceleration
+# (whole run, or a static segment at the start) and each run is rotated so gravity lies exactly on the vertical axis.
+
+# Steps:
+# 1) Mean acceleration of each run -> unit gravity vector g (one per run)
+# 2) Rotation taking g onto the vertical axis (Rodrigues' formula, all runs at once)
+# 3) Runs with the same number of samples are stacked and rotated in one batched matrix multiply
+#    (np.einsum over runs x samples x 3) into a preallocated array
+# NOTE: the sign of the vertical axis is kept as the sensor has it (a sensor reading -9.81 on x stays negative),
+#       so only the tilt is corrected, never flipped
+# NOTE: gravity gives no information about rotation around the vertical axis, so ML and AP are only as good as the
+#       sensor was lined up with the direction of running
+
+
+def rotations_to_vertical(gravity, vertical_axis=0):
+    """
+    Rotation matrices (runs x 3 x 3) taking each gravity vector (runs x 3) onto the vertical axis
+    (0, 1 or 2, i.e. x, y or z of the sensor) with the same sign it already has.
+    """
+    gravity = np.asarray(gravity, dtype=np.float64).reshape(-1, 3)
+    g = gravity / np.linalg.norm(gravity, axis=1, keepdims=True)
+
+    target = np.zeros_like(g)
+    target[:, vertical_axis] = np.where(g[:, vertical_axis] < 0, -1.0, 1.0)
+
+    # Rodrigues: R = I + K + K^2 / (1 + cos), K is the cross product matrix of g x target
+    v = np.cross(g, target)
+    cos = np.einsum('ri,ri->r', g, target)
+    K = np.zeros((len(g), 3, 3))
+    K[:, 0, 1], K[:, 0, 2] = -v[:, 2], v[:, 1]
+    K[:, 1, 0], K[:, 1, 2] = v[:, 2], -v[:, 0]
+    K[:, 2, 0], K[:, 2, 1] = -v[:, 1], v[:, 0]
+    return np.eye(3) + K + (K @ K) / (1 + cos)[:, None, None]
+
+
+def reorient_to_body_axes(dfs, columns, new_columns=('vt_m/s/s', 'ml_m/s/s', 'ap_m/s/s'), vertical_axis=0, static_samples=None):
+    """
+    This function rotates the three acceleration columns of each dataframe in the input dictionary so gravity lies
+    on the vertical axis, and adds the rotated signals as new columns.
+
+    Arguments:
+    - dfs: a dictionary of pandas dataframes. The keys are the names of the dataframes and the values are the dataframes themselves.
+    - columns: the three sensor acceleration columns, e.g. ['accel_x (m/s2)', 'accel_y (m/s2)', 'accel_z (m/s2)'].
+    - new_columns: names of the rotated columns, in the same sensor axis order as 'columns'. With the default
+      vertical_axis=0 this is VT, ML, AP.
+    - vertical_axis: which of the three columns is (roughly) vertical when the sensor is worn, default is 0 (x).
+    - static_samples: number of samples at the start of each run to estimate gravity from (e.g. standing still before the run).
+      Default (None) uses the mean of the whole run.
+
+    If any of the columns does not exist in a dataframe, a warning message is issued and the dataframe is skipped.
+    The rotated columns keep the dtype of float input columns (float32 stays float32). Integer columns (raw counts)
+    are rotated in the float dtype selected with precision.set_precision, so they are not truncated.
+
+    The function returns a dictionary of {key: 3 x 3 rotation matrix} for the runs that were rotated.
+    """
+    # Runs are grouped by length so each group can be rotated in one batched multiply
+    groups = {}
+    for key in dfs.keys():
+        df = dfs[key]
+        missing = [col for col in columns if col not in df.columns]
+        if missing:
+            for col in missing:
+                warnings.warn(f"The column '{col}' does not exist in '{key}'")
+            continue
+        groups.setdefault(len(df), []).append(key)
+
+    rotations = {}
+    for n_samples, keys in groups.items():
+        dtype = np.result_type(*[dfs[key][columns].dtypes.iloc[i]
+                               for key in keys for i in range(3)])
+        if not np.issubdtype(dtype, np.floating):
+            dtype = get_float_dtype()
+        # (runs x samples x 3) stack of the sensor axes and a preallocated array for the rotated axes
+        stacked = np.empty((len(keys), n_samples, 3), dtype=dtype)
+        for i, key in enumerate(keys):
+            stacked[i] = dfs[key][columns].to_numpy(dtype=dtype)
+
+        # Gravity estimated in float64
+        segment = stacked if static_samples is None else stacked[:,
+                                                                 :static_samples]
+        gravity = segment.mean(axis=1, dtype=np.float64)
+        group_rotations = rotations_to_vertical(gravity, vertical_axis)
+
+        rotated = np.empty_like(stacked)
+        np.einsum('rij,rnj->rni', group_rotations.astype(dtype), stacked,
+                  out=rotated)
+
+        for i, key in enumerate(keys):
+            df = dfs[key]
+            for axis, new_col in enumerate(new_columns):
+                df[new_col] = rotated[i, :, axis]
+            # Update the dictionary with the modified dataframe
+            dfs[key] = df
+            rotations[key] = group_rotations[i]
+
+    return rotations
+
 
 # Function for creating the export table I need ----------------------------------------------------------
 
@@ -310,6 +670,37 @@ def append_df_to_excel(df_to_append, file_path, sheet_name):
     # Print a message to indicate that the file has been saved
     print(f'Data has been saved successfully to {file_path}.')
 
+
+# Columns that identify a result row of the export tables (export_tbl / export_tbl_imu_val)
+RESULT_KEY_COLUMNS = ['sub_id', 'run_type', 'sensor', 'variable']
+
+
+def upsert_df_to_excel(df_to_write, file_path, sheet_name, key_columns=RESULT_KEY_COLUMNS):
+    """
+    Same as append_df_to_excel, but rows already in the sheet with the same key_columns values as a new row are
+    replaced instead of kept, so re-running a job doesn't duplicate its results.
+    """
+    try:
+        with pd.ExcelFile(file_path) as xlsx:
+            df = pd.read_excel(xlsx, sheet_name=sheet_name)
+    except FileNotFoundError:
+        df = pd.DataFrame()
+
+    if not df.empty:
+        # Compared as text, with ids like '00917' and 917 (a sensor id read back from Excel as a number) the same,
+        # and None the same as the empty cell it is read back as
+        def row_keys(table):
+            return pd.MultiIndex.from_frame(table[key_columns].astype(object).fillna('').astype(str).apply(
+                lambda col: col.where(~col.str.isdigit(), col.str.lstrip('0').replace('', '0'))))
+        df = df[~row_keys(df).isin(row_keys(df_to_write))]
+
+    df = pd.concat([df, df_to_write], ignore_index=True)
+
+    with pd.ExcelWriter(file_path) as writer:
+        df.to_excel(writer, sheet_name=sheet_name, index=False)
+
+    print(f'Data has been saved successfully to {file_path}.')
+
 # Remove dfs from a dictionary based on trial number ----------------------------------------------------------
 
 
@@ -382,21 +773,23 @@ def peak_and_window_data(dfs, offset_times_df, sampling_rate=500, search_window_
     # Store peak timestamps and indices for each trial of right_tibia
     right_tibia_peaks = {}
 
+    # NOTE: rows are looked up by position on NumPy views of the columns (instead of df.reset_index(drop=True),
+    # which copies the whole dataframe)
+
     # First loop: Process only right_tibia
     for key, df in dfs.items():
-        df = df.reset_index(drop=True)
         parts = key.split('_')
         body_part = '_'.join(parts[6:8])
         trial_num = int(parts[-1].replace('trial', ''))
 
         if body_part == 'right_tibia':
-            initial_peak_row = df['res_g'].idxmax()
-            peak_timestamp = df.loc[initial_peak_row, 'timestamp']
+            initial_peak_row = int(np.nanargmax(df['res_g'].to_numpy()))
+            peak_timestamp = df['timestamp'].to_numpy()[initial_peak_row]
             right_tibia_peaks[trial_num] = (initial_peak_row, peak_timestamp)
 
     # Second loop: Process left_tibia and right_tibia (for creating search windows)
     for key, df in dfs.items():
-        df = df.reset_index(drop=True)
+        timestamps = df['timestamp'].to_numpy()
         parts = key.split('_')
         body_part = '_'.join(parts[6:8])
         trial_num = int(parts[-1].replace('trial', ''))
@@ -414,7 +807,7 @@ def peak_and_window_data(dfs, offset_times_df, sampling_rate=500, search_window_
             if body_part == 'right_tibia':
                 peak_row = right_tibia_peak_row
                 peak_timestamp = right_tibia_peak_timestamp
-                peak_value = df['res_g'].max()
+                peak_value = np.nanmax(df['res_g'].to_numpy())
             else:  # For left_tibia, use right_tibia's peak timestamp but no peak value
                 peak_row = right_tibia_peak_row  # Aligning with the right_tibia
                 peak_timestamp = None  # No peak timestamp for left_tibia
@@ -430,10 +823,10 @@ def peak_and_window_data(dfs, offset_times_df, sampling_rate=500, search_window_
                 len(df) - 1, row_offset + search_window_margin)
 
             # Fetch timestamp values for the window start and end indices
-            window_start_timestamp = df.loc[window_start_idx,
-                                            'timestamp'] if window_start_idx < len(df) else None
-            window_end_timestamp = df.loc[window_end_idx,
-                                          'timestamp'] if window_end_idx < len(df) else None
+            window_start_timestamp = timestamps[window_start_idx] if window_start_idx < len(
+                df) else None
+            window_end_timestamp = timestamps[window_end_idx] if window_end_idx < len(
+                df) else None
 
             # Append the data to the summary list
             summary_data.append({
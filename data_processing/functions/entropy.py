@@ -0,0 +1,316 @@
+"""
+Functions for entropy measures built on one shared template matching core
+ - Sample Entropy (SampEn), same definition as nolds.sampen (masked_sample_entropy leaves out templates with masked rows)
+ - Approximate Entropy (ApEn)
+ - Fuzzy Entropy (FuzzyEn)
+ - Multiscale versions of all three (coarse-grained scales, e.g. 1-20)
+
+How the work is shared:
+ - The coarse-grained series for every scale come from one cumulative sum of the signal.
+ - For each scale the template vectors (length m and m+1) are put into a KD-tree once (Chebyshev distance).
+   Sample entropy and approximate entropy are both read off the same neighbour counts from those trees, so asking
+   for both costs about the same as asking for one.
+ - Counting neighbours with a KD-tree avoids comparing every template with every other template in Python,
+   which is what makes nolds.sampen slow on 5 min runs.
+"""
+# Packages
+import numpy as np
+import pandas as pd
+import warnings
+from numpy.lib.stride_tricks import sliding_window_view
+
+from ._lazy import lazy_module
+
+# scipy.spatial is imported the first time a tree is built
+spatial = lazy_module('scipy.spatial')
+
+MEASURES = ('sampen', 'apen', 'fuzzyen')
+
+# Coarse graining ----------------------------------------------------------
+
+
+def coarse_grain(x, scale, cumsum=None):
+    """
+    Coarse-grained series for multiscale entropy: the mean of consecutive, non-overlapping windows of 'scale' samples.
+    Pass 'cumsum' (np.concatenate([[0], np.cumsum(x)])) to reuse it across scales.
+    """
+    x = np.asarray(x, dtype=np.float64)
+    if scale == 1:
+        return x
+    if cumsum is None:
+        cumsum = np.concatenate([[0.0], np.cumsum(x)])
+    n_windows = len(x) // scale
+    window_ends = cumsum[scale:(n_windows * scale) + 1:scale]
+    window_starts = cumsum[0:n_windows * scale:scale]
+    return (window_ends - window_starts) / scale
+
+
+def default_tolerance(x):
+    # 0.2 x sample SD (ddof=1), the usual choice (Richman & Moorman 2000). NOTE: not exactly the nolds.sampen default:
+    # recent nolds uses the sample SD x 0.1164 x (0.5627 x ln(emb_dim) + 1.3334) (0.2006 x SD for emb_dim=2) and
+    # older releases used np.std with ddof=0. Pass the tolerance explicitly to match a nolds result exactly.
+    return 0.2 * np.std(np.asarray(x, dtype=np.float64), ddof=1)
+
+# Template matching core ----------------------------------------------------------
+
+
+class _Templates:
+    """
+    Template vectors of one series and the neighbour counts every measure needs.
+    Trees and counts are built the first time they are needed and then reused.
+    """
+
+    def __init__(self, x, emb_dim, tolerance):
+        self.x = np.asarray(x, dtype=np.float64)
+        self.m = emb_dim
+        self.n = len(self.x)
+        # nolds (and the usual definition of SampEn) counts distances *strictly* less than the tolerance,
+        # KD-tree counts are <= r, so use the next float below the tolerance
+        self.r = tolerance
+        self.r_strict = np.nextafter(tolerance, -np.inf)
+        self._trees = {}
+        self._counts = {}
+
+    def embedding(self, length):
+        # All n - length + 1 template vectors of the given length (a view, no copy)
+        return sliding_window_view(self.x, length)
+
+    def tree(self, length):
+        if length not in self._trees:
+            self._trees[length] = spatial.cKDTree(self.embedding(length))
+        return self._trees[length]
+
+    def counts(self, length):
+        """
+        Number of templates within the tolerance of each template (including itself), for all n - length + 1 templates.
+        """
+        if length not in self._counts:
+            tree = self.tree(length)
+            self._counts[length] = tree.query_ball_point(
+                tree.data, self.r_strict, p=np.inf, return_length=True)
+        return self._counts[length]
+
+    def pair_count(self, length, n_templates):
+        """
+        Number of (unordered, non-self) pairs of the first 'n_templates' templates that are within the tolerance.
+        """
+        if length in self._counts:
+            # Reuse the per-template counts if ApEn already computed them
+            counts = self._counts[length]
+            pairs = (counts.sum() - len(counts)) // 2
+            # Remove pairs with the templates past n_templates
+            extra = self.embedding(length)[n_templates:]
+            if len(extra):
+                kept_tree = spatial.cKDTree(self.embedding(length)[:n_templates])
+                pairs -= kept_tree.query_ball_point(
+                    extra, self.r_strict, p=np.inf, return_length=True).sum()
+                # Pairs between two of the extra templates were removed above but also need removing from the total
+                extra_tree = spatial.cKDTree(extra)
+                pairs -= (extra_tree.count_neighbors(extra_tree,
+                          self.r_strict, p=np.inf) - len(extra)) // 2
+            return int(pairs)
+
+        tree = self.tree(length) if n_templates == self.n - length + \
+            1 else spatial.cKDTree(self.embedding(length)[:n_templates])
+        return int((tree.count_neighbors(tree, self.r_strict, p=np.inf) - n_templates) // 2)
+
+# Single series measures ----------------------------------------------------------
+
+
+def _sampen_from_templates(templates):
+    m = templates.m
+    n_templates = templates.n - m
+    if n_templates < 2:
+        return np.nan
+    # Same as nolds: n - m templates for both m and m+1
+    count_m = templates.pair_count(m, n_templates)
+    count_m1 = templates.pair_count(m + 1, n_templates)
+    return _sampen_from_counts(count_m, count_m1)
+
+
+def _sampen_from_counts(count_m, count_m1):
+    if count_m == 0 or count_m1 == 0:
+        warnings.warn(
+            'Zero template matches within tolerance. Consider raising the tolerance.', RuntimeWarning)
+        if count_m == 0 and count_m1 == 0:
+            return np.nan
+        return np.inf if count_m > 0 else -np.inf
+    return -np.log(count_m1 / count_m)
+
+
+def _apen_from_templates(templates):
+    m = templates.m
+    if templates.n - m < 1:
+        return np.nan
+    # phi(m) = mean of log(C_i) where C_i is the fraction of templates within the tolerance of template i (itself included)
+    counts_m = templates.counts(m)
+    counts_m1 = templates.counts(m + 1)
+    phi_m = np.mean(np.log(counts_m / len(counts_m)))
+    phi_m1 = np.mean(np.log(counts_m1 / len(counts_m1)))
+    return phi_m - phi_m1
+
+
+def _fuzzy_phi(x, length, n_templates, tolerance, n, chunk_size, eps):
+    # Templates with their own mean removed (baseline removal, Chen et al. 2007)
+    templates = sliding_window_view(x, length)[:n_templates]
+    templates = templates - templates.mean(axis=1, keepdims=True)
+    # Similarity exp(-d^n / r) is below 'eps' past this distance, so pairs further apart than this are ignored
+    max_distance = (-tolerance * np.log(eps)) ** (1.0 / n)
+
+    tree = spatial.cKDTree(templates)
+    total = 0.0
+    for start in range(0, n_templates, chunk_size):
+        chunk_tree = spatial.cKDTree(templates[start:start + chunk_size])
+        pairs = chunk_tree.sparse_distance_matrix(
+            tree, max_distance, p=np.inf, output_type='ndarray')
+        total += np.exp(-(pairs['v'] ** n) / tolerance).sum()
+    # Every template paired with itself (distance 0, similarity 1) is in the sum above, take those out
+    total -= n_templates
+    return total / (n_templates * (n_templates - 1))
+
+
+def sample_entropy(x, emb_dim=2, tolerance=None):
+    """
+    Sample entropy of a 1D signal. Gives the same result as nolds.sampen(x, emb_dim, tolerance) (Chebyshev distance,
+    distances strictly below the tolerance count as matches).
+    - tolerance: absolute tolerance r (default 0.2 x sample SD of x, see default_tolerance for how it differs from nolds).
+    """
+    x = np.asarray(x, dtype=np.float64)
+    tolerance = default_tolerance(x) if tolerance is None else tolerance
+    return _sampen_from_templates(_Templates(x, emb_dim, tolerance))
+
+
+def masked_sample_entropy(x, mask, emb_dim=2, tolerance=None):
+    """
+    Sample entropy of a 1D signal leaving out every template that has a masked row in it (e.g. the long gaps marked
+    by prep.rebuild_time_base), so no template spans a gap. With nothing masked it is the same as sample_entropy.
+    - mask: boolean array, True = leave the row out.
+    - tolerance: absolute tolerance r (default 0.2 x SD of the unmasked rows).
+    """
+    x = np.asarray(x, dtype=np.float64)
+    mask = np.asarray(mask, dtype=bool)
+    tolerance = default_tolerance(x[~mask]) if tolerance is None else tolerance
+    m = emb_dim
+    if len(x) - m < 2:
+        return np.nan
+
+    # Same n - m template starts as sample_entropy, keeping those whose m + 1 rows are all unmasked
+    masked_count = np.concatenate([[0], np.cumsum(mask, dtype=np.int64)])
+    starts = np.flatnonzero(masked_count[m + 1:] - masked_count[:-(m + 1)] == 0)
+    if len(starts) < 2:
+        return np.nan
+
+    r_strict = np.nextafter(tolerance, -np.inf)
+    counts = []
+    for length in (m, m + 1):
+        tree = spatial.cKDTree(sliding_window_view(x, length)[starts])
+        counts.append(int((tree.count_neighbors(tree, r_strict, p=np.inf) - len(starts)) // 2))
+    return _sampen_from_counts(*counts)
+
+
+def approximate_entropy(x, emb_dim=2, tolerance=None):
+    """
+    Approximate entropy (Pincus 1991) of a 1D signal (Chebyshev distance, self matches included).
+    - tolerance: absolute tolerance r (default 0.2 x sample SD of x, see default_tolerance for how it differs from nolds).
+    """
+    x = np.asarray(x, dtype=np.float64)
+    tolerance = default_tolerance(x) if tolerance is None else tolerance
+    return _apen_from_templates(_Templates(x, emb_dim, tolerance))
+
+
+def fuzzy_entropy(x, emb_dim=2, tolerance=None, n=2, chunk_size=20000, eps=1e-8):
+    """
+    Fuzzy entropy (Chen et al. 2007) of a 1D signal: baseline removed templates, Chebyshev distance d and
+    similarity exp(-d^n / r).
+    - tolerance: r (default 0.2 x SD of x).
+    - n: the exponent of the similarity function.
+    - eps: pairs with a similarity below eps are left out (this is what keeps it from being a full N x N comparison).
+
+    NOTE: unlike SampEn, every pair of templates has some similarity, so the cost grows with the number of pairs
+    closer than the cut-off distance. Use it on coarse-grained scales or windows rather than a whole 1125hz run.
+    """
+    x = np.asarray(x, dtype=np.float64)
+    tolerance = default_tolerance(x) if tolerance is None else tolerance
+    n_templates = len(x) - emb_dim
+    if n_templates < 2:
+        return np.nan
+    phi_m = _fuzzy_phi(x, emb_dim, n_templates,
+                       tolerance, n, chunk_size, eps)
+    phi_m1 = _fuzzy_phi(x, emb_dim + 1, n_templates,
+                        tolerance, n, chunk_size, eps)
+    return np.log(phi_m) - np.log(phi_m1)
+
+
+def multiscale_entropy(x, scales=range(1, 21), emb_dim=2, tolerance=None, measures=('sampen', 'apen')):
+    """
+    Entropy of the coarse-grained series at each scale.
+
+    - tolerance: absolute r used at *every* scale (default 0.2 x SD of the original series, as in Costa et al. 2002).
+    - measures: any of 'sampen', 'apen', 'fuzzyen'.
+
+    Returns a dictionary of {(measure, scale): value}.
+    """
+    x = np.asarray(x, dtype=np.float64)
+    unknown = set(measures) - set(MEASURES)
+    if unknown:
+        raise ValueError(
+            f"Unknown measures: {', '.join(sorted(unknown))}. Options are: {', '.join(MEASURES)}")
+    tolerance = default_tolerance(x) if tolerance is None else tolerance
+    cumsum = np.concatenate([[0.0], np.cumsum(x)])
+
+    values = {}
+    for scale in scales:
+        series = coarse_grain(x, scale, cumsum=cumsum)
+        # One set of templates per scale shared by all the measures
+        templates = _Templates(series, emb_dim, tolerance)
+        # ApEn first so SampEn can reuse its per-template counts
+        if 'apen' in measures:
+            values[('apen', scale)] = _apen_from_templates(templates)
+        if 'sampen' in measures:
+            values[('sampen', scale)] = _sampen_from_templates(templates)
+        if 'fuzzyen' in measures:
+            values[('fuzzyen', scale)] = fuzzy_entropy(
+                series, emb_dim=emb_dim, tolerance=tolerance)
+    return values
+
+# Entropy suite for specified columns for each df in a dictionary ----------------------------------------------------------
+
+
+def apply_entropy_suite_to_dfs(dfs, columns, scales=range(1, 21), emb_dim=2, tolerance=None, measures=('sampen', 'apen')):
+    """
+    This function calculates multiscale sample entropy, approximate entropy and/or fuzzy entropy of the specified columns
+    in each dataframe in the input dictionary (e.g. the VT, ML, AP and resultant columns).
+
+    Arguments:
+    - dfs: a dictionary of pandas dataframes.
+    - columns: a list of column names to calculate the entropy measures for.
+    - scales: coarse-graining scales, default is 1-20 (scale 1 is the original signal).
+    - emb_dim: embedding dimension (m), default is 2.
+    - tolerance: absolute tolerance (r). Default (None) is 0.2 x SD of each column, used at every scale.
+    - measures: any of 'sampen', 'apen', 'fuzzyen'.
+
+    The variable names are the column name plus the measure and scale, e.g. 'res_m/s/s_sampen_scale3'.
+    If a column in 'columns' does not exist in a dataframe, a warning message is issued and the column is skipped.
+
+    The function returns a dataframe in the same long format as apply_sampen_to_dfs (key, variable, value).
+    """
+    results = []
+
+    for key in dfs.keys():
+        df = dfs[key]
+
+        for col in columns:
+            if col in df.columns:
+                values = multiscale_entropy(
+                    df[col].to_numpy(dtype=np.float64), scales=scales, emb_dim=emb_dim, tolerance=tolerance, measures=measures)
+                for (measure, scale), value in values.items():
+                    results.append({
+                        'key': key,
+                        'variable': f'{col}_{measure}_scale{scale}',
+                        'value': value
+                    })
+            else:
+                warnings.warn(f"The column '{col}' does not exist in '{key}'")
+
+    result_df = pd.DataFrame(results)
+    return result_df
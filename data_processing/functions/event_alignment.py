@@ -0,0 +1,245 @@
+"""
+Functions for lining up the IMU trials of the IMU validation (chapter 3) with the force plate
+
+Replaces the hand measured offset times (data/validity_og/offset_times/...) used by prep.peak_and_window_data:
+ - The lag between the IMU resultant and a reference signal (e.g. the force plate vertical force, resampled to the
+   IMU rate) is found with FFT cross-correlation, for all trials in one batched FFT
+ - The lag is refined to a fraction of a sample with a parabola through the correlation peak
+ - The foot strike on the force plate (first time the force goes above a contact threshold) is moved onto the IMU
+   time line with that lag and turned into the same offset (secs from the right tibia stomp peak) as the offset files
+
+The output has the same imu / trial_num / offset columns as the offset files, so it goes straight into
+prep.filter_out_dfs and prep.peak_and_window_data (which returns offset_windows_df). create_offset_windows does the
+alignment and peak_and_window_data in one call.
+
+Read only: the dfs passed in are not modified.
+"""
+# Packages
+import re
+import numpy as np
+import pandas as pd
+import warnings
+
+from . import data_prep as prep
+from ._lazy import lazy_module
+
+# scipy.fft is imported the first time signals are cross correlated
+fft = lazy_module('scipy.fft')
+
+# Cross-correlation ----------------------------------------------------------
+
+
+def _standardise(signal):
+    signal = np.asarray(signal, dtype=np.float64)
+    signal = signal - np.nanmean(signal)
+    sd = np.nanstd(signal)
+    return np.nan_to_num(signal / sd if sd > 0 else signal)
+
+
+def cross_correlation_lags(signals, references, max_lag=None):
+    """
+    Lag (in samples, with a sub-sample part) of each signal relative to its reference, for all pairs at once.
+
+    A positive lag means an event at sample i of the reference is at sample i + lag of the signal.
+
+    Arguments:
+    - signals, references: lists of 1D arrays (one pair per trial, lengths can differ), same sample rate.
+    - max_lag: only look for lags up to this many samples either way (default: any lag).
+
+    Returns (lags, peak_correlations). The peak correlation (about -1 to 1) is a check on how well each pair lines up.
+    """
+    n_pairs = len(signals)
+    signal_lengths = np.array([len(signal) for signal in signals])
+    reference_lengths = np.array([len(reference) for reference in references])
+    # Zero padding so the circular correlation has no wrap-around
+    fft_length = fft.next_fast_len(
+        int(signal_lengths.max() + reference_lengths.max() - 1), real=True)
+
+    padded_signals = np.zeros((n_pairs, fft_length))
+    padded_references = np.zeros((n_pairs, fft_length))
+    for i in range(n_pairs):
+        padded_signals[i, :signal_lengths[i]] = _standardise(signals[i])
+        padded_references[i, :reference_lengths[i]
+                          ] = _standardise(references[i])
+
+    # One batched FFT for all trials: corr[k] = sum_n signal[n + k] * reference[n]
+    correlation = fft.irfft(fft.rfft(padded_signals, axis=1) *
+                            np.conj(fft.rfft(padded_references, axis=1)), n=fft_length, axis=1)
+    # Normalise so a perfect match is 1
+    correlation /= np.sqrt(signal_lengths * reference_lengths)[:, None]
+
+    # Lag of each index of the circular correlation for each pair: indices below the signal length are the positive
+    # lags (0 to signal length - 1), the last reference length - 1 indices are the negative lags
+    index = np.arange(fft_length)
+    lag_of_index = np.where(index < signal_lengths[:, None], index, index - fft_length)
+    allowed = (lag_of_index > -reference_lengths[:, None]) & (
+        lag_of_index < signal_lengths[:, None])
+    if max_lag is not None:
+        allowed &= np.abs(lag_of_index) <= max_lag
+    correlation_search = np.where(allowed, correlation, -np.inf)
+
+    best = np.argmax(correlation_search, axis=1)
+    rows = np.arange(n_pairs)
+    peak = correlation[rows, best]
+
+    # Parabola through the peak and its two neighbours for the sub-sample part
+    before = correlation[rows, (best - 1) % fft_length]
+    after = correlation[rows, (best + 1) % fft_length]
+    denominator = before - 2 * peak + after
+    with np.errstate(divide='ignore', invalid='ignore'):
+        shift = np.where(denominator < 0, 0.5 *
+                         (before - after) / denominator, 0.0)
+
+    return lag_of_index[rows, best] + shift, peak
+
+
+def check_cross_correlation_lags(signal_length=5000, reference_length=1000, lags=(-600, 0, 500, 2000, 3500, 3900),
+                                 seed=0):
+    """
+    Cuts references out of a random signal at known lags (negative lags start the reference before the signal) and
+    checks cross_correlation_lags finds them, including lags over half the FFT length.
+    Returns a list of the lags that weren't found (empty if all were).
+    """
+    rng = np.random.default_rng(seed)
+    padding = reference_length
+    source = rng.normal(size=signal_length + 2 * padding)
+    signal = source[padding:padding + signal_length]
+    references = [source[padding + lag:padding + lag + reference_length] for lag in lags]
+    found, _ = cross_correlation_lags([signal] * len(lags), references)
+    return [lag for lag, lag_found in zip(lags, found) if abs(lag_found - lag) > 0.5]
+
+# Reference event ----------------------------------------------------------
+
+
+def contact_index(force, threshold):
+    """
+    Sample position (with a fraction, linear interpolation) where the force first goes above the threshold,
+    or NaN if it never does.
+    """
+    force = np.asarray(force, dtype=np.float64)
+    above = np.flatnonzero(force >= threshold)
+    if len(above) == 0:
+        return np.nan
+    i = above[0]
+    if i == 0:
+        return 0.0
+    return (i - 1) + (threshold - force[i - 1]) / (force[i] - force[i - 1])
+
+# Offsets for each trial ----------------------------------------------------------
+
+
+TRIAL_PATTERN = re.compile(r'trial(\d+)$')
+
+
+def _imu_and_trial(key):
+    # Same key layout as peak_and_window_data: body part is parts 6-7, the trial number is the end of the key
+    parts = key.split('_')
+    return '_'.join(parts[6:8]), int(parts[-1].replace('trial', ''))
+
+
+def align_trials_to_reference(dfs, reference_dfs, imu_column='res_g', reference_column='fz', sampling_rate=500,
+                              reference_sampling_rate=None, contact_threshold=20, max_lag_s=None):
+    """
+    This function works out the offset time of each IMU trial from the force plate (reference) trials.
+
+    Arguments:
+    - dfs: a dictionary of IMU trial dfs (same keys as for peak_and_window_data, with left_tibia / right_tibia trials).
+    - reference_dfs: a dictionary of reference (force plate) dfs with keys ending in 'trial{n}'.
+    - imu_column: IMU column cross-correlated with the reference, default is 'res_g'.
+    - reference_column: reference column, e.g. the vertical force, default is 'fz'.
+    - sampling_rate: IMU sample rate, default is 500hz (same as peak_and_window_data).
+    - reference_sampling_rate: reference sample rate. If it differs from the IMU rate the reference is resampled to it.
+    - contact_threshold: force (same units as the reference column) for the foot strike, default is 20.
+    - max_lag_s: only look for lags up to this many secs either way (default: any lag).
+
+    If a column does not exist in a dataframe or a trial has no reference, a warning message is issued and the trial is skipped.
+
+    The function returns a dataframe with the columns of the offset files (imu, trial_num, offset) plus lag_s
+    (IMU vs reference) and xcorr_peak (how well the signals lined up, 1 is a perfect match).
+    """
+    references = {}
+    for key, df in reference_dfs.items():
+        match = TRIAL_PATTERN.search(key)
+        if match is None:
+            continue
+        if reference_column not in df.columns:
+            warnings.warn(
+                f"The column '{reference_column}' does not exist in '{key}'")
+            continue
+        reference = df[reference_column].to_numpy(dtype=np.float64)
+        if reference_sampling_rate is not None and reference_sampling_rate != sampling_rate:
+            reference = prep.resample_signals(
+                reference, reference_sampling_rate, sampling_rate)
+        references[int(match.group(1))] = reference
+
+    # Right tibia stomp (initial peak) of each trial, which the offsets are measured from
+    stomp_rows = {}
+    trials = []
+    for key, df in dfs.items():
+        imu, trial_num = _imu_and_trial(key)
+        if imu_column not in df.columns:
+            warnings.warn(f"The column '{imu_column}' does not exist in '{key}'")
+            continue
+        if trial_num not in references:
+            warnings.warn(f"No reference trial found for '{key}'")
+            continue
+        signal = df[imu_column].to_numpy(dtype=np.float64)
+        if imu == 'right_tibia':
+            stomp_rows[trial_num] = int(np.nanargmax(signal))
+        trials.append((key, imu, trial_num, signal))
+
+    if not trials:
+        return pd.DataFrame(columns=['imu', 'trial_num', 'offset', 'lag_s', 'xcorr_peak'])
+
+    # All trials in one batched cross-correlation
+    lags, peaks = cross_correlation_lags(
+        [signal for _, _, _, signal in trials],
+        [references[trial_num] for _, _, trial_num, _ in trials],
+        max_lag=None if max_lag_s is None else int(np.ceil(max_lag_s * sampling_rate)))
+
+    results = []
+    for (key, imu, trial_num, _), lag, peak in zip(trials, lags, peaks):
+        if trial_num not in stomp_rows:
+            warnings.warn(f"No right tibia trial found for '{key}'")
+            continue
+        # Foot strike on the IMU time line, measured from the right tibia stomp (like the offset files)
+        event_row = contact_index(
+            references[trial_num], contact_threshold) + lag
+        results.append({
+            'imu': imu,
+            'trial_num': trial_num,
+            'offset': (event_row - stomp_rows[trial_num]) / sampling_rate,
+            'lag_s': lag / sampling_rate,
+            'xcorr_peak': peak,
+        })
+
+    result_df = pd.DataFrame(results)
+    return result_df
+
+
+def create_offset_windows(dfs, reference_dfs, imu_column='res_g', reference_column='fz', sampling_rate=500,
+                          reference_sampling_rate=None, contact_threshold=20, max_lag_s=None, min_xcorr_peak=None,
+                          search_window_margin=50):
+    """
+    This function replaces reading the offset file + prep.peak_and_window_data for one subject and run type.
+
+    Arguments are the same as align_trials_to_reference, plus:
+    - min_xcorr_peak: trials that line up worse than this (xcorr_peak) are left out, default keeps every trial.
+    - search_window_margin: passed on to prep.peak_and_window_data, default is 50 samples.
+
+    The function returns (offset_windows_df, offset_times_df): offset_windows_df has the same columns as
+    prep.peak_and_window_data (for plots.plot_trial_data), offset_times_df is the output of align_trials_to_reference
+    (can be passed to prep.filter_out_dfs or saved in place of the offset file).
+    """
+    offset_times_df = align_trials_to_reference(
+        dfs, reference_dfs, imu_column=imu_column, reference_column=reference_column, sampling_rate=sampling_rate,
+        reference_sampling_rate=reference_sampling_rate, contact_threshold=contact_threshold, max_lag_s=max_lag_s)
+    offset_times_df = offset_times_df.dropna(subset=['offset'])
+    if min_xcorr_peak is not None:
+        offset_times_df = offset_times_df[offset_times_df['xcorr_peak']
+                                          >= min_xcorr_peak]
+    offset_times_df = offset_times_df.reset_index(drop=True)
+
+    offset_windows_df = prep.peak_and_window_data(
+        dfs, offset_times_df, sampling_rate=sampling_rate, search_window_margin=search_window_margin)
+    return offset_windows_df, offset_times_df
@@ -3,36 +3,126 @@ Function for brining in files w/ Tkinter GUI
 Will store each file as a dataframe within a dictionary
 
 NOTE: Has several conditions for handeling file names specific for this project
+NOTE: .imuz archives (see imu_archive) are read the same way as the CSV files they were made from
 """
 # Packages ---
-import tkinter as tk
-from tkinter import filedialog
+import os
+import numpy as np
 import pandas as pd
 
+from . import imu_archive
+from . import precision
+from ._lazy import lazy_module
+
+# Tkinter is only imported when a file dialog is opened (the 'gui' extra), so the non-GUI readers work on a
+# headless machine
+tk = lazy_module('tkinter', extra='gui')
+filedialog = lazy_module('tkinter.filedialog', extra='gui')
+
+
+def _tk_root():
+    # Tkinter root window for the file dialogs
+    try:
+        return tk.Tk()
+    except ImportError:
+        # Tkinter is not installed: keep the message from the lazy import (and don't evaluate tk.TclError below,
+        # which would try the import again)
+        raise
+    except tk.TclError as e:
+        raise RuntimeError('The file dialog needs a display. On a headless machine use read_csv_files_from_dir '
+                           'instead.') from e
+
+# Reading a single CSV ----------------------------------------------------------
+
+
+def read_csv(filepath):
+    """
+    Reads a CSV file into a dataframe using the precision selected with precision.set_precision.
+    In float32 mode the float (non-time) columns are parsed straight to float32.
+    """
+    if precision.get_float_dtype() == np.float64:
+        return pd.read_csv(filepath)
+
+    # Read the first rows to find which columns are floats, then parse the whole file with those set to float32
+    df_head = pd.read_csv(filepath, nrows=100)
+    return pd.read_csv(filepath, dtype=precision.float_column_dtypes(df_head.dtypes.items()))
+
+
+def read_file(filepath, columns=None, start_s=None, end_s=None, rows=None):
+    """
+    Reads a CSV file or a .imuz archive into a dataframe.
+
+    - columns, start_s, end_s, rows: optional, only read part of the file (see imu_archive.read_archive), e.g.
+      rows=slice(-337500, None) for the 5 min crop at 1125hz. Archives only read the chunks needed, CSV files are
+      read whole and then cut down (same result).
+    """
+    if filepath.lower().endswith(imu_archive.ARCHIVE_EXTENSION):
+        return imu_archive.read_archive(filepath, columns=columns, start_s=start_s, end_s=end_s, rows=rows)
+
+    df = read_csv(filepath)
+    if start_s is not None or end_s is not None or rows is not None:
+        time_column = next((col for col in imu_archive.TIME_COLUMNS if col in df.columns), None)
+        df = imu_archive.select_rows(df, time_column, start_s, end_s, rows)
+    return df if columns is None else df[list(columns)]
+
 # File import function ----------------------------------------------------------
 
 
 def read_csv_files_gui(initialdir):
-    # Create an empty dictionary to store each file as a dataframe
-    dfs = {}
-
     # Create a Tkinter root window
-    root = tk.Tk()
+    root = _tk_root()
     root.withdraw()  # NOTE: only way I found to get Tkinter to stop running
 
     # Open file dialog to select multiple CSV files
     filepaths = filedialog.askopenfilenames(
         title="Select Files",
         initialdir=initialdir,
-        filetypes=(("csv files", "*.csv"),))
+        filetypes=(("csv files", "*.csv"), ("IMU archives", "*" + imu_archive.ARCHIVE_EXTENSION)))
+
+    return read_csv_files(filepaths)
+
+# File import without the GUI ----------------------------------------------------------
+
+
+def data_files_in_dir(directory):
+    """
+    The CSV files and .imuz archives in 'directory' (sorted). If a CSV file has an archive next to it (same name)
+    only the archive is listed.
+    """
+    filenames = os.listdir(directory)
+    archives = {os.path.splitext(filename)[0] for filename in filenames
+                if filename.lower().endswith(imu_archive.ARCHIVE_EXTENSION)}
+    return sorted(
+        os.path.join(directory, filename) for filename in filenames
+        if filename.lower().endswith(imu_archive.ARCHIVE_EXTENSION)
+        or (filename.lower().endswith(".csv") and os.path.splitext(filename)[0] not in archives))
+
+
+def read_csv_files_from_dir(directory, **read_options):
+    """
+    Same as read_csv_files_gui but reads every CSV file (or .imuz archive, see data_files_in_dir) in 'directory'
+    instead of asking for files in a dialog.
+    Used for batch processing (no Tkinter window, so it also works on a headless machine).
+    """
+    return read_csv_files(data_files_in_dir(directory), **read_options)
+
+
+def read_csv_files(filepaths, **read_options):
+    """
+    Reads a list of CSV files (or .imuz archives) into a dictionary of dataframes.
+    The keys follow the same filename rules as read_csv_files_gui.
+    read_options (columns, start_s, end_s, rows) only read part of each file, see read_file.
+    """
+    # Create an empty dictionary to store each file as a dataframe
+    dfs = {}
 
-    # Loop through the selected filepaths and read each CSV file into a dataframe
+    # Loop through the filepaths and read each CSV file into a dataframe
     # Then store each dataframe in a dictionary with a modified filename as its key
     for filepath in filepaths:
-        df = pd.read_csv(filepath)
-
-        # Get the filename from the filepath
-        filename = filepath.split("/")[-1]
+        # Get the filename from the filepath (archives are named like the CSV file they came from)
+        filename = os.path.basename(filepath)
+        if filename.lower().endswith(imu_archive.ARCHIVE_EXTENSION):
+            filename = filename[:-len(imu_archive.ARCHIVE_EXTENSION)] + ".csv"
 
         # Check if the filename contains the characters "PRS"
         if "PRS" not in filename:
@@ -48,8 +138,8 @@ def read_csv_files_gui(initialdir):
         # Make the modified filename all lowercase
         df_name = df_name.lower()
 
-        # Read the CSV file into a dataframe
-        df = pd.read_csv(filepath)
+        # Read the CSV file (or archive) into a dataframe
+        df = read_file(filepath, **read_options)
 
         # Append the dataframe to the dictionary using its modified filename as its key
         dfs[df_name] = df
@@ -67,7 +157,7 @@ def read_csv_files_gui_2(initialdir):
     dfs = {}
 
     # Create a Tkinter root window
-    root = tk.Tk()
+    root = _tk_root()
     root.withdraw()  # NOTE: only way I found to get Tkinter to stop running
 
     # Open file dialog to select multiple CSV files
@@ -79,7 +169,7 @@ def read_csv_files_gui_2(initialdir):
     # Loop through the selected filepaths and read each CSV file into a dataframe
     # Then store each dataframe in a dictionary with a modified filename as its key
     for filepath in filepaths:
-        df = pd.read_csv(filepath)
+        df = read_csv(filepath)
 
         # Get the filename from the filepath
         filename = filepath.split("/")[-1]
@@ -111,7 +201,7 @@ def read_csv_files_gui_2(initialdir):
         df_name = df_name.lower()
 
         # Read the CSV file into a dataframe
-        df = pd.read_csv(filepath)
+        df = read_csv(filepath)
 
         # Append the dataframe to the dictionary using its modified filename as its key
         dfs[df_name] = df
@@ -129,7 +219,7 @@ def read_csv_files_gui_3(initialdir):
     dfs = {}
 
     # Create a Tkinter root window
-    root = tk.Tk()
+    root = _tk_root()
     root.withdraw()  # Hide the main window
 
     # Open file dialog to select multiple CSV files
@@ -147,7 +237,7 @@ def read_csv_files_gui_3(initialdir):
         filename_without_extension = os.path.splitext(filename)[0]
 
         # Read the CSV file into a dataframe
-        df = pd.read_csv(filepath)
+        df = read_csv(filepath)
 
         # Append the dataframe to the dictionary using its filename as its key
         dfs[filename_without_extension] = df
@@ -0,0 +1,213 @@
+"""
+Functions for splitting a tibia IMU run into strides (gait cycles)
+ - Foot strikes detected once from the resultant acceleration (peak_detection.find_peak_indices)
+ - Every stride time-normalised to 101 points (0-100% of the stride) in one (strides x 101 x columns) array
+ - Per-stride features (peak, impulse, loading rate, stride time) for all strides and columns at once
+
+A new stride level measure only needs another calculation on the strides array, not another pass through the dfs.
+
+Read only: the dfs passed in are not modified.
+"""
+# Packages
+import numpy as np
+import pandas as pd
+import warnings
+
+from . import peak_detection as peaks
+from ._lazy import lazy_module
+
+# scipy.integrate is imported the first time an impulse is computed
+integrate = lazy_module('scipy.integrate')
+
+# Foot strikes ----------------------------------------------------------
+
+
+# NOTE: at the tibia every resultant impact peak is a foot strike of that leg, so the minimum time between peaks is
+# about one stride (~0.5 secs, the same spacing the tibia notebook uses). Each stride starts 'pre_strike_secs' before
+# its impact peak so the loading phase (foot strike -> impact peak) is inside the stride.
+
+
+def detect_foot_strikes(signal, sample_freq, min_peak_height=None, max_peak_height=None, min_secs_between_peaks=0.5, pre_strike_secs=0.02):
+    """
+    Returns the row positions where each stride starts (one per detected impact peak, moved back 'pre_strike_secs')
+    and the row positions of the impact peaks.
+    """
+    impact_peaks = peaks.find_peak_indices(
+        signal, min_peak_height=min_peak_height, max_peak_height=max_peak_height,
+        min_secs_between_peaks=min_secs_between_peaks, sample_freq=sample_freq)
+    strikes = impact_peaks - int(round(pre_strike_secs * sample_freq))
+    keep = strikes >= 0
+    return strikes[keep], impact_peaks[keep]
+
+# Time-normalised strides ----------------------------------------------------------
+
+
+def normalise_strides(values, starts, ends, n_points=101):
+    """
+    Time-normalises every stride (samples starts[i] to ends[i], both included) of a (samples x columns) array to
+    'n_points' points with linear interpolation, all strides at once.
+
+    Returns a (strides x n_points x columns) array.
+    """
+    values = np.asarray(values)
+    if values.ndim == 1:
+        values = values[:, None]
+    starts = np.asarray(starts, dtype=np.float64)
+    ends = np.asarray(ends, dtype=np.float64)
+
+    # Fractional sample position of every normalised point of every stride (strides x n_points)
+    positions = starts[:, None] + (ends - starts)[:, None] * \
+        np.linspace(0, 1, n_points)[None, :]
+    lower = np.minimum(np.floor(positions).astype(np.intp),
+                       values.shape[0] - 2)
+    fraction = (positions - lower)[:, :, None]
+    return values[lower] * (1 - fraction) + values[lower + 1] * fraction
+
+# Per-stride features ----------------------------------------------------------
+
+
+# Steps (for every stride and column at once):
+# - stride_time: (end - start) / sample_freq
+# - peak: highest value in the stride, taken from the raw samples because a 101 point stride can step over a short
+#   impact peak
+# - impulse: area under the curve of the normalised stride (trapezoid rule, each point is 1% of the stride time)
+# - loading_rate: rise from the foot strike to the peak divided by the time it took (units per sec)
+
+
+def stride_features(values, starts, ends, normalised, sample_freq):
+    """
+    Per-stride features from the raw (samples x columns) array and its time-normalised strides.
+
+    Returns a dictionary of arrays: stride_time (strides), peak, impulse and loading_rate (strides x columns).
+    """
+    values = np.asarray(values)
+    if values.ndim == 1:
+        values = values[:, None]
+    stride_time = (ends - starts) / sample_freq
+
+    # Peak and where it is: the raw samples of every stride gathered end to end (about as many rows as the run, so a
+    # multi-second 'stride' from a missed foot strike doesn't blow up memory) and reduced per stride with reduceat
+    lengths = (ends - starts + 1).astype(np.intp)
+    offsets = np.concatenate([[0], np.cumsum(lengths)[:-1]])
+    stride_of_row = np.repeat(np.arange(len(starts)), lengths)
+    row_in_stride = np.arange(lengths.sum()) - offsets[stride_of_row]
+    gathered = values[np.minimum(starts[stride_of_row] + row_in_stride, values.shape[0] - 1)]
+    peak = np.maximum.reduceat(gathered, offsets, axis=0)
+    # First row of each stride at its peak
+    at_peak = gathered == peak[stride_of_row]
+    peak_offsets = np.minimum.reduceat(np.where(at_peak, row_in_stride[:, None], lengths.max()), offsets, axis=0)
+    peak_offsets[peak_offsets == lengths.max()] = 0
+
+    impulse = integrate.trapezoid(normalised, dx=1.0 / (normalised.shape[1] - 1), axis=1) * \
+        stride_time[:, None]
+    rise_time = peak_offsets / sample_freq
+    with np.errstate(divide='ignore', invalid='ignore'):
+        loading_rate = np.where(rise_time > 0,
+                                (peak - values[starts]) / rise_time, np.nan)
+
+    return {
+        'stride_time': stride_time,
+        'peak': peak,
+        'impulse': impulse,
+        'loading_rate': loading_rate,
+    }
+
+# Gait segmentation for each df in a dictionary ----------------------------------------------------------
+
+
+def apply_gait_segmentation_to_dfs(dfs, resultant_column, columns, sample_freq, time_column=None,
+                                   min_peak_height=None, max_peak_height=None, min_secs_between_peaks=0.5,
+                                   pre_strike_secs=0.02, min_stride_secs=None, max_stride_secs=None, n_points=101):
+    """
+    This function splits each run in the input dictionary into strides and calculates per-stride features.
+
+    Arguments:
+    - dfs: a dictionary of pandas dataframes. The keys are the names of the dataframes and the values are the dataframes themselves.
+    - resultant_column: column used to find the foot strikes (e.g. 'res_g' of a tibia IMU).
+    - columns: a list of column names to segment and calculate features for (e.g. ['res_g', 'ax_g']).
+    - sample_freq: sample rate (hz).
+    - time_column: optional time column used for the start time of each stride (otherwise start sample / sample_freq).
+    - min_peak_height, max_peak_height, min_secs_between_peaks: foot strike (impact peak) detection settings.
+    - pre_strike_secs: each stride starts this long before its impact peak, default is 0.02 secs.
+    - min_stride_secs, max_stride_secs: strides shorter / longer than these are left out (e.g. a missed foot strike).
+    - n_points: points of each time-normalised stride, default is 101 (0-100%).
+
+    If 'resultant_column' or a column in 'columns' does not exist in a dataframe, a warning message is issued and
+    the run (or column) is skipped.
+
+    The function returns:
+    - summary_df: mean of each per-stride feature per run in the long format (key, variable, value),
+      e.g. 'res_g_stride_peak_mean' and 'stride_time_mean'.
+    - stride_df: one row per stride (key, stride, start_s, stride_time and '{col}_peak', '{col}_impulse',
+      '{col}_loading_rate' columns).
+    - segments: a dictionary of {key: (strides x n_points x columns) array} of the time-normalised strides.
+    """
+    results = []
+    stride_tables = []
+    segments = {}
+
+    for key in dfs.keys():
+        df = dfs[key]
+
+        if resultant_column not in df.columns:
+            warnings.warn(
+                f"The column '{resultant_column}' does not exist in '{key}'")
+            continue
+        key_columns = []
+        for col in columns:
+            if col in df.columns:
+                key_columns.append(col)
+            else:
+                warnings.warn(f"The column '{col}' does not exist in '{key}'")
+        if not key_columns:
+            continue
+
+        strikes, _ = detect_foot_strikes(
+            df[resultant_column].to_numpy(), sample_freq, min_peak_height=min_peak_height, max_peak_height=max_peak_height,
+            min_secs_between_peaks=min_secs_between_peaks, pre_strike_secs=pre_strike_secs)
+        # A stride runs from one foot strike to the next
+        starts, ends = strikes[:-1], strikes[1:]
+        durations = (ends - starts) / sample_freq
+        keep = np.ones(len(starts), dtype=bool)
+        if min_stride_secs is not None:
+            keep &= durations >= min_stride_secs
+        if max_stride_secs is not None:
+            keep &= durations <= max_stride_secs
+        starts, ends = starts[keep], ends[keep]
+        if len(starts) == 0:
+            warnings.warn(f"No strides found in '{key}'")
+            continue
+
+        values = df[key_columns].to_numpy(dtype=np.float64)
+        normalised = normalise_strides(values, starts, ends, n_points=n_points)
+        features = stride_features(
+            values, starts, ends, normalised, sample_freq)
+        segments[key] = normalised
+
+        stride_table = {
+            'key': key,
+            'stride': np.arange(len(starts)),
+            'start_s': df[time_column].to_numpy(dtype=np.float64)[starts] if time_column in df.columns else starts / sample_freq,
+            'stride_time': features['stride_time'],
+        }
+        for i, col in enumerate(key_columns):
+            for feature in ('peak', 'impulse', 'loading_rate'):
+                stride_table[f'{col}_{feature}'] = features[feature][:, i]
+        stride_tables.append(pd.DataFrame(stride_table))
+
+        results.append({
+            'key': key,
+            'variable': 'stride_time_mean',
+            'value': np.mean(features['stride_time'])
+        })
+        for i, col in enumerate(key_columns):
+            for feature in ('peak', 'impulse', 'loading_rate'):
+                results.append({
+                    'key': key,
+                    'variable': f'{col}_stride_{feature}_mean',
+                    'value': np.nanmean(features[feature][:, i])
+                })
+
+    summary_df = pd.DataFrame(results)
+    stride_df = pd.concat(stride_tables, ignore_index=True) if stride_tables else pd.DataFrame()
+    return summary_df, stride_df, segments
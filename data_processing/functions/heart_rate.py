@@ -0,0 +1,243 @@
+"""
+Functions for the Polar heart rate (HR) data of chapter 4 and for joining it with the IMU runs
+ - prep_hr_data and calculate_eTRIMP (from the ch.4_heart_rate notebook)
+ - HR-IMU join: the IMU measures (RMS, number of impact peaks, mean peak acceleration) of every HR epoch
+   (one HR sample, e.g. 1 sec at 1 hz), giving one small per-epoch table per session
+
+How the join works (no merge_asof and no IMU table at HR resolution):
+ - The IMU row where each epoch starts is found with np.searchsorted on the IMU times (one call for all epochs)
+ - Sums of squares per epoch come from np.add.reduceat over those rows, a chunk of the IMU at a time, so the whole
+   34 min session never needs more than one chunk of extra memory
+ - Impact peaks are found once for the whole session and put into epochs with np.searchsorted + np.bincount
+
+Read only: the dfs passed in are not modified.
+"""
+# Packages
+import numpy as np
+import pandas as pd
+import warnings
+
+from . import peak_detection as peaks
+
+# HR data prep ----------------------------------------------------------
+
+
+def prep_hr_data(dfs, session_end='0:34:00'):
+    """
+    Cleans the Polar HR exports (same steps as the ch.4_heart_rate notebook).
+
+    Keeps the time and HR columns (renamed 'time' and 'hr_bpm'), removes everything after 'session_end'
+    (default 34 min) and the rows without a HR value. Returns a new dictionary.
+    """
+    updated_dfs = {}
+
+    for key, df in dfs.items():
+        # Keep only the 2nd and 3rd columns, the header is the 3rd row
+        df = df.iloc[2:, 1:3]
+        df.columns = df.iloc[0]
+        df = df.iloc[1:].reset_index(drop=True)
+        df.columns = ['time', 'hr_bpm']
+
+        # Remove all rows after the end of the session
+        if session_end in df['time'].values:
+            cutoff_index = df[df['time'] == session_end].index.max()
+            df = df.loc[:cutoff_index]
+
+        # Remove rows where 'hr_bpm' is not a number
+        initial_row_count = len(df)
+        df = df.assign(hr_bpm=pd.to_numeric(df['hr_bpm'], errors='coerce')).dropna(subset=['hr_bpm'])
+        rows_removed = initial_row_count - len(df)
+
+        updated_dfs[key] = df
+
+        if rows_removed > 0:
+            print(f"For '{key}', {rows_removed} rows were removed due to NaN in 'hr_bpm'.")
+
+    return updated_dfs
+
+
+def hr_time_to_secs(time):
+    """
+    Polar times ('h:mm:ss') as secs from the start of the recording.
+    """
+    return pd.to_timedelta(pd.Series(time).astype(str)).dt.total_seconds().to_numpy()
+
+# eTRIMP ----------------------------------------------------------
+
+
+# Edwards TRIMP: time (samples at 1 hz) in each HR zone x the zone number
+# NOTE: same zone limits as the notebook (% of HRmax): 50-59, 60-69, 70-79, 80-89, > 90
+def hr_zone_durations(per_max_hr):
+    per_max_hr = np.asarray(per_max_hr, dtype=np.float64)
+    return {
+        'zone1': int(((per_max_hr >= 50) & (per_max_hr <= 59)).sum()),
+        'zone2': int(((per_max_hr >= 60) & (per_max_hr <= 69)).sum()),
+        'zone3': int(((per_max_hr >= 70) & (per_max_hr <= 79)).sum()),
+        'zone4': int(((per_max_hr >= 80) & (per_max_hr <= 89)).sum()),
+        'zone5': int((per_max_hr > 90).sum()),
+    }
+
+
+def _max_hr(max_hrs_df, sub_id):
+    return pd.to_numeric(max_hrs_df.loc[max_hrs_df['sub_id'] == sub_id, 'max_hr']).iloc[0]
+
+
+def calculate_eTRIMP(dfs, max_hrs_df):
+    """
+    This function calculates Edwards TRIMP for each HR df (keys 'runXXX_...').
+
+    Arguments:
+    - dfs: a dictionary of prepped HR dfs (prep_hr_data).
+    - max_hrs_df: max HR of each subject (sub_id, max_hr), e.g. data/polar_hr/max_hr.csv.
+
+    The function returns a dataframe with key, max_hr, the secs in each zone and etrimp.
+    """
+    results = []
+    for key, df in dfs.items():
+        max_hr = _max_hr(max_hrs_df, key.split('_')[0])
+        zone_durations = hr_zone_durations(df['hr_bpm'] / max_hr * 100)
+        results.append({
+            'key': key,
+            'max_hr': max_hr,
+            **zone_durations,
+            'etrimp': sum(zone * zone_durations[f'zone{zone}'] for zone in range(1, 6))
+        })
+
+    results_df = pd.DataFrame(results)
+    return results_df
+
+# Epoch sums of the IMU ----------------------------------------------------------
+
+
+def epoch_edges(hr_secs):
+    """
+    Start of each HR epoch plus the end of the last one (each HR sample covers the time up to the next one,
+    the last one as long as the median gap).
+    """
+    hr_secs = np.asarray(hr_secs, dtype=np.float64)
+    last = np.median(np.diff(hr_secs)) if len(hr_secs) > 1 else 1.0
+    return np.append(hr_secs, hr_secs[-1] + last)
+
+
+def epoch_sums(values, edge_rows, chunk_samples=1_000_000):
+    """
+    Sum of the squares of every column in every epoch ((epochs x columns), float64) and samples per epoch.
+
+    edge_rows: IMU row where each epoch starts plus the row where the last one ends (np.searchsorted of the epoch
+    edges on the IMU times). Rows outside the epochs are never read.
+    """
+    values = np.asarray(values)
+    if values.ndim == 1:
+        values = values[:, None]
+    counts = np.diff(edge_rows)
+    sums = np.zeros((len(counts), values.shape[1]))
+
+    for start in range(int(edge_rows[0]), int(edge_rows[-1]), chunk_samples):
+        stop = min(start + chunk_samples, int(edge_rows[-1]))
+        chunk = np.square(values[start:stop], dtype=np.float64)
+        # Epoch starts inside this chunk; reduceat needs increasing starts so empty epochs are left out
+        starts = np.clip(edge_rows, start, stop) - start
+        filled = np.diff(starts) > 0
+        sums[filled] += np.add.reduceat(chunk, starts[:-1][filled], axis=0)
+
+    return sums, counts
+
+
+def epoch_peaks(peak_times, peak_values, edges):
+    """
+    Number of peaks and mean peak value in every epoch (NaN for epochs without a peak).
+    """
+    epoch = np.searchsorted(edges, peak_times, side='right') - 1
+    inside = (epoch >= 0) & (epoch < len(edges) - 1)
+    n_peaks = np.bincount(epoch[inside], minlength=len(edges) - 1)
+    total = np.bincount(epoch[inside], weights=peak_values[inside], minlength=len(edges) - 1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return n_peaks, total / n_peaks
+
+# HR-IMU join for each session ----------------------------------------------------------
+
+
+def session_id(key, hr=False):
+    """
+    (sub_id, run_type) of an IMU key (same rule as prep.export_tbl) or a HR key ('runXXX_{run_type}').
+    """
+    parts = key.split('_')
+    if hr:
+        return parts[0], '_'.join(parts[1:]).lower()
+    return parts[0], '_'.join(part for part in parts[1:-2] if not part.isdigit()).lower()
+
+
+def join_hr_imu(hr_dfs, imu_dfs, columns, peak_column, sample_freq, time_column='time_s', max_hrs_df=None,
+                imu_offset_s=0.0, min_peak_height=None, max_peak_height=None, min_secs_between_peaks=0.25,
+                pairs=None, chunk_samples=1_000_000):
+    """
+    This function joins each HR session with its IMU run, one row per HR epoch.
+
+    Arguments:
+    - hr_dfs: a dictionary of prepped HR dfs (prep_hr_data), keys 'runXXX_{run_type}'.
+    - imu_dfs: a dictionary of IMU dfs (e.g. the low back at 1125 hz).
+    - columns: IMU columns for the per-epoch RMS (e.g. ['res_m/s/s']).
+    - peak_column: IMU column the impact peaks are found in (e.g. 'res_g').
+    - sample_freq: IMU sample rate (hz).
+    - time_column: IMU time column (secs), default is 'time_s'.
+    - max_hrs_df: optional max HR of each subject (sub_id, max_hr) for the % of HRmax column.
+    - imu_offset_s: HR time of the first IMU sample (IMU time + imu_offset_s = HR time), default is 0.
+    - min_peak_height, max_peak_height, min_secs_between_peaks: impact peak settings (0.25 secs is the low back spacing).
+    - pairs: optional list of (hr_key, imu_key). Default pairs the keys with the same sub_id and run type.
+    - chunk_samples: IMU rows squared at a time.
+
+    If a column does not exist in a dataframe or a session has no IMU run, a warning message is issued and it is skipped.
+
+    The function returns a dictionary of {hr_key: per-epoch table} with the columns epoch, time_s (HR time),
+    hr_bpm, (pct_max_hr), imu_samples, '{col}_rms', n_peaks and '{peak_column}_mean_peak'.
+    """
+    if pairs is None:
+        imu_sessions = {session_id(key): key for key in imu_dfs.keys()}
+        pairs = []
+        for hr_key in hr_dfs.keys():
+            if session_id(hr_key, hr=True) in imu_sessions:
+                pairs.append((hr_key, imu_sessions[session_id(hr_key, hr=True)]))
+            else:
+                warnings.warn(f"No IMU run found for '{hr_key}'")
+
+    tables = {}
+    for hr_key, imu_key in pairs:
+        hr_df = hr_dfs[hr_key]
+        imu_df = imu_dfs[imu_key]
+        missing = [col for col in list(columns) + [peak_column, time_column] if col not in imu_df.columns]
+        for col in missing:
+            warnings.warn(f"The column '{col}' does not exist in '{imu_key}'")
+        if missing:
+            continue
+
+        hr_secs = hr_time_to_secs(hr_df['time'])
+        edges = epoch_edges(hr_secs)
+        # IMU times on the HR clock (a view unless there is an offset)
+        imu_secs = imu_df[time_column].to_numpy(dtype=np.float64)
+        if imu_offset_s:
+            imu_secs = imu_secs + imu_offset_s
+        edge_rows = np.searchsorted(imu_secs, edges, side='left')
+
+        sums, counts = epoch_sums(imu_df[list(columns)].to_numpy(), edge_rows, chunk_samples=chunk_samples)
+        peak_signal = imu_df[peak_column].to_numpy()
+        peak_rows = peaks.find_peak_indices(peak_signal, min_peak_height=min_peak_height,
+                                            max_peak_height=max_peak_height,
+                                            min_secs_between_peaks=min_secs_between_peaks, sample_freq=sample_freq)
+        n_peaks, mean_peak = epoch_peaks(imu_secs[peak_rows], peak_signal[peak_rows].astype(np.float64), edges)
+
+        table = {
+            'epoch': np.arange(len(hr_secs)),
+            'time_s': hr_secs,
+            'hr_bpm': hr_df['hr_bpm'].to_numpy(dtype=np.float64),
+        }
+        if max_hrs_df is not None:
+            table['pct_max_hr'] = table['hr_bpm'] / _max_hr(max_hrs_df, session_id(hr_key, hr=True)[0]) * 100
+        table['imu_samples'] = counts
+        with np.errstate(divide='ignore', invalid='ignore'):
+            for i, col in enumerate(columns):
+                table[f'{col}_rms'] = np.sqrt(sums[:, i] / counts)
+        table['n_peaks'] = n_peaks
+        table[f'{peak_column}_mean_peak'] = mean_peak
+        tables[hr_key] = pd.DataFrame(table)
+
+    return tables
@@ -0,0 +1,446 @@
+"""
+Compact archive format (.imuz) for the raw IMU captures
+
+The Blue Trident CSVs store every sample as text (e.g. '-9.806650,0.123456,...' at 1125-1600hz), which is 5-10x
+bigger than the numbers need. An archive stores the same table as:
+ - float channels quantized to int16 or int32 with a per-channel scale and offset. By default the scale is the last
+   decimal place written in the CSV, so the values read back are the same numbers as in the CSV (lossless).
+   max_error gives a coarser scale (lossy) if that is good enough
+ - the time column as integer ticks, delta-encoded within each chunk (almost every delta is the same, so it
+   compresses to almost nothing)
+ - chunks of 'chunk_rows' rows, each channel compressed with zlib on its own after a byte shuffle (all the first
+   bytes of the values, then all the second bytes, ...), which zlib compresses 10-25% better
+ - an index in the footer (rows, first/last time and byte ranges of every chunk), so a time range (a trial) or a row
+   range (the 5 min crop) only reads and decompresses the chunks it needs
+
+File layout: 'IMUZ' + version | chunk data ... | footer (JSON index) | footer length (uint64) + 'IMUZ'
+
+Example:
+    imu_archive.csv_to_archive('run014_easy_prs_pre_00917_lowg.csv')      # writes run014_..._lowg.imuz
+    df = imu_archive.read_archive('run014_easy_prs_pre_00917_lowg.imuz', rows=slice(-337500, None))  # 5 min crop
+    # or convert a folder from the command line (from the data_processing folder)
+    python -m functions.imu_archive data/five_min_runs/run014 --check
+
+file_import_gui.read_csv_files / read_csv_files_from_dir read .imuz files the same way as CSVs.
+"""
+# Packages
+import argparse
+import json
+import os
+import struct
+import warnings
+import zlib
+import numpy as np
+import pandas as pd
+
+from . import precision
+
+MAGIC = b'IMUZ'
+VERSION = 1
+ARCHIVE_EXTENSION = '.imuz'
+# Columns delta-encoded as time when time_column='auto'
+TIME_COLUMNS = ('time_s', 'timestamp')
+# Most decimals looked for when working out the scale of a channel
+MAX_DECIMALS = 9
+# Lowest value of each integer type marks a NaN
+QUANTIZED_DTYPES = ('<i2', '<i4')
+
+# Quantization ----------------------------------------------------------
+
+
+def channel_decimals(values, max_decimals=MAX_DECIMALS):
+    """
+    Fewest decimal places that hold every (finite) value exactly, i.e. what the CSV was written with.
+    Returns None if more than max_decimals are needed.
+    """
+    finite = values[np.isfinite(values)]
+    for decimals in range(max_decimals + 1):
+        scaled = finite * 10.0**decimals
+        if np.all(np.abs(scaled - np.round(scaled)) <= 1e-6 + 1e-12 * np.abs(scaled)):
+            return decimals
+    return None
+
+
+def quantize_channel(values, max_error=None):
+    """
+    Quantizes a float channel to the smallest integer type that holds it.
+
+    The value of each sample is (q + offset_steps) / 10**decimals (lossless, decimals from channel_decimals)
+    or (q + offset_steps) * scale with scale = 2 * max_error.
+    Returns (q, column info), or (values as float64, column info) if the channel doesn't fit in an int32.
+    """
+    values = np.asarray(values, dtype=np.float64)
+    finite = np.isfinite(values)
+    info = {'kind': 'float', 'decimals': None, 'scale': None, 'offset_steps': 0}
+
+    if max_error is None:
+        info['decimals'] = channel_decimals(values)
+        if info['decimals'] is None:
+            return values, {**info, 'kind': 'raw', 'dtype': '<f8'}
+        steps = values * 10.0**info['decimals']
+    else:
+        info['scale'] = 2 * max_error
+        steps = values / info['scale']
+
+    if finite.any():
+        # The offset is a whole number of steps, so q + offset_steps is exact
+        info['offset_steps'] = int(np.round((steps[finite].min() + steps[finite].max()) / 2))
+    q = np.round(steps - info['offset_steps'])
+    span = np.abs(q[finite]).max() if finite.any() else 0
+
+    for dtype in QUANTIZED_DTYPES:
+        limits = np.iinfo(np.dtype(dtype))
+        if span < limits.max:
+            q[~finite] = limits.min
+            return q.astype(dtype), {**info, 'dtype': dtype}
+    return values, {**info, 'kind': 'raw', 'dtype': '<f8'}
+
+
+def dequantize_channel(q, info):
+    """
+    Float64 values of a quantized channel (NaN where the integer type's lowest value is).
+    """
+    steps = q.astype(np.int64) + info['offset_steps']
+    if info['decimals'] is not None:
+        # Dividing the whole number of steps by 10**decimals gives the nearest float to the decimal, like parsing the CSV
+        values = steps / 10.0**info['decimals']
+    else:
+        values = steps * info['scale']
+    values[q == np.iinfo(q.dtype).min] = np.nan
+    return values
+
+# Column encoding ----------------------------------------------------------
+
+
+def _column_info(df, column, time_column, max_error):
+    # How a column is stored (without the data)
+    series = df[column]
+    if column == time_column:
+        return {'kind': 'time'}
+    if pd.api.types.is_bool_dtype(series):
+        return {'kind': 'bool', 'dtype': '|u1'}
+    if pd.api.types.is_integer_dtype(series):
+        return {'kind': 'int', 'dtype': '<i8'}
+    if pd.api.types.is_float_dtype(series):
+        return {'kind': 'float', 'max_error': max_error}
+    return {'kind': 'text'}
+
+
+def _shuffle(values):
+    # Bytes of a numeric array grouped by byte position
+    values = np.ascontiguousarray(values)
+    return values.view(np.uint8).reshape(-1, values.dtype.itemsize).T.tobytes()
+
+
+def _unshuffle(data, dtype):
+    dtype = np.dtype(dtype)
+    return np.frombuffer(data, dtype=np.uint8).reshape(dtype.itemsize, -1).T.copy().view(dtype).ravel()
+
+
+def _encode(values, info):
+    # Bytes of one column of one chunk
+    if info['kind'] == 'text':
+        return '\x1f'.join(values.astype(str)).encode('utf-8')
+    return _shuffle(np.asarray(values, dtype=info['dtype']))
+
+
+def _decode(data, info, n_rows):
+    if info['kind'] == 'text':
+        return np.array(data.decode('utf-8').split('\x1f') if n_rows else [], dtype=object)
+    return _unshuffle(data, info['dtype'])
+
+# Writer ----------------------------------------------------------
+
+
+def write_archive(df, file_path, time_column='auto', chunk_rows=65536, max_error=None, level=6):
+    """
+    This function writes a dataframe to an archive file (.imuz).
+
+    Arguments:
+    - df: a dataframe of one IMU capture.
+    - file_path: archive file to write.
+    - time_column: time column (secs) that is delta-encoded and used for reading by time. 'auto' uses the first of
+      TIME_COLUMNS in the df, None stores no time index.
+    - chunk_rows: rows per chunk, the smallest piece that is read back. Default is 65536 (about 1 min at 1125hz).
+    - max_error: None stores the float channels to the decimals they have (lossless for data read from a CSV).
+      A value (e.g. 1e-4) quantizes every float channel to steps of 2 x max_error instead.
+    - level: zlib compression level (1-9).
+
+    The function returns a dictionary with the number of rows, chunks and the size of the file (bytes).
+    """
+    if time_column == 'auto':
+        time_column = next((col for col in TIME_COLUMNS if col in df.columns), None)
+    columns = [{'name': str(col), 'source_dtype': str(df[col].dtype),
+                **_column_info(df, col, time_column, max_error)} for col in df.columns]
+
+    # Time as integer ticks (same decimals as written). If it has NaNs or more than MAX_DECIMALS it is stored like
+    # any other float channel instead (the chunk index still has its first/last time)
+    ticks = None
+    if time_column is not None:
+        time = df[time_column].to_numpy(dtype=np.float64)
+        time_info = columns[list(df.columns).index(time_column)]
+        decimals = channel_decimals(time) if np.isfinite(time).all() else None
+        if decimals is not None:
+            ticks = np.round(time * 10.0**decimals).astype(np.int64)
+            time_info.update({'decimals': decimals})
+        else:
+            time_info.update({'kind': 'float', 'max_error': max_error})
+
+    # Quantize the float channels once for the whole capture so every chunk uses the same scale
+    encoded = {}
+    for info, col in zip(columns, df.columns):
+        if info['kind'] == 'float':
+            encoded[col], quantized_info = quantize_channel(df[col].to_numpy(), info.pop('max_error'))
+            info.update(quantized_info)
+        elif info['kind'] in ('bool', 'int', 'text'):
+            encoded[col] = df[col].to_numpy()
+
+    n_rows = len(df)
+    chunks = []
+    with open(file_path, 'wb') as f:
+        f.write(MAGIC + struct.pack('<B3x', VERSION))
+        for start in range(0, n_rows, chunk_rows):
+            stop = min(start + chunk_rows, n_rows)
+            chunk = {'start_row': start, 'n_rows': stop - start, 'channels': []}
+
+            if time_column is not None:
+                chunk_time = time[start:stop]
+                chunk['t_start'] = float(np.nanmin(chunk_time)) if np.isfinite(chunk_time).any() else None
+                chunk['t_end'] = float(np.nanmax(chunk_time)) if np.isfinite(chunk_time).any() else None
+            if ticks is not None:
+                chunk_ticks = ticks[start:stop]
+                chunk['first_tick'] = int(chunk_ticks[0])
+                # First delta is 0, the time of the first row is first_tick
+                deltas = np.diff(chunk_ticks, prepend=chunk['first_tick'])
+                chunk['delta_dtype'] = '<i4' if np.abs(deltas).max() < 2**31 else '<i8'
+
+            for info, col in zip(columns, df.columns):
+                if info['kind'] == 'time':
+                    data = _shuffle(deltas.astype(chunk['delta_dtype']))
+                else:
+                    data = _encode(encoded[col][start:stop], info)
+                compressed = zlib.compress(data, level)
+                chunk['channels'].append([f.tell(), len(compressed)])
+                f.write(compressed)
+            chunks.append(chunk)
+
+        footer = json.dumps({'version': VERSION, 'n_rows': n_rows, 'chunk_rows': chunk_rows,
+                             'time_column': time_column, 'columns': columns, 'chunks': chunks}).encode('utf-8')
+        f.write(footer)
+        f.write(struct.pack('<Q', len(footer)) + MAGIC)
+        file_size = f.tell()
+
+    return {'rows': n_rows, 'chunks': len(chunks), 'bytes': file_size}
+
+# Reader ----------------------------------------------------------
+
+
+def archive_info(file_path):
+    """
+    The footer index of an archive: n_rows, chunk_rows, time_column, columns (how each is stored) and chunks.
+    """
+    with open(file_path, 'rb') as f:
+        return _read_footer(f, file_path)
+
+
+def _read_footer(f, file_path):
+    if f.read(len(MAGIC)) != MAGIC:
+        raise ValueError(f"'{file_path}' is not an IMU archive")
+    f.seek(-(8 + len(MAGIC)), os.SEEK_END)
+    footer_length, magic = struct.unpack('<Q4s', f.read(8 + len(MAGIC)))
+    if magic != MAGIC:
+        raise ValueError(f"'{file_path}' is not a complete IMU archive (no footer)")
+    f.seek(-(8 + len(MAGIC) + footer_length), os.SEEK_END)
+    info = json.loads(f.read(footer_length).decode('utf-8'))
+    if info['version'] > VERSION:
+        raise ValueError(f"'{file_path}' was written by a newer version (format {info['version']})")
+    return info
+
+
+def _output_dtype(info):
+    # Float columns come back in their original dtype, float64 ones in the selected precision (time stays float64)
+    source_dtype = np.dtype(info['source_dtype'])
+    if info['kind'] in ('float', 'raw') and source_dtype == np.float64 and not precision.is_time_column(info['name']):
+        return precision.get_float_dtype()
+    return source_dtype
+
+
+def select_rows(df, time_column=None, start_s=None, end_s=None, rows=None):
+    """
+    Rows of a df picked the same way as read_archive: first by position ('rows', a slice, e.g.
+    slice(-337500, None) for the last 5 mins at 1125hz like crop_df_five_mins), then start_s <= time < end_s.
+    """
+    if rows is not None:
+        df = df.iloc[rows]
+    if start_s is not None or end_s is not None:
+        time = df[time_column].to_numpy(dtype=np.float64)
+        keep = np.ones(len(df), dtype=bool)
+        if start_s is not None:
+            keep &= time >= start_s
+        if end_s is not None:
+            keep &= time < end_s
+        df = df[keep]
+    return df.reset_index(drop=True)
+
+
+def read_archive(file_path, columns=None, start_s=None, end_s=None, rows=None):
+    """
+    This function reads an archive file (.imuz) into a dataframe.
+
+    Arguments:
+    - file_path: archive file.
+    - columns: optional list of columns to read (default: all). Only these are decompressed.
+    - start_s, end_s: optional time range (secs, start_s <= time < end_s), e.g. one trial.
+    - rows: optional slice of row positions (step 1), e.g. slice(-337500, None) for the 5 min crop at 1125hz.
+      Applied before the time range.
+
+    Only the chunks that overlap the rows/time range are read and decompressed.
+    The function returns a dataframe (index from 0, like pd.read_csv).
+    """
+    with open(file_path, 'rb') as f:
+        info = _read_footer(f, file_path)
+        time_column = info['time_column']
+        if (start_s is not None or end_s is not None) and time_column is None:
+            raise ValueError(f"'{file_path}' has no time column, it can only be read by rows")
+
+        names = [col['name'] for col in info['columns']]
+        wanted = names if columns is None else [name for name in names if name in columns]
+        missing = [] if columns is None else [col for col in columns if col not in names]
+        if missing:
+            raise KeyError(f"Columns {missing} are not in '{file_path}'")
+        # The time column is needed to pick the time range even if it isn't asked for
+        to_read = wanted + ([time_column] if (start_s is not None or end_s is not None)
+                            and time_column not in wanted else [])
+
+        if rows is not None and rows.step not in (None, 1):
+            raise ValueError(f"rows must be a slice with a step of 1, got {rows}")
+        first_row, last_row, _ = (rows if rows is not None else slice(None)).indices(info['n_rows'])
+        chunks = [chunk for chunk in info['chunks']
+                  if chunk['start_row'] < last_row and chunk['start_row'] + chunk['n_rows'] > first_row
+                  and (start_s is None or chunk['t_end'] is None or chunk['t_end'] >= start_s)
+                  and (end_s is None or chunk['t_start'] is None or chunk['t_start'] < end_s)]
+
+        parts = {name: [] for name in to_read}
+        for chunk in chunks:
+            for col_info, (offset, length) in zip(info['columns'], chunk['channels']):
+                if col_info['name'] not in parts:
+                    continue
+                f.seek(offset)
+                data = zlib.decompress(f.read(length))
+                if col_info['kind'] == 'time':
+                    ticks = chunk['first_tick'] + np.cumsum(_unshuffle(data, chunk['delta_dtype']), dtype=np.int64)
+                    values = ticks / 10.0**col_info['decimals']
+                elif col_info['kind'] == 'float':
+                    values = dequantize_channel(_unshuffle(data, col_info['dtype']), col_info)
+                else:
+                    values = _decode(data, col_info, chunk['n_rows'])
+                parts[col_info['name']].append(values)
+
+    col_infos = {col['name']: col for col in info['columns']}
+    df = pd.DataFrame({
+        name: (np.concatenate(parts[name]) if parts[name] else np.empty(0)).astype(
+            _output_dtype(col_infos[name]), copy=False)
+        for name in to_read})
+
+    # Rows and time range inside the chunks that were read
+    chunk_start = chunks[0]['start_row'] if chunks else 0
+    # (chunks before the time range may have been skipped, so the rows can start before the first chunk read)
+    df = select_rows(df, time_column, start_s, end_s,
+                     slice(max(first_row - chunk_start, 0), max(last_row - chunk_start, 0)))
+    return df[wanted]
+
+
+def check_ranged_reads(archive_path):
+    """
+    Reads a few row and time ranges (across chunk boundaries) from an archive and compares them with the same rows
+    picked (select_rows) from the whole archive read at once.
+    Returns a list of the ranges that didn't match (empty if all did).
+    """
+    df = read_archive(archive_path)
+    time_column = archive_info(archive_path)['time_column']
+    n_rows = len(df)
+    ranges = [{'rows': slice(n_rows // 4, n_rows // 4 * 3)}, {'rows': slice(-(n_rows // 3), None)}]
+    if time_column is not None and n_rows:
+        times = df[time_column].to_numpy(dtype=np.float64)
+        t_first, t_last = np.nanmin(times), np.nanmax(times)
+        for start, end in [(0.15, 0.6), (0.25, None), (None, 0.4), (0.5, 0.9)]:
+            ranges.append({'start_s': None if start is None else t_first + start * (t_last - t_first),
+                           'end_s': None if end is None else t_first + end * (t_last - t_first)})
+        ranges.append({'rows': slice(n_rows // 10, None), 'start_s': t_first + 0.3 * (t_last - t_first)})
+
+    return [read_range for read_range in ranges
+            if not read_archive(archive_path, **read_range).equals(select_rows(df, time_column, **read_range))]
+
+# Converting CSV files ----------------------------------------------------------
+
+
+def archive_path_for(csv_path, output_dir=None):
+    """
+    Archive file for a CSV file: same name with .imuz, next to it or in 'output_dir'.
+    """
+    name = os.path.splitext(os.path.basename(csv_path))[0] + ARCHIVE_EXTENSION
+    return os.path.join(output_dir or os.path.dirname(csv_path), name)
+
+
+def csv_to_archive(csv_path, archive_path=None, check=False, **kwargs):
+    """
+    Converts a CSV file to an archive (keyword arguments go to write_archive).
+    With check=True the archive is read back and compared with the CSV (largest difference of any float channel)
+    and a few row/time ranges are read and compared with the whole archive (check_ranged_reads).
+
+    Returns a dictionary: csv, archive, csv_mb, archive_mb, ratio (and max_error with check=True).
+    """
+    archive_path = archive_path or archive_path_for(csv_path)
+    # Parse as float64 so the decimals are found on the values as written
+    df = pd.read_csv(csv_path)
+    write_archive(df, archive_path, **kwargs)
+
+    result = {
+        'csv': csv_path,
+        'archive': archive_path,
+        'csv_mb': os.path.getsize(csv_path) / 1024**2,
+        'archive_mb': os.path.getsize(archive_path) / 1024**2,
+    }
+    result['ratio'] = result['csv_mb'] / result['archive_mb']
+    if check:
+        df_back = read_archive(archive_path)
+        float_columns = [col for col in df.columns if pd.api.types.is_float_dtype(df[col])]
+        differences = np.abs(df_back[float_columns].to_numpy(dtype=np.float64) - df[float_columns].to_numpy())
+        result['max_error'] = float(np.nanmax(differences)) if differences.size else 0.0
+        failed = check_ranged_reads(archive_path)
+        if failed:
+            warnings.warn(f"Ranged reads of '{archive_path}' don't match the CSV: {failed}")
+        result['ranged_reads_ok'] = not failed
+    return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Convert IMU CSV files to .imuz archives.')
+    parser.add_argument('paths', nargs='+', help='CSV files or folders (searched recursively)')
+    parser.add_argument('--output-dir', default=None, help='folder for the archives (default: next to each CSV)')
+    parser.add_argument('--max-error', type=float, default=None,
+                        help='quantize float channels to this error (default: lossless to the CSV decimals)')
+    parser.add_argument('--chunk-rows', type=int, default=65536, help='rows per chunk')
+    parser.add_argument('--check', action='store_true', help='read each archive back and compare with the CSV')
+    args = parser.parse_args(argv)
+
+    csv_paths = []
+    for path in args.paths:
+        if os.path.isdir(path):
+            for directory, _, filenames in os.walk(path):
+                csv_paths.extend(os.path.join(directory, filename) for filename in sorted(filenames)
+                                 if filename.lower().endswith('.csv'))
+        else:
+            csv_paths.append(path)
+
+    results = []
+    for csv_path in csv_paths:
+        results.append(csv_to_archive(csv_path, archive_path_for(csv_path, args.output_dir), check=args.check,
+                                      max_error=args.max_error, chunk_rows=args.chunk_rows))
+        print(f"{csv_path}: {results[-1]['csv_mb']:.1f} MB -> {results[-1]['archive_mb']:.1f} MB")
+    if results:
+        print(pd.DataFrame(results).round(4).to_string(index=False))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,323 @@
+"""
+Opt-in profiling for the functions package
+
+Wraps every public function in data_prep, peak_detection, low_back_measures, stride_variables and stats and records:
+ - wall time and CPU time
+ - samples processed (total rows of the dictionary of dfs, or the length of the series/array passed in)
+ - peak memory allocated during the call (tracemalloc, optional)
+ - a per-key breakdown (optional, runs dict-of-dfs functions one key at a time, see PER_KEY_FUNCTIONS)
+
+When it is not enabled nothing is wrapped, so there is no overhead at all.
+
+Example:
+    import functions.instrumentation as instr
+    instr.enable(memory=True)
+    ... run the notebook cells ...
+    instr.disable()
+    timing_df = instr.records_df()
+    instr.write_chrome_trace('profile.json')  # open in chrome://tracing or https://ui.perfetto.dev
+"""
+# Packages
+import functools
+import importlib
+import inspect
+import json
+import os
+import threading
+import time
+import tracemalloc
+import numpy as np
+import pandas as pd
+
+# Modules wrapped by default
+DEFAULT_MODULES = [
+    'data_prep',
+    'peak_detection',
+    'low_back_measures',
+    'stride_variables',
+    'stats',
+]
+
+# Dict-of-dfs functions that treat each key on its own, so running them one key at a time (per_key=True) gives the
+# same results. Others look across keys (e.g. peak_and_window_data windows left_tibia on the right_tibia peak) and
+# are always timed as one call.
+PER_KEY_FUNCTIONS = {
+    'data_prep.crop_df_five_mins',
+    'data_prep.resample_dfs',
+    'data_prep.rebuild_time_base',
+    'data_prep.add_resultant_column',
+    'data_prep.accel_to_gs_columns',
+    'data_prep.shift_time_s_to_zero',
+    'data_prep.apply_butter_lowpass_filter_to_dfs',
+    'data_prep.calc_mean_shift',
+    'data_prep.reorient_to_body_axes',
+    'data_prep.remove_trials_from_dfs',
+    'peak_detection.calc_avg_positive_peaks',
+    'peak_detection.calc_avg_positive_peaks_from_tbl',
+    'peak_detection.calc_avg_neg_peaks',
+    'peak_detection.calc_avg_abs_peaks',
+    'peak_detection.calc_avg_windowed_abs_peaks',
+    'peak_detection.calc_avg_windowed_neg_peaks',
+    'low_back_measures.apply_rms_to_dfs',
+    'low_back_measures.apply_windowed_rms_to_dfs',
+    'low_back_measures.apply_sampen_to_dfs',
+    'low_back_measures.apply_control_entropy_to_dfs',
+    'stride_variables.calc_stride_times',
+    'stride_variables.calc_stride_times_vars',
+    'stats.create_summary_tbl',
+    'stats.remove_outliers',
+}
+
+# State ----------------------------------------------------------
+
+
+# module name -> (module, {function name: original function})
+_originals = {}
+_records = []
+_settings = {'memory': False, 'per_key': False, 'started_tracemalloc': False}
+_local = threading.local()
+_t0 = time.perf_counter()
+
+# Helpers ----------------------------------------------------------
+
+
+def _is_dict_of_dfs(obj):
+    return isinstance(obj, dict) and len(obj) > 0 and all(isinstance(df, pd.DataFrame) for df in obj.values())
+
+
+def _count_samples(args, kwargs):
+    """
+    Number of samples handed to a function: total rows over a dictionary of dfs, or the length of a DataFrame/Series/array.
+    """
+    data = args[0] if args else kwargs.get('dfs', kwargs.get('data'))
+    if _is_dict_of_dfs(data):
+        return int(sum(len(df) for df in data.values()))
+    if isinstance(data, (pd.DataFrame, pd.Series, np.ndarray, list)):
+        return int(len(data))
+    return None
+
+
+def _merge_outputs(outputs):
+    """
+    Combines the outputs of running a function one key at a time back into what one call would have returned.
+    """
+    first = outputs[0]
+    if first is None:
+        return None
+    if isinstance(first, pd.DataFrame):
+        return pd.concat(outputs, ignore_index=True)
+    if isinstance(first, dict):
+        merged = {}
+        for output in outputs:
+            merged.update(output)
+        return merged
+    if isinstance(first, tuple):
+        return tuple(_merge_outputs([output[i] for output in outputs]) for i in range(len(first)))
+    return outputs
+
+
+def _call_per_key(func, name, args, kwargs):
+    """
+    Runs a dict-of-dfs function once per key so each key gets its own record.
+    Changes made to the single-key dictionary (replaced or removed dfs) are copied back to the original dictionary.
+    """
+    dfs = args[0]
+    outputs = []
+    for key in list(dfs.keys()):
+        sub_dfs = {key: dfs[key]}
+        outputs.append(_timed_call(func, name, (sub_dfs,) + args[1:], kwargs, key=key))
+        if key in sub_dfs:
+            dfs[key] = sub_dfs[key]
+        else:
+            del dfs[key]
+    return _merge_outputs(outputs)
+
+
+def _timed_call(func, name, args, kwargs, key=None):
+    depth = getattr(_local, 'depth', 0)
+    # Nested calls (e.g. butter_lowpass_filter inside apply_butter_lowpass_filter_to_dfs) inherit the key of their caller
+    parent_key = getattr(_local, 'key', None)
+    if key is None:
+        key = parent_key
+    # Only the outermost call measures memory, otherwise the inner call would reset the outer call's peak
+    measure_memory = _settings['memory'] and depth == 0 and tracemalloc.is_tracing()
+    if measure_memory:
+        tracemalloc.reset_peak()
+        memory_start = tracemalloc.get_traced_memory()[0]
+
+    _local.depth = depth + 1
+    _local.key = key
+    start_wall = time.perf_counter()
+    start_cpu = time.process_time()
+    try:
+        return func(*args, **kwargs)
+    finally:
+        wall_time = time.perf_counter() - start_wall
+        cpu_time = time.process_time() - start_cpu
+        _local.depth = depth
+        _local.key = parent_key
+
+        _records.append({
+            'function': name,
+            'key': key,
+            'depth': depth,
+            'start_s': start_wall - _t0,
+            'wall_time_s': wall_time,
+            'cpu_time_s': cpu_time,
+            'samples': _count_samples(args, kwargs),
+            'peak_memory_bytes': tracemalloc.get_traced_memory()[1] - memory_start if measure_memory else None,
+            'thread_id': threading.get_ident(),
+        })
+
+
+def _wrap(func, name):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if (_settings['per_key'] and name in PER_KEY_FUNCTIONS and getattr(_local, 'depth', 0) == 0
+                and args and _is_dict_of_dfs(args[0]) and len(args[0]) > 1):
+            return _call_per_key(func, name, args, kwargs)
+        return _timed_call(func, name, args, kwargs)
+    wrapper.__instrumented__ = True
+    return wrapper
+
+# Turning it on and off ----------------------------------------------------------
+
+
+def enable(modules=None, memory=False, per_key=False):
+    """
+    Wraps the public functions of the given modules (default: DEFAULT_MODULES).
+
+    Arguments:
+    - modules: list of module names in the functions package (or module objects).
+    - memory: record peak allocated memory with tracemalloc. NOTE: tracemalloc slows Python allocations down,
+      so leave this off when you only need timings.
+    - per_key: run dict-of-dfs functions one key at a time so the records break down by run.
+      Only the functions in PER_KEY_FUNCTIONS are split up, the rest are timed as one call (key is None).
+    """
+    _settings['memory'] = memory
+    _settings['per_key'] = per_key
+    if memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+        _settings['started_tracemalloc'] = True
+
+    for module in modules or DEFAULT_MODULES:
+        if isinstance(module, str):
+            module = importlib.import_module(f'{__package__}.{module}')
+        if module.__name__ in _originals:
+            continue
+
+        originals = {}
+        for name, func in inspect.getmembers(module, inspect.isfunction):
+            # Only public functions defined in the module itself (not imported ones like find_peaks)
+            if name.startswith('_') or func.__module__ != module.__name__:
+                continue
+            originals[name] = func
+            setattr(module, name, _wrap(
+                func, f"{module.__name__.split('.')[-1]}.{name}"))
+        _originals[module.__name__] = (module, originals)
+
+
+def disable():
+    """
+    Puts the original functions back. Records are kept until reset() is called.
+    """
+    for module, originals in _originals.values():
+        for name, func in originals.items():
+            setattr(module, name, func)
+    _originals.clear()
+
+    if _settings['started_tracemalloc']:
+        tracemalloc.stop()
+        _settings['started_tracemalloc'] = False
+
+
+def reset():
+    _records.clear()
+
+
+class profile:
+    """
+    Context manager version of enable()/disable().
+
+    with instr.profile(memory=True):
+        back.apply_sampen_to_dfs(dfs, ['res_g'])
+    """
+
+    def __init__(self, modules=None, memory=False, per_key=False):
+        self.kwargs = {'modules': modules,
+                       'memory': memory, 'per_key': per_key}
+
+    def __enter__(self):
+        enable(**self.kwargs)
+        return self
+
+    def __exit__(self, *exc_info):
+        disable()
+        return False
+
+# Results ----------------------------------------------------------
+
+
+def records_df():
+    """
+    Returns one row per function call (function, key, depth, start_s, wall_time_s, cpu_time_s, samples, peak_memory_bytes, thread_id).
+    """
+    columns = ['function', 'key', 'depth', 'start_s', 'wall_time_s',
+               'cpu_time_s', 'samples', 'peak_memory_bytes', 'thread_id']
+    return pd.DataFrame(_records, columns=columns)
+
+
+def summary_df(by=('function',)):
+    """
+    Totals per function (or per function and key with by=('function', 'key')), slowest first.
+    """
+    df = records_df()
+    summary = df.groupby(list(by), dropna=False).agg(
+        calls=('wall_time_s', 'size'),
+        wall_time_s=('wall_time_s', 'sum'),
+        cpu_time_s=('cpu_time_s', 'sum'),
+        samples=('samples', 'sum'),
+        peak_memory_bytes=('peak_memory_bytes', 'max'),
+    ).reset_index()
+    summary['samples_per_s'] = summary['samples'] / summary['wall_time_s']
+    return summary.sort_values('wall_time_s', ascending=False, ignore_index=True)
+
+
+def _json_value(value):
+    if value is None or (isinstance(value, float) and np.isnan(value)):
+        return None
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
+def write_json(file_path):
+    with open(file_path, 'w') as f:
+        json.dump([{name: _json_value(value) for name, value in record.items()}
+                  for record in _records], f, indent=2)
+
+
+def write_chrome_trace(file_path):
+    """
+    Writes the records in the Chrome trace event format (complete 'X' events, times in microseconds).
+    """
+    pid = os.getpid()
+    events = []
+    for record in _records:
+        events.append({
+            'name': record['function'] if record['key'] is None else f"{record['function']} [{record['key']}]",
+            'cat': record['function'].split('.')[0],
+            'ph': 'X',
+            'ts': record['start_s'] * 1e6,
+            'dur': record['wall_time_s'] * 1e6,
+            'pid': pid,
+            'tid': record['thread_id'],
+            'args': {
+                'key': record['key'],
+                'cpu_time_s': record['cpu_time_s'],
+                'samples': _json_value(record['samples']),
+                'peak_memory_bytes': _json_value(record['peak_memory_bytes']),
+            },
+        })
+    with open(file_path, 'w') as f:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
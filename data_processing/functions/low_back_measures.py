@@ -1,14 +1,25 @@
 """
 Functions for measures calculated from the IMU on the low back
  - Root Mean Squared (RMS) for each axis (VT, ML, and AP) and resultant (RES)
+ - Windowed RMS and jerk RMS (RMS over time within a run)
  - Sample Entropy (SE) for each single axis
+
+All functions here are read only: they never modify the dfs passed in and only return new result tables.
+With mask_column (e.g. 'gap_mask' from prep.rebuild_time_base) the masked rows are left out: RMS skips them,
+windowed RMS and control entropy skip the windows that have any, and sample entropy skips the templates that have any.
 """
 # Packages
-import nolds
 import numpy as np
 import pandas as pd
 import warnings
 
+from . import data_prep as prep
+from ._lazy import lazy_module
+
+# nolds (and entropy, which needs scipy) are imported the first time they are used
+nolds = lazy_module('nolds')
+entropy = lazy_module(f'{__package__}.entropy')
+
 # Root Mean Squared (RMS) ----------------------------------------------------------
 
 
@@ -19,21 +30,24 @@ import warnings
 # 1) Square each value in the series (series.pow(2)). pow(2) means "power of 2"
 # 2) Compute the mean of the squared values (np.mean(series.pow(2))).
 # 3) Compute the square root of the mean of the squared values (np.sqrt(np.mean(series.pow(2)))).
+# NOTE: the mean of the squares is accumulated in float64 so float32 columns give the same RMS
 
 
 def calculate_rms(series):
-    return np.sqrt(np.mean(series.pow(2)))
+    values = np.asarray(series)
+    return np.sqrt(np.mean(np.square(values), dtype=np.float64))
 
 # RMS for specified columns for each df in a dictionary ----------------------------------------------------------
 
 
-def apply_rms_to_dfs(dfs, columns):
+def apply_rms_to_dfs(dfs, columns, mask_column=None):
     """
     This function calculates the root mean square (RMS) of the specified columns in each dataframe in the input dictionary.
 
     Arguments:
     - dfs: a dictionary of pandas dataframes. The keys are the names of the dataframes and the values are the dataframes themselves.
     - columns: a list of strings, where each string is a column name in the dataframes that the RMS should be calculated for.
+    - mask_column: optional boolean column, rows where it is True are left out (e.g. 'gap_mask').
 
     For each column in 'columns', the function calculates the RMS using the calculate_rms function and 
     stores the result in a dictionary along with the key of the dataframe in dfs and the column name (appended with '_rms'). 
@@ -45,10 +59,12 @@ def apply_rms_to_dfs(dfs, columns):
 
     for key in dfs.keys():
         df = dfs[key]
+        mask = prep.masked_rows(df, mask_column, key)
 
         for col in columns:
             if col in df.columns:
-                rms_value = calculate_rms(df[col])
+                values = df[col].to_numpy()
+                rms_value = calculate_rms(values if mask is None else values[~mask])
 
                 results.append({
                     'key': key,
@@ -62,6 +78,191 @@ def apply_rms_to_dfs(dfs, columns):
     return result_df
 
 
+# Windowed RMS and jerk RMS ----------------------------------------------------------
+
+
+# RMS over time (e.g. 1 sec windows with 50% overlap) to look at changes within a run, plus the RMS of the jerk
+# (derivative of acceleration, diff * fs).
+
+# Steps:
+# 1) Cumulative sum of the squared values for all the columns at once (one pass over the data)
+# 2) The sum of squares for any window is then cumsum[end] - cumsum[start], so every window costs the same
+#    no matter how big it is or how much the windows overlap
+# 3) RMS = sqrt(sum of squares / samples in the window)
+# NOTE: the cumulative sums are float64 (also for float32 columns) so subtracting them doesn't lose precision
+# NOTE: the jerk window for samples [start, end) uses the end - start - 1 differences inside the window
+
+
+def _window_length_and_hop(fs, window_s, overlap):
+    window = int(round(window_s * fs))
+    hop = int(round(window * (1 - overlap)))
+    if window < 2:
+        raise ValueError('window_s * fs must be at least 2 samples')
+    if hop < 1:
+        raise ValueError('overlap must be less than 1')
+    return window, hop
+
+
+def _cumsum_of_squares(values):
+    # Leading row of zeros so cumsum[end] - cumsum[start] is the sum of samples start to end - 1
+    cumsum = np.zeros((values.shape[0] + 1, values.shape[1]), dtype=np.float64)
+    np.cumsum(np.square(values, dtype=np.float64), axis=0, out=cumsum[1:])
+    return cumsum
+
+
+def windowed_rms(values, window, hop, fs=None, jerk=False):
+    """
+    RMS of each window of 'window' samples, moving 'hop' samples each time, for every column of a 2D array (samples x columns).
+
+    Returns (starts, rms) where starts are the first sample of each window and rms is (windows x columns).
+    With jerk=True (needs fs) it returns (starts, rms, jerk_rms).
+    """
+    values = np.asarray(values)
+    if values.ndim == 1:
+        values = values[:, None]
+    starts = np.arange(0, values.shape[0] - window + 1, hop)
+
+    cumsum = _cumsum_of_squares(values)
+    rms = np.sqrt((cumsum[starts + window] - cumsum[starts]) / window)
+    if not jerk:
+        return starts, rms
+
+    if fs is None:
+        raise ValueError('fs is needed for jerk')
+    jerk_cumsum = _cumsum_of_squares(
+        np.diff(values, axis=0).astype(np.float64) * fs)
+    jerk_rms = np.sqrt(
+        (jerk_cumsum[starts + window - 1] - jerk_cumsum[starts]) / (window - 1))
+    return starts, rms, jerk_rms
+
+
+def _windows_table(key, starts, first_window, times, columns, rms, jerk_rms=None):
+    """
+    One row per window: key, window number, start sample, start time and a '{col}_rms' (and '{col}_jerk_rms') column for each column.
+    """
+    table = {
+        'key': key,
+        'window': np.arange(first_window, first_window + len(starts)),
+        'start_sample': starts,
+        'start_s': times,
+    }
+    for i, col in enumerate(columns):
+        table[f'{col}_rms'] = rms[:, i]
+    if jerk_rms is not None:
+        for i, col in enumerate(columns):
+            table[f'{col}_jerk_rms'] = jerk_rms[:, i]
+    return pd.DataFrame(table)
+
+
+class WindowedRMS:
+    """
+    Streaming version of apply_windowed_rms_to_dfs for data that arrives in chunks (e.g. reading a long recording a piece at a time).
+
+    Samples that could still be part of a window are carried over to the next chunk, so the windows are exactly the same
+    as running on the whole recording at once.
+
+    Example:
+        stream = back.WindowedRMS('run_1', ['ax_m/s/s', 'ay_m/s/s'], fs=1125, jerk=True)
+        tables = [stream.update(chunk) for chunk in pd.read_csv(file, chunksize=100000)]
+        windows_df = pd.concat(tables, ignore_index=True)
+    """
+
+    def __init__(self, key, columns, fs, window_s=1.0, overlap=0.5, jerk=False, time_col='time_s'):
+        self.key = key
+        self.columns = list(columns)
+        self.fs = fs
+        self.jerk = jerk
+        self.time_col = time_col
+        self.window, self.hop = _window_length_and_hop(fs, window_s, overlap)
+        # Samples carried over from the last chunk, the sample number of the first one and the number of windows so far
+        self._values = np.empty((0, len(self.columns)), dtype=np.float64)
+        self._times = np.empty(0, dtype=np.float64)
+        self._offset = 0
+        self._n_windows = 0
+
+    def update(self, chunk):
+        """
+        Adds a chunk (DataFrame with the columns, and optionally the time column) and returns the windows it completed.
+        """
+        values = np.concatenate(
+            [self._values, chunk[self.columns].to_numpy(dtype=np.float64)])
+        if self.time_col in chunk.columns:
+            times = np.concatenate(
+                [self._times, chunk[self.time_col].to_numpy(dtype=np.float64)])
+        else:
+            times = np.concatenate(
+                [self._times, (self._offset + len(self._times) + np.arange(len(chunk))) / self.fs])
+
+        results = windowed_rms(values, self.window, self.hop,
+                               fs=self.fs, jerk=self.jerk)
+        starts = results[0]
+        table = _windows_table(self.key, starts + self._offset, self._n_windows,
+                               times[starts], self.columns, *results[1:])
+
+        # Keep everything from the start of the next window onwards
+        next_start = starts[-1] + self.hop if len(starts) else 0
+        self._values = values[next_start:]
+        self._times = times[next_start:]
+        self._offset += next_start
+        self._n_windows += len(starts)
+        return table
+
+
+def apply_windowed_rms_to_dfs(dfs, columns, fs, window_s=1.0, overlap=0.5, jerk=False, time_col='time_s', mask_column=None):
+    """
+    This function calculates the RMS of the specified columns over overlapping windows in each dataframe in the input dictionary.
+
+    Arguments:
+    - dfs: a dictionary of pandas dataframes. The keys are the names of the dataframes and the values are the dataframes themselves.
+    - columns: a list of strings, where each string is a column name in the dataframes that the RMS should be calculated for.
+    - fs: sample rate (hz).
+    - window_s: length of each window in seconds, default is 1 sec.
+    - overlap: fraction of each window that overlaps with the next, default is 0.5 (50%).
+    - jerk: also calculate the RMS of the jerk (derivative) of each column, default is False.
+    - time_col: column used for the start time of each window. If it doesn't exist the start time is start_sample / fs.
+    - mask_column: optional boolean column, windows with any row where it is True are left out (e.g. 'gap_mask').
+
+    If a column in 'columns' does not exist in a dataframe, a warning message is issued and the column is skipped.
+    Only complete windows are used (a partial window at the end of the run is left out).
+
+    The function returns a dataframe with one row per window (key, window, start_sample, start_s and '{col}_rms' /
+    '{col}_jerk_rms' columns).
+    """
+    window, hop = _window_length_and_hop(fs, window_s, overlap)
+    tables = []
+
+    for key in dfs.keys():
+        df = dfs[key]
+
+        key_columns = []
+        for col in columns:
+            if col in df.columns:
+                key_columns.append(col)
+            else:
+                warnings.warn(f"The column '{col}' does not exist in '{key}'")
+        if not key_columns:
+            continue
+
+        results = windowed_rms(df[key_columns].to_numpy(), window, hop,
+                               fs=fs, jerk=jerk)
+        mask = prep.masked_rows(df, mask_column, key)
+        if mask is not None:
+            keep = ~prep.windows_with_masked_rows(mask, results[0], window)
+            results = tuple(result[keep] for result in results)
+        starts = results[0]
+        if time_col in df.columns:
+            times = df[time_col].to_numpy(dtype=np.float64)[starts]
+        else:
+            times = starts / fs
+        tables.append(_windows_table(key, starts, 0, times,
+                      key_columns, *results[1:]))
+
+    if not tables:
+        return pd.DataFrame(columns=['key', 'window', 'start_sample', 'start_s'])
+    result_df = pd.concat(tables, ignore_index=True)
+    return result_df
+
+
 # Sample Entropy for specified columns for each df in a dictionary ----------------------------------------------------------
 
 
@@ -70,7 +271,7 @@ def apply_rms_to_dfs(dfs, columns):
 # - tolerance is r
 
 
-def apply_sampen_to_dfs(dfs, columns, emb_dim=2, tolerance=0.2):
+def apply_sampen_to_dfs(dfs, columns, emb_dim=2, tolerance=0.2, mask_column=None):
     """
     This function calculates the sample entropy of the specified columns in each dataframe in the input dictionary.
 
@@ -79,6 +280,8 @@ def apply_sampen_to_dfs(dfs, columns, emb_dim=2, tolerance=0.2):
     - columns: a list of strings, where each string is a column name in the dataframes that the sample entropy should be calculated for.
     - emb_dim: embedding dimension for sample entropy calculation, default is 2.
     - tolerance: tolerance for sample entropy calculation, default is 0.15.
+    - mask_column: optional boolean column (e.g. 'gap_mask'). Templates with any row where it is True are left out
+      (entropy.masked_sample_entropy, same result as nolds.sampen when nothing is masked).
 
     For each column in 'columns', the function calculates the sample entropy using the nolds.sampen function and 
     stores the result in a dictionary along with the key of the dataframe in dfs and the column name (appended with '_sampen'). 
@@ -90,11 +293,16 @@ def apply_sampen_to_dfs(dfs, columns, emb_dim=2, tolerance=0.2):
 
     for key in dfs.keys():
         df = dfs[key]
+        mask = prep.masked_rows(df, mask_column, key)
 
         for col in columns:
             if col in df.columns:
-                sampen_value = nolds.sampen(
-                    df[col], emb_dim=emb_dim, tolerance=tolerance)
+                if mask is None:
+                    sampen_value = nolds.sampen(
+                        df[col].to_numpy(dtype=np.float64), emb_dim=emb_dim, tolerance=tolerance)
+                else:
+                    sampen_value = entropy.masked_sample_entropy(
+                        df[col].to_numpy(dtype=np.float64), mask, emb_dim=emb_dim, tolerance=tolerance)
 
                 results.append({
                     'key': key,
@@ -106,3 +314,62 @@ def apply_sampen_to_dfs(dfs, columns, emb_dim=2, tolerance=0.2):
 
     result_df = pd.DataFrame(results)
     return result_df
+
+
+# Control Entropy (windowed Sample Entropy) for specified columns for each df in a dictionary ----------------------------------------------------------
+
+
+# NOTE: This is the overlapping window method from the control entropy notebook
+# - window_size = 750 and overlap = 375 is a 50% overlapping window
+
+
+def apply_control_entropy_to_dfs(dfs, columns, window_size=750, overlap=375, emb_dim=2, tolerance=0.15, mask_column=None):
+    """
+    This function calculates control entropy (the average sample entropy of overlapping windows) of the specified columns
+    in each dataframe in the input dictionary.
+
+    Arguments:
+    - dfs: a dictionary of pandas dataframes. The keys are the names of the dataframes and the values are the dataframes themselves.
+    - columns: a list of strings, where each string is a column name in the dataframes that control entropy should be calculated for.
+    - window_size: number of samples in each window, default is 750.
+    - overlap: number of samples the window moves over each time, default is 375.
+    - emb_dim: embedding dimension for sample entropy calculation, default is 2.
+    - tolerance: tolerance for sample entropy calculation, default is 0.15.
+    - mask_column: optional boolean column, windows with any row where it is True are left out (e.g. 'gap_mask').
+
+    The result for each column is stored along with the key of the dataframe in dfs and the column name (appended with '_control_entropy').
+    If a column in 'columns' does not exist in a dataframe, a warning message is issued and the column is skipped.
+
+    The function returns a dataframe with the control entropy calculations.
+    """
+    results = []
+
+    for key in dfs.keys():
+        df = dfs[key]
+        mask = prep.masked_rows(df, mask_column, key)
+
+        for col in columns:
+            if col in df.columns:
+                signal = df[col].to_numpy(dtype=np.float64)
+
+                # Sample entropy for each window
+                # moves over 'overlap' each time and then ends its window at wherever it started plus 'window_size'
+                starts = np.arange(0, len(signal) - window_size, overlap)
+                if mask is not None:
+                    starts = starts[~prep.windows_with_masked_rows(mask, starts, window_size)]
+                sample_entropy_values = []
+                for i in starts:
+                    window = signal[i:i+window_size]
+                    sample_entropy_values.append(nolds.sampen(
+                        window, emb_dim=emb_dim, tolerance=tolerance))
+
+                results.append({
+                    'key': key,
+                    'variable': f'{col}_control_entropy',
+                    'value': np.mean(sample_entropy_values)
+                })
+            else:
+                warnings.warn(f"The column '{col}' does not exist in '{key}'")
+
+    result_df = pd.DataFrame(results)
+    return result_df
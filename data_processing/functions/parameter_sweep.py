@@ -0,0 +1,293 @@
+"""
+Functions for sensitivity checks over a grid of processing parameters (instead of re-running the notebooks)
+ - Sample entropy over many tolerances (r)
+ - Average peak / number of peaks over many min_peak_height and min_samples_between_peaks values
+ - Outlier bounds of create_summary_tbl over many k (IQR) and z (Z-score) values
+ - Butterworth low pass cutoffs (residual analysis, Winter 2009), alone or jointly with the sampen and peak grids
+
+How work is shared between grid points:
+ - Sample entropy: the match counts for every r come from one KD-tree pass per embedding dimension
+   (cKDTree.count_neighbors with an array of radii) instead of one nolds.sampen call per r
+ - Peaks: every local maximum is found once; each grid point only filters those candidates by height and then by
+   distance (same order and result as scipy.signal.find_peaks)
+ - k and z: quartiles, mean and SD are calculated once, the bounds for every k and z are then a line each, and the
+   number of values outside them comes from np.searchsorted on the sorted values
+ - Cutoffs: all columns of a run are filtered in one filtfilt call per cutoff, and the filtered signals are reused
+   for the sampen and peak grids when they are swept jointly with the cutoff
+
+All sweeps return a tidy results cube: one row per key, variable and grid point (columns key, sweep, variable,
+the parameter columns of that sweep, value). Sweeps can be stacked with pd.concat.
+
+Read only: the dfs passed in are not modified.
+"""
+# Packages
+import numpy as np
+import pandas as pd
+import warnings
+from itertools import product
+from numpy.lib.stride_tricks import sliding_window_view
+
+from ._lazy import lazy_module
+
+# scipy is imported the first time a sweep runs
+scipy_signal = lazy_module('scipy.signal')
+spatial = lazy_module('scipy.spatial')
+
+# Sample entropy over many tolerances ----------------------------------------------------------
+
+
+def sampen_tolerance_sweep(x, emb_dim=2, tolerances=(0.1, 0.15, 0.2, 0.25)):
+    """
+    Sample entropy of one series for every tolerance (absolute, like nolds.sampen), same result as nolds.sampen /
+    entropy.sample_entropy for each one.
+
+    The pair counts for all tolerances come from one count_neighbors call per template length.
+    """
+    x = np.asarray(x, dtype=np.float64)
+    tolerances = np.asarray(tolerances, dtype=np.float64)
+    n_templates = len(x) - emb_dim
+    if n_templates < 2:
+        return np.full(len(tolerances), np.nan)
+
+    # Distances strictly below the tolerance (count_neighbors counts <= r), see entropy._Templates
+    radii = np.nextafter(tolerances, -np.inf)
+    counts = []
+    for length in (emb_dim, emb_dim + 1):
+        tree = spatial.cKDTree(sliding_window_view(x, length)[:n_templates])
+        counts.append((tree.count_neighbors(tree, radii, p=np.inf) - n_templates) // 2)
+    count_m, count_m1 = counts
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        sampen = -np.log(count_m1 / count_m)
+    if np.any(count_m1 == 0):
+        warnings.warn(
+            'Zero template matches within tolerance. Consider raising the tolerance.', RuntimeWarning)
+    sampen[(count_m == 0) & (count_m1 == 0)] = np.nan
+    return sampen
+
+
+def sweep_sampen(dfs, columns, tolerances, emb_dim=2):
+    """
+    Sample entropy of the columns of each df for every tolerance (variable '{col}_sampen', like apply_sampen_to_dfs).
+    """
+    results = []
+    for key in dfs.keys():
+        df = dfs[key]
+        for col in columns:
+            if col not in df.columns:
+                warnings.warn(f"The column '{col}' does not exist in '{key}'")
+                continue
+            results.append(_sampen_rows(key, col, df[col].to_numpy(dtype=np.float64), tolerances, emb_dim))
+    return pd.concat(results, ignore_index=True) if results else pd.DataFrame()
+
+
+def _sampen_rows(key, col, values, tolerances, emb_dim, sweep='sampen', **grid_point):
+    # Rows of the results cube for one series, grid_point adds parameter columns (e.g. the cutoff it was filtered at)
+    return pd.DataFrame({'key': key, 'sweep': sweep, 'variable': f'{col}_sampen', **grid_point,
+                         'emb_dim': emb_dim, 'tolerance': tolerances,
+                         'value': sampen_tolerance_sweep(values, emb_dim, tolerances)})
+
+# Peaks over many heights and spacings ----------------------------------------------------------
+
+
+def candidate_peaks(signal):
+    """
+    Every local maximum of the signal (the same candidates find_peaks starts from) and its height.
+    """
+    signal = np.ascontiguousarray(signal, dtype=np.float64)
+    candidates = scipy_signal.find_peaks(signal)[0]
+    return candidates, signal[candidates]
+
+
+def filter_peaks(candidates, heights, min_peak_height=None, max_peak_height=None, min_samples_between_peaks=None):
+    """
+    The peaks find_peaks(signal, height=(min_peak_height, max_peak_height), distance=min_samples_between_peaks)
+    would return, picked from the candidates (heights first, then the distance rule: highest peaks are kept first).
+    """
+    keep = np.ones(len(candidates), dtype=bool)
+    if min_peak_height is not None:
+        keep &= heights >= min_peak_height
+    if max_peak_height is not None:
+        keep &= heights <= max_peak_height
+    candidates, heights = candidates[keep], heights[keep]
+
+    if min_samples_between_peaks is not None and min_samples_between_peaks > 1 and len(candidates):
+        keep = _select_by_distance(candidates, heights, min_samples_between_peaks)
+        candidates, heights = candidates[keep], heights[keep]
+    return candidates, heights
+
+
+def _select_by_distance(candidates, heights, distance):
+    # find_peaks' distance rule (highest peaks kept first) run on a signal that is -inf everywhere but the candidates,
+    # so only the candidates can be peaks and their spacing is unchanged
+    sparse = np.full(candidates[-1] + 2, -np.inf)
+    sparse[candidates] = heights
+    return np.isin(candidates, scipy_signal.find_peaks(sparse, distance=distance)[0])
+
+
+def sweep_peaks(dfs, columns, min_peak_heights=(None,), min_samples_between_peaks=(None,), max_peak_height=None):
+    """
+    Average peak (variable '{col}_avg_peak', like calc_avg_positive_peaks) and number of peaks ('{col}_n_peaks') of
+    the columns of each df for every min_peak_height x min_samples_between_peaks.
+    """
+    results = []
+    for key in dfs.keys():
+        df = dfs[key]
+        for col in columns:
+            if col not in df.columns:
+                warnings.warn(f"The column '{col}' does not exist in '{key}'")
+                continue
+            results.extend(_peak_rows(key, col, df[col].to_numpy(), min_peak_heights, min_samples_between_peaks,
+                                      max_peak_height))
+    return pd.DataFrame(results)
+
+
+def _peak_rows(key, col, signal, min_peak_heights, min_samples_between_peaks, max_peak_height, sweep='peaks',
+               **grid_point):
+    # Rows of the results cube for one series, grid_point adds parameter columns (e.g. the cutoff it was filtered at)
+    candidates, heights = candidate_peaks(signal)
+    rows = []
+    for height, distance in product(min_peak_heights, min_samples_between_peaks):
+        _, peak_values = filter_peaks(candidates, heights, height, max_peak_height, distance)
+        for variable, value in ((f'{col}_avg_peak', np.mean(peak_values) if len(peak_values) else np.nan),
+                                (f'{col}_n_peaks', len(peak_values))):
+            rows.append({'key': key, 'sweep': sweep, 'variable': variable, **grid_point,
+                         'min_peak_height': height, 'min_samples_between_peaks': distance, 'value': value})
+    return rows
+
+# Outlier bounds over many k and z ----------------------------------------------------------
+
+
+def sweep_outlier_bounds(dfs, columns, ks=(2, 3, 4), zs=(2, 3, 4)):
+    """
+    Lower and upper outlier bounds of create_summary_tbl for every k (IQR) and z (Z-score) and how many values
+    (and what % of them) are outside each pair of bounds.
+
+    Variables: '{col}_lower_bound', '{col}_upper_bound', '{col}_n_outliers' and '{col}_pct_outliers', with
+    method 'k' or 'z' and the multiplier in 'threshold'.
+    """
+    results = []
+    for key in dfs.keys():
+        df = dfs[key]
+        for col in columns:
+            if col not in df.columns:
+                warnings.warn(f"The column '{col}' does not exist in '{key}'")
+                continue
+            values = np.sort(df[col].dropna().to_numpy(dtype=np.float64))
+            # Same statistics as create_summary_tbl (pandas quantiles and SD with ddof=1)
+            q1, q3 = np.quantile(values, [0.25, 0.75])
+            mean, sd = values.mean(), values.std(ddof=1)
+
+            for method, thresholds, centre_low, centre_high, spread in (
+                    ('k', np.asarray(ks, dtype=np.float64), q1, q3, q3 - q1),
+                    ('z', np.asarray(zs, dtype=np.float64), mean, mean, sd)):
+                lower = centre_low - thresholds * spread
+                upper = centre_high + thresholds * spread
+                n_outliers = np.searchsorted(values, lower, side='left') + \
+                    len(values) - np.searchsorted(values, upper, side='right')
+                for variable, value in ((f'{col}_lower_bound', lower), (f'{col}_upper_bound', upper),
+                                        (f'{col}_n_outliers', n_outliers),
+                                        (f'{col}_pct_outliers', n_outliers / len(values) * 100)):
+                    results.append(pd.DataFrame({'key': key, 'sweep': 'outliers', 'variable': variable,
+                                                 'method': method, 'threshold': thresholds, 'value': value}))
+    return pd.concat(results, ignore_index=True) if results else pd.DataFrame()
+
+# Butterworth cutoffs ----------------------------------------------------------
+
+
+def sweep_cutoffs(dfs, columns, fs, cutoffs, order=4, tolerances=None, emb_dim=2, min_peak_heights=None,
+                  min_samples_between_peaks=None, max_peak_height=None):
+    """
+    Residual analysis of the Butterworth low pass filter (same filter as butter_lowpass_filter) for every cutoff:
+    RMS of the residual (raw - filtered, variable '{col}_residual_rms') and RMS of the filtered signal
+    ('{col}_filtered_rms'). The cutoff is usually taken where the residual stops falling quickly.
+
+    To see how the cutoff changes the measures, give the sampen and/or peak grids too: each filtered signal is then
+    also run through them (joint grid cutoff x tolerance, sweep 'cutoff_sampen', and cutoff x min_peak_height x
+    min_samples_between_peaks, sweep 'cutoff_peaks'). The signals are filtered once per cutoff for all of these.
+    """
+    peak_grid = min_peak_heights is not None or min_samples_between_peaks is not None
+    results = []
+    tables = []
+    for key in dfs.keys():
+        df = dfs[key]
+        key_columns = []
+        for col in columns:
+            if col in df.columns:
+                key_columns.append(col)
+            else:
+                warnings.warn(f"The column '{col}' does not exist in '{key}'")
+        if not key_columns:
+            continue
+
+        raw = df[key_columns].to_numpy(dtype=np.float64)
+        for cutoff in cutoffs:
+            b, a = scipy_signal.butter(order, cutoff / (0.5 * fs), btype='low', analog=False)
+            filtered = scipy_signal.filtfilt(b, a, raw, axis=0)
+            residual_rms = np.sqrt(np.mean((raw - filtered) ** 2, axis=0))
+            filtered_rms = np.sqrt(np.mean(filtered ** 2, axis=0))
+            for i, col in enumerate(key_columns):
+                for variable, value in ((f'{col}_residual_rms', residual_rms[i]), (f'{col}_filtered_rms', filtered_rms[i])):
+                    results.append({'key': key, 'sweep': 'cutoff', 'variable': variable,
+                                    'order': order, 'cutoff': cutoff, 'value': value})
+                if peak_grid:
+                    results.extend(_peak_rows(key, col, filtered[:, i], min_peak_heights or (None,),
+                                              min_samples_between_peaks or (None,), max_peak_height,
+                                              sweep='cutoff_peaks', order=order, cutoff=cutoff))
+                if tolerances is not None:
+                    tables.append(_sampen_rows(key, col, filtered[:, i], tolerances, emb_dim,
+                                               sweep='cutoff_sampen', order=order, cutoff=cutoff))
+
+    tables = [pd.DataFrame(results)] + tables
+    tables = [table for table in tables if not table.empty]
+    return pd.concat(tables, ignore_index=True) if tables else pd.DataFrame()
+
+# Whole grid ----------------------------------------------------------
+
+
+def run_parameter_sweep(dfs, columns, tolerances=None, emb_dim=2, min_peak_heights=None,
+                        min_samples_between_peaks=None, max_peak_height=None, ks=None, zs=None, cutoffs=None, fs=None,
+                        order=4, joint_cutoffs=False):
+    """
+    This function runs every sweep that has a grid given and returns one tidy results cube.
+
+    Arguments:
+    - dfs: a dictionary of pandas dataframes (the cohort). The keys are the names of the dataframes and the values are the dataframes themselves.
+    - columns: a list of column names.
+    - tolerances (+ emb_dim): sample entropy tolerances (sweep_sampen).
+    - min_peak_heights, min_samples_between_peaks (+ max_peak_height): peak settings (sweep_peaks). Give one or both.
+    - ks, zs: outlier multipliers (sweep_outlier_bounds). Give one or both.
+    - cutoffs (+ fs, order): Butterworth cutoffs in hz (sweep_cutoffs).
+    - joint_cutoffs: also run the sampen and peak grids on the signal filtered at every cutoff (joint grid, see
+      sweep_cutoffs), default is False (each sweep on its own, on the signals as given).
+
+    If a column in 'columns' does not exist in a dataframe, a warning message is issued and the column is skipped.
+
+    The function returns a dataframe with key, sweep, variable, value and the parameter columns (NaN for the
+    parameters a sweep does not use).
+    """
+    tables = []
+    if tolerances is not None:
+        tables.append(sweep_sampen(dfs, columns, tolerances, emb_dim=emb_dim))
+    if min_peak_heights is not None or min_samples_between_peaks is not None:
+        tables.append(sweep_peaks(dfs, columns, min_peak_heights or (None,), min_samples_between_peaks or (None,),
+                                  max_peak_height=max_peak_height))
+    if ks is not None or zs is not None:
+        tables.append(sweep_outlier_bounds(dfs, columns, ks or (), zs or ()))
+    if cutoffs is not None:
+        if fs is None:
+            raise ValueError('fs is needed for the cutoff sweep')
+        if joint_cutoffs:
+            tables.append(sweep_cutoffs(dfs, columns, fs, cutoffs, order=order, tolerances=tolerances, emb_dim=emb_dim,
+                                        min_peak_heights=min_peak_heights,
+                                        min_samples_between_peaks=min_samples_between_peaks,
+                                        max_peak_height=max_peak_height))
+        else:
+            tables.append(sweep_cutoffs(dfs, columns, fs, cutoffs, order=order))
+
+    tables = [table for table in tables if not table.empty]
+    if not tables:
+        return pd.DataFrame()
+    cube = pd.concat(tables, ignore_index=True)
+    # value last so the parameter columns sit between the variable and its value
+    return cube[[col for col in cube.columns if col != 'value'] + ['value']]
@@ -2,12 +2,88 @@
 Functions for calculating peaks
  - Peak detection for positive, negative, and absolute values
  - Peak detection for negative and absolute values using specified window based on *each* resultant peak
+
+What each function does to the dictionary of dfs passed in:
+ - every function is read only: peaks are found on NumPy arrays of the columns by row position (whatever the index of
+   the df is) and only new tables are returned. Nothing is added to or changed in the dfs passed in.
+ - calc_avg_positive_peaks and calc_avg_positive_peaks_from_tbl also return a new dictionary of small peak tables.
+ - return_markers=True also returns a new dictionary of {key: df of peak marker columns (0/1)} with the same index as
+   each run, for plotting (e.g. dfs[key].join(dfs_markers[key])).
+ - find_peak_indices works on a single signal and is read only.
+ - mask_column (find_peak_indices: mask): peaks in masked rows (e.g. the long gaps marked by prep.rebuild_time_base)
+   are left out. The windowed functions also leave out resultant peaks whose window has any masked row.
 """
 # Packages
 import numpy as np
 import pandas as pd
 import warnings
-from scipy.signal import find_peaks
+
+from . import data_prep as prep
+from ._lazy import lazy_module
+
+# scipy.signal is imported the first time peaks are found
+scipy_signal = lazy_module('scipy.signal')
+
+# Peak spacing in seconds ----------------------------------------------------------
+
+
+# The spacing parameters below are in samples, so they change with the sample rate (e.g. 0.25 secs = 281 samples at
+# 1125hz but 400 at 1600hz). Every peak function can also take them in seconds (min_secs_between_peaks, window_secs)
+# together with sample_freq, which is then used instead of the samples version.
+
+
+def secs_to_samples(secs, sample_freq):
+    return int(round(secs * sample_freq))
+
+
+def _samples_from_secs(samples, secs, sample_freq):
+    if secs is None:
+        return samples
+    if sample_freq is None:
+        raise ValueError(
+            'sample_freq is needed when the peak spacing is given in seconds')
+    return secs_to_samples(secs, sample_freq)
+
+# Peak locations only ----------------------------------------------------------
+
+
+def find_peak_indices(signal, min_peak_height=None, max_peak_height=None, min_samples_between_peaks=None, min_secs_between_peaks=None, sample_freq=None, mask=None):
+    """
+    Returns the row positions of the positive peaks of a single signal (same find_peaks settings as calc_avg_positive_peaks)
+    without adding any columns to a df. Used by the gait segmentation and bilateral functions.
+    - mask: optional boolean array, peaks where it is True are left out.
+    """
+    min_samples_between_peaks = _samples_from_secs(
+        min_samples_between_peaks, min_secs_between_peaks, sample_freq)
+    peaks, _ = scipy_signal.find_peaks(np.asarray(signal), height=(
+        min_peak_height, max_peak_height), distance=min_samples_between_peaks)
+    if mask is not None:
+        peaks = peaks[~np.asarray(mask)[peaks]]
+    return peaks
+
+
+def _unmasked_peaks(peaks, peak_values, mask):
+    # Leaves out the peaks in masked rows
+    if mask is None:
+        return peaks, peak_values
+    keep = ~mask[peaks]
+    return peaks[keep], peak_values[keep]
+
+
+def _marker_column(n_rows, peaks):
+    # 0/1 column marking the peak rows (for plotting)
+    marker = np.zeros(n_rows, dtype=np.int64)
+    marker[peaks] = 1
+    return marker
+
+
+def _unmasked_windows(peaks, half_window_size, n_rows, mask):
+    # Leaves out the peaks whose window (same bounds as the windowed peak functions) has any masked row
+    if mask is None:
+        return peaks
+    starts = np.maximum(0, peaks - half_window_size)
+    ends = np.minimum(n_rows - 1, peaks + half_window_size)
+    return peaks[~prep.windows_with_masked_rows(mask, starts, ends - starts + 1)]
 
 # Average Peak Acceleration for Positive Peaks ----------------------------------------------------------
 
@@ -15,10 +91,9 @@ from scipy.signal import find_peaks
 import numpy as np
 import pandas as pd
 import warnings
-from scipy.signal import find_peaks
 
 
-def calc_avg_positive_peaks(dfs, columns, time_column=None,  min_peak_height=None, max_peak_height=None, min_samples_between_peaks=None):
+def calc_avg_positive_peaks(dfs, columns, time_column=None,  min_peak_height=None, max_peak_height=None, min_samples_between_peaks=None, min_secs_between_peaks=None, sample_freq=None, mask_column=None, return_markers=False):
     """
     Calculates the average positive peak for the specified columns in each dataframe in the input dictionary.
 
@@ -27,39 +102,46 @@ def calc_avg_positive_peaks(dfs, columns, time_column=None,  min_peak_height=Non
     - 1125hz = 281
     - 1600hz = 400
     When the IMU is located on the left or right leg the numbers above are just doubled in order to represent the time between just one side (vs both)
+    Or give the spacing in seconds with min_secs_between_peaks (e.g. 0.25) and sample_freq, which works at any sample rate.
+    With mask_column (e.g. 'gap_mask' from prep.rebuild_time_base) the peaks in masked rows are left out.
 
     Notes:
     - For each column in 'columns', the function finds the peaks using the scipy.signal.find_peaks function, calculates the average of these peaks,
     and stores the result in a dictionary along with the key of the dataframe in 'dfs' and the column name (appended with '_avg_peak').
-    - A new column indicating the peak locations is also added to the original dataframe. 
+    - The dfs passed in are not changed. With return_markers=True a dictionary of {key: df of '{col}_peaks' (0/1)
+    columns marking the peak locations} is also returned (for plotting).
     - The function also creates a dictionary containing dfs with the time and peak values for each peak.
 
     """
+    min_samples_between_peaks = _samples_from_secs(
+        min_samples_between_peaks, min_secs_between_peaks, sample_freq)
     results = []
     dfs_peak_values = {}
+    dfs_markers = {}
 
     for key in dfs.keys():
         df = dfs[key]
-        df.reset_index(drop=True, inplace=True)
+        mask = prep.masked_rows(df, mask_column, key)
+        markers = {}
 
         for col in columns:
             if col in df.columns:
-                peaks, properties = find_peaks(
-                    df[col], height=(min_peak_height, max_peak_height), distance=min_samples_between_peaks)
-                peak_values = properties["peak_heights"]
-                avg_peak_value = np.mean(peak_values)
+                peaks, properties = scipy_signal.find_peaks(
+                    df[col].to_numpy(), height=(min_peak_height, max_peak_height), distance=min_samples_between_peaks)
+                peaks, peak_values = _unmasked_peaks(
+                    peaks, properties["peak_heights"], mask)
+                avg_peak_value = np.mean(peak_values, dtype=np.float64)
 
-                # Add new column to *original* dataframe indicating the peak locations
-                df[f'{col}_peaks'] = 0
-                df.loc[peaks, f'{col}_peaks'] = 1
+                # Marker column indicating the peak locations (returned with return_markers=True)
+                markers[f'{col}_peaks'] = _marker_column(len(df), peaks)
 
                 # Create a dictionary of dfs w/ a column for the values (heights) for each peak and time at which they occured.
                 # 'time_column': this column contains the time values at the points where peaks have been identified in the data.
-                # NOTE: these time values are fetched from the 'time_column' of the *original* df at the indices where the peaks were found (the peaks array).
+                # NOTE: these time values are fetched from the 'time_column' of the *original* df at the row positions where the peaks were found (the peaks array).
                 peak_df = pd.DataFrame({
-                    time_column: df[time_column][peaks],
+                    time_column: df[time_column].to_numpy()[peaks],
                     'peak_values': peak_values
-                })
+                }, index=peaks)
                 # Storing this peak_df in a larger dictionary (dfs_peak_values):
                 # The key under which this df is stored is the original key of the df
                 dfs_peak_values[f'{key}'] = peak_df
@@ -72,29 +154,35 @@ def calc_avg_positive_peaks(dfs, columns, time_column=None,  min_peak_height=Non
             else:
                 warnings.warn(f"The column '{col}' does not exist in '{key}'")
 
-        # Replace the original dataframe with the modified one in the dictionary
-        dfs[key] = df
+        dfs_markers[key] = pd.DataFrame(markers, index=df.index)
 
     result_df = pd.DataFrame(results)
+    if return_markers:
+        return result_df, dfs_peak_values, dfs_markers
     return result_df, dfs_peak_values
 
 # Dynamic Version of Average Peak Acceleration for Positive Peaks ----------------------------------------------------------
 
 
-def calc_avg_positive_peaks_from_tbl(dfs, columns, time_column=None, summary_table=None, id_column=None, min_peak_height_column=None, max_peak_height_column=None, min_samples_between_peaks=None):
+def calc_avg_positive_peaks_from_tbl(dfs, columns, time_column=None, summary_table=None, id_column=None, min_peak_height_column=None, max_peak_height_column=None, min_samples_between_peaks=None, min_secs_between_peaks=None, sample_freq=None, mask_column=None, return_markers=False):
     """
     Update:
     This modification fetches min_peak_height and max_peak_height for each dataframe in the input dictionary 'dfs' dynamically from the input 'summary_table'. 
     The 'id_column' parameter specifies the column in 'summary_table' that matches with the keys in 'dfs'. 
     The 'min_peak_height_column' and 'max_peak_height_column' parameters specify the columns in 'summary_table' from where to 
     fetch the min and max peak heights for each dataframe.
+    With mask_column (e.g. 'gap_mask' from prep.rebuild_time_base) the peaks in masked rows are left out.
+    With return_markers=True a dictionary of peak marker dfs is also returned (see calc_avg_positive_peaks).
     """
+    min_samples_between_peaks = _samples_from_secs(
+        min_samples_between_peaks, min_secs_between_peaks, sample_freq)
     results = []
     dfs_peak_values = {}
+    dfs_markers = {}
 
     for key in dfs.keys():
         df = dfs[key]
-        df.reset_index(drop=True, inplace=True)
+        markers = {}
 
         # Obtain min and max peak heights for the current dataframe from the summary table
         min_peak_height = summary_table.loc[summary_table[id_column]
@@ -102,22 +190,24 @@ def calc_avg_positive_peaks_from_tbl(dfs, columns, time_column=None, summary_tab
         max_peak_height = summary_table.loc[summary_table[id_column]
                                             == key, max_peak_height_column].values[0]
 
+        mask = prep.masked_rows(df, mask_column, key)
+
         for col in columns:
             if col in df.columns:
-                peaks, properties = find_peaks(
-                    df[col], height=(min_peak_height, max_peak_height), distance=min_samples_between_peaks)
-                peak_values = properties["peak_heights"]
-                avg_peak_value = np.mean(peak_values)
+                peaks, properties = scipy_signal.find_peaks(
+                    df[col].to_numpy(), height=(min_peak_height, max_peak_height), distance=min_samples_between_peaks)
+                peaks, peak_values = _unmasked_peaks(
+                    peaks, properties["peak_heights"], mask)
+                avg_peak_value = np.mean(peak_values, dtype=np.float64)
 
-                # Add new column to *original* dataframe indicating the peak locations
-                df[f'{col}_peaks'] = 0
-                df.loc[peaks, f'{col}_peaks'] = 1
+                # Marker column indicating the peak locations (returned with return_markers=True)
+                markers[f'{col}_peaks'] = _marker_column(len(df), peaks)
 
                 # Create a dictionary of dfs w/ a column for the values (heights) for each peak and time at which they occured.
                 peak_df = pd.DataFrame({
-                    time_column: df[time_column][peaks],
+                    time_column: df[time_column].to_numpy()[peaks],
                     'peak_values': peak_values
-                })
+                }, index=peaks)
                 dfs_peak_values[f'{key}'] = peak_df
 
                 results.append({
@@ -128,16 +218,17 @@ def calc_avg_positive_peaks_from_tbl(dfs, columns, time_column=None, summary_tab
             else:
                 warnings.warn(f"The column '{col}' does not exist in '{key}'")
 
-        # Replace the original dataframe with the modified one in the dictionary
-        dfs[key] = df
+        dfs_markers[key] = pd.DataFrame(markers, index=df.index)
 
     result_df = pd.DataFrame(results)
+    if return_markers:
+        return result_df, dfs_peak_values, dfs_markers
     return result_df, dfs_peak_values
 
 # Average Peak Acceleration for Negative Peaks ----------------------------------------------------------
 
 
-def calc_avg_neg_peaks(dfs, columns, min_peak_height=1.0, min_samples_between_peaks=281):
+def calc_avg_neg_peaks(dfs, columns, min_peak_height=1.0, min_samples_between_peaks=281, min_secs_between_peaks=None, sample_freq=None, mask_column=None, return_markers=False):
     """
     This function calculates the average negative peak acceleration for the specified columns in each dataframe in the input dictionary.
 
@@ -150,33 +241,40 @@ def calc_avg_neg_peaks(dfs, columns, min_peak_height=1.0, min_samples_between_pe
     - columns: a list of strings, where each string is a column name in the dataframes that the average peak acceleration should be calculated for.
     - min_peak_height: the minimum height for a peak to be recognized, default is 1.0.
     - min_samples_between_peaks: the minimum number of samples between peaks, default is 281 (comes from 1125hz = 0.25 secs).
+    - mask_column: optional boolean column (e.g. 'gap_mask' from prep.rebuild_time_base), peaks in rows where it is
+      True are left out.
 
     For each column in 'columns', the function finds the peaks using the scipy.signal.find_peaks function, calculates the average 
     of these peaks, and stores the result in a dictionary along with the key of the dataframe in dfs and the column name (appended with '_avg_peak'). 
 
     If a column in 'columns' does not exist in a dataframe, a warning message is issued and the column is skipped.
 
-    The function returns a dataframe with the average peak accelerations for each key and 
-    adds a column to the original dataframe to indicate the location of the peaks. 
+    The function returns a dataframe with the average peak accelerations for each key. The dfs passed in are not
+    changed. With return_markers=True it also returns a dictionary of {key: df of a column (0/1) indicating the
+    location of the peaks}.
 
     """
+    min_samples_between_peaks = _samples_from_secs(
+        min_samples_between_peaks, min_secs_between_peaks, sample_freq)
     results = []
+    dfs_markers = {}
 
     for key in dfs.keys():
         df = dfs[key]
-        df.reset_index(drop=True, inplace=True)
+        mask = prep.masked_rows(df, mask_column, key)
+        markers = {}
 
         for col in columns:
             if col in df.columns:
                 # Multiply by -1 to find negative peaks
-                peaks, properties = find_peaks(
-                    -df[col], height=min_peak_height, distance=min_samples_between_peaks)
-                peak_values = properties["peak_heights"]
-                avg_peak_value = np.mean(peak_values)
+                peaks, properties = scipy_signal.find_peaks(
+                    -df[col].to_numpy(), height=min_peak_height, distance=min_samples_between_peaks)
+                peaks, peak_values = _unmasked_peaks(
+                    peaks, properties["peak_heights"], mask)
+                avg_peak_value = np.mean(peak_values, dtype=np.float64)
 
-                # Add new column to original dataframe indicating the peak locations
-                df[f'{col}_neg_peaks'] = 0
-                df.loc[peaks, f'{col}_neg_peaks'] = 1
+                # Marker column indicating the peak locations (returned with return_markers=True)
+                markers[f'{col}_neg_peaks'] = _marker_column(len(df), peaks)
 
                 results.append({
                     'key': key,
@@ -186,13 +284,17 @@ def calc_avg_neg_peaks(dfs, columns, min_peak_height=1.0, min_samples_between_pe
             else:
                 warnings.warn(f"The column '{col}' does not exist in '{key}'")
 
+        dfs_markers[key] = pd.DataFrame(markers, index=df.index)
+
     result_df = pd.DataFrame(results)
+    if return_markers:
+        return result_df, dfs_markers
     return result_df
 
 # Average Peak Acceleration for Absolute Values ----------------------------------------------------------
 
 
-def calc_avg_abs_peaks(dfs, columns, min_peak_height=1.0, min_samples_between_peaks=281):
+def calc_avg_abs_peaks(dfs, columns, min_peak_height=1.0, min_samples_between_peaks=281, min_secs_between_peaks=None, sample_freq=None, mask_column=None, return_markers=False):
     """
     This function calculates the average absolute peak acceleration for the specified columns in each dataframe in the input dictionary.
 
@@ -206,34 +308,41 @@ def calc_avg_abs_peaks(dfs, columns, min_peak_height=1.0, min_samples_between_pe
     - columns: a list of strings, where each string is a column name in the dataframes that the average peak acceleration should be calculated for.
     - min_peak_height: the minimum height for a peak to be recognized, default is 1.0.
     - min_samples_between_peaks: the minimum number of samples between peaks, default is 281 (comes from 1125hz = 0.25 secs).
+    - mask_column: optional boolean column (e.g. 'gap_mask' from prep.rebuild_time_base), peaks in rows where it is
+      True are left out.
 
     For each column in 'columns', the function finds the peaks using the scipy.signal.find_peaks function, calculates the average 
     of these peaks, and stores the result in a dictionary along with the key of the dataframe in dfs and the column name (appended with '_avg_abs_peak'). 
 
     If a column in 'columns' does not exist in a dataframe, a warning message is issued and the column is skipped.
 
-    The function returns a dataframe with the average peak accelerations for each key and 
-    adds a column to the original dataframe to indicate the location of the peaks. 
+    The function returns a dataframe with the average peak accelerations for each key. The dfs passed in are not
+    changed. With return_markers=True it also returns a dictionary of {key: df of a column (0/1) indicating the
+    location of the peaks}.
 
     """
+    min_samples_between_peaks = _samples_from_secs(
+        min_samples_between_peaks, min_secs_between_peaks, sample_freq)
     results = []
+    dfs_markers = {}
 
     for key in dfs.keys():
         df = dfs[key]
-        df.reset_index(drop=True, inplace=True)
+        mask = prep.masked_rows(df, mask_column, key)
+        markers = {}
 
         for col in columns:
             if col in df.columns:
                 # Find peaks on the absolute values of the data
-                peaks, properties = find_peaks(
-                    df[col].abs(), height=min_peak_height, distance=min_samples_between_peaks)
+                peaks, properties = scipy_signal.find_peaks(
+                    np.abs(df[col].to_numpy()), height=min_peak_height, distance=min_samples_between_peaks)
                 # Calculate absolute peak values
-                peak_values = df[col].iloc[peaks].abs()
-                avg_peak_value = np.mean(peak_values)
+                peaks, peak_values = _unmasked_peaks(
+                    peaks, properties["peak_heights"], mask)
+                avg_peak_value = np.mean(peak_values, dtype=np.float64)
 
-                # Add new column to original dataframe indicating the peak locations
-                df[f'{col}_abs_peaks'] = 0
-                df.loc[peaks, f'{col}_abs_peaks'] = 1
+                # Marker column indicating the peak locations (returned with return_markers=True)
+                markers[f'{col}_abs_peaks'] = _marker_column(len(df), peaks)
 
                 results.append({
                     'key': key,
@@ -243,24 +352,35 @@ def calc_avg_abs_peaks(dfs, columns, min_peak_height=1.0, min_samples_between_pe
             else:
                 warnings.warn(f"The column '{col}' does not exist in '{key}'")
 
+        dfs_markers[key] = pd.DataFrame(markers, index=df.index)
+
     result_df = pd.DataFrame(results)
+    if return_markers:
+        return result_df, dfs_markers
     return result_df
 
 # Find absolute peaks using a window determined by the RES peaks -----------------------------------------------------------
 
 
-def calc_avg_windowed_abs_peaks(dfs, resultant_column, columns, min_peak_height=1.0, min_samples_between_peaks=281, window_size=150):
+def calc_avg_windowed_abs_peaks(dfs, resultant_column, columns, min_peak_height=1.0, min_samples_between_peaks=281, window_size=150, min_secs_between_peaks=None, window_secs=None, sample_freq=None, mask_column=None, return_markers=False):
     """
     This function calculates the average absolute peak acceleration for the specified columns in each dataframe in the input dictionary,
     within a window of 'window_size' samples centered around each peak in 'resultant_column'.
+    With mask_column (e.g. 'gap_mask' from prep.rebuild_time_base) resultant peaks whose window has any masked row
+    are left out.
+    The dfs passed in are not changed. With return_markers=True a dictionary of {key: df of 'resultant_peaks' and
+    the windowed peak columns (0/1) indicating the peak locations} is also returned (for plotting).
     """
+    min_samples_between_peaks = _samples_from_secs(
+        min_samples_between_peaks, min_secs_between_peaks, sample_freq)
+    window_size = _samples_from_secs(window_size, window_secs, sample_freq)
     results = []
     peak_counts = []
+    dfs_markers = {}
     half_window_size = window_size // 2
 
     for key in dfs.keys():
         df = dfs[key]
-        df.reset_index(drop=True, inplace=True)
 
         if resultant_column not in df.columns:
             warnings.warn(
@@ -269,13 +389,14 @@ def calc_avg_windowed_abs_peaks(dfs, resultant_column, columns, min_peak_height=
 
         # Find locations of resultant peaks
         # NOTE: resultant_peaks is an array with the index ie location of each peak
-        resultant_peaks, _ = find_peaks(
-            df[resultant_column], height=min_peak_height, distance=min_samples_between_peaks)
+        resultant_peaks, _ = scipy_signal.find_peaks(
+            df[resultant_column].to_numpy(), height=min_peak_height, distance=min_samples_between_peaks)
+        resultant_peaks = _unmasked_windows(
+            resultant_peaks, half_window_size, len(df), prep.masked_rows(df, mask_column, key))
 
-        # Mark resultant peak locations in the *original* dataframe
-        # NOTE: the purpose of this is just to have these to use for plotting the data later
-        df['resultant_peaks'] = 0
-        df.loc[resultant_peaks, 'resultant_peaks'] = 1
+        # Mark resultant peak locations
+        # NOTE: the purpose of this is just to have these to use for plotting the data later (return_markers=True)
+        markers = {'resultant_peaks': _marker_column(len(df), resultant_peaks)}
 
         # Keep track of the total count of peaks found which will be used as a comparison to the count of absolute peaks (which should be the same)
         num_resultant_peaks = len(resultant_peaks)
@@ -285,7 +406,8 @@ def calc_avg_windowed_abs_peaks(dfs, resultant_column, columns, min_peak_height=
 
                 # Create a column for storing the locations of the absolute peaks
                 # NOTE: Just like above, the purpose of this is to be able plot the data later
-                df[f'{col}_windowed_abs_peak'] = 0
+                marker = np.zeros(len(df), dtype=np.int64)
+                values = df[col].to_numpy()
 
                 # Create a list to store the actual values of the highest peaks within the windows for the current column
                 windowed_abs_peak = []
@@ -298,12 +420,12 @@ def calc_avg_windowed_abs_peaks(dfs, resultant_column, columns, min_peak_height=
                     end = min(len(df) - 1, peak + half_window_size)
                     # Extracts the window of data from the current column using the indexes created above
                     # the plus 1 makes the end point inclusive
-                    window = df[col][start:end+1]
+                    window = values[start:end+1]
 
                     # Find peaks on the absolute values of the data within the window
                     # NOTE: peaks here corresponds to location of the peaks not their actual values
-                    peaks, properties = find_peaks(
-                        window.abs(), height=min_peak_height)
+                    peaks, properties = scipy_signal.find_peaks(
+                        np.abs(window), height=min_peak_height)
 
                     # Because multiple peaks may have been found I need to find the single *highest* one
                     if len(peaks) > 0:  # check if there are any peaks in the first place
@@ -315,17 +437,17 @@ def calc_avg_windowed_abs_peaks(dfs, resultant_column, columns, min_peak_height=
                         # Now I need to get the actual index of the highest peak *within the current window*
                         highest_peak_index_in_window = peaks[highest_peak_index]
 
-                        # Mark the absolute peak location in the original dataframe
+                        # Mark the absolute peak location
                         peak_indices = start + highest_peak_index_in_window
-                        df.loc[peak_indices, f'{col}_windowed_abs_peak'] = 1
+                        marker[peak_indices] = 1
 
                         # And finally, using this locaiton, grab the absolute peak height *value* in the window and append it the list
                         # NOTE: Need to first calculate abs() because the window represents the orginal values
                         windowed_abs_peak.append(
-                            abs(window.iloc[highest_peak_index_in_window]))
+                            abs(window[highest_peak_index_in_window]))
 
                 # Calculate average absolute peak values
-                avg_peak_value = np.mean(windowed_abs_peak)
+                avg_peak_value = np.mean(windowed_abs_peak, dtype=np.float64)
 
                 # Adding a row to the results table
                 results.append({
@@ -335,7 +457,8 @@ def calc_avg_windowed_abs_peaks(dfs, resultant_column, columns, min_peak_height=
                 })
 
                 # Adding a row to the peak count table
-                num_abs_peaks = df[f'{col}_windowed_abs_peak'].sum()
+                markers[f'{col}_windowed_abs_peak'] = marker
+                num_abs_peaks = marker.sum()
                 peak_counts.append({
                     'key': key,
                     'variable': col,
@@ -347,29 +470,37 @@ def calc_avg_windowed_abs_peaks(dfs, resultant_column, columns, min_peak_height=
             else:
                 warnings.warn(f"The column '{col}' does not exist in '{key}'")
 
-        # Replace the original dataframe with the modified one in the dictionary
-        dfs[key] = df
+        dfs_markers[key] = pd.DataFrame(markers, index=df.index)
 
     result_df = pd.DataFrame(results)
     peak_count_df = pd.DataFrame(peak_counts)
 
+    if return_markers:
+        return result_df, peak_count_df, dfs_markers
     return result_df, peak_count_df
 
 # Find negative peaks using a window determined by the RES peaks ----------------------------------------------------------
 
 
-def calc_avg_windowed_neg_peaks(dfs, resultant_column, columns, min_peak_height=1.0, min_samples_between_peaks=281, window_size=150):
+def calc_avg_windowed_neg_peaks(dfs, resultant_column, columns, min_peak_height=1.0, min_samples_between_peaks=281, window_size=150, min_secs_between_peaks=None, window_secs=None, sample_freq=None, mask_column=None, return_markers=False):
     """
     This function calculates the average negative peak acceleration for the specified columns in each dataframe in the input dictionary,
     within a window of 'window_size' samples centered around each peak in 'resultant_column'.
+    With mask_column (e.g. 'gap_mask' from prep.rebuild_time_base) resultant peaks whose window has any masked row
+    are left out.
+    The dfs passed in are not changed. With return_markers=True a dictionary of {key: df of 'resultant_peaks' and
+    the windowed peak columns (0/1) indicating the peak locations} is also returned (for plotting).
     """
+    min_samples_between_peaks = _samples_from_secs(
+        min_samples_between_peaks, min_secs_between_peaks, sample_freq)
+    window_size = _samples_from_secs(window_size, window_secs, sample_freq)
     results = []
     peak_counts = []
+    dfs_markers = {}
     half_window_size = window_size // 2
 
     for key in dfs.keys():
         df = dfs[key]
-        df.reset_index(drop=True, inplace=True)
 
         if resultant_column not in df.columns:
             warnings.warn(
@@ -378,13 +509,14 @@ def calc_avg_windowed_neg_peaks(dfs, resultant_column, columns, min_peak_height=
 
         # Find locations of resultant peaks
         # NOTE: resultant_peaks is an array with the index ie location of each peak
-        resultant_peaks, _ = find_peaks(
-            df[resultant_column], height=min_peak_height, distance=min_samples_between_peaks)
+        resultant_peaks, _ = scipy_signal.find_peaks(
+            df[resultant_column].to_numpy(), height=min_peak_height, distance=min_samples_between_peaks)
+        resultant_peaks = _unmasked_windows(
+            resultant_peaks, half_window_size, len(df), prep.masked_rows(df, mask_column, key))
 
-        # Mark resultant peak locations in the *original* dataframe
-        # NOTE: the purpose of this is just to have these to use for plotting the data later
-        df['resultant_peaks'] = 0
-        df.loc[resultant_peaks, 'resultant_peaks'] = 1
+        # Mark resultant peak locations
+        # NOTE: the purpose of this is just to have these to use for plotting the data later (return_markers=True)
+        markers = {'resultant_peaks': _marker_column(len(df), resultant_peaks)}
 
         # Keep track of the total count of peaks found which will be used as a comparison to the count of negative peaks (which should be the same)
         num_resultant_peaks = len(resultant_peaks)
@@ -394,7 +526,8 @@ def calc_avg_windowed_neg_peaks(dfs, resultant_column, columns, min_peak_height=
 
                 # Create a column for storing the locations of the negative peaks
                 # NOTE: Just like above, the purpose of this is to be able plot the data later
-                df[f'{col}_windowed_neg_peak'] = 0
+                marker = np.zeros(len(df), dtype=np.int64)
+                values = df[col].to_numpy()
 
                 # Create a list to store the actual values of the highest peaks within the windows for the current column
                 windowed_neg_peak = []
@@ -407,12 +540,12 @@ def calc_avg_windowed_neg_peaks(dfs, resultant_column, columns, min_peak_height=
                     end = min(len(df) - 1, peak + half_window_size)
                     # Extracts the window of data from the current column using the indexes created above
                     # the plus 1 makes the end point inclusive
-                    window = df[col][start:end+1]
+                    window = values[start:end+1]
 
                     # Find peaks on the negative values of the data within the window
                     # To do this I am just negating all the values
                     # NOTE: peaks here corresponds to location of the peaks not their actual values
-                    peaks, properties = find_peaks(
+                    peaks, properties = scipy_signal.find_peaks(
                         -window, height=min_peak_height)
 
                     # Because multiple peaks may have been found I need to find the single *highest* one
@@ -425,17 +558,17 @@ def calc_avg_windowed_neg_peaks(dfs, resultant_column, columns, min_peak_height=
                         # Now I need to get the actual index of the highest peak *within the current window*
                         highest_peak_index_in_window = peaks[highest_peak_index]
 
-                        # Mark the negative peak location in the original dataframe
+                        # Mark the negative peak location
                         peak_indices = start + highest_peak_index_in_window
-                        df.loc[peak_indices, f'{col}_windowed_neg_peak'] = 1
+                        marker[peak_indices] = 1
 
                         # And finally, using this locaiton, grab the negative peak height *value* in the window and append it the list
                         # NOTE: Need to first negate all the value because the window represents the orginal values
                         windowed_neg_peak.append(
-                            -window.iloc[highest_peak_index_in_window])
+                            -window[highest_peak_index_in_window])
 
                 # Calculate average negative peak values
-                avg_peak_value = np.mean(windowed_neg_peak)
+                avg_peak_value = np.mean(windowed_neg_peak, dtype=np.float64)
 
                 # Adding a row to the results table
                 results.append({
@@ -445,7 +578,8 @@ def calc_avg_windowed_neg_peaks(dfs, resultant_column, columns, min_peak_height=
                 })
 
                 # Adding a row to the peak count table
-                num_neg_peaks = df[f'{col}_windowed_neg_peak'].sum()
+                markers[f'{col}_windowed_neg_peak'] = marker
+                num_neg_peaks = marker.sum()
                 peak_counts.append({
                     'key': key,
                     'variable': col,
@@ -457,10 +591,11 @@ def calc_avg_windowed_neg_peaks(dfs, resultant_column, columns, min_peak_height=
             else:
                 warnings.warn(f"The column '{col}' does not exist in '{key}'")
 
-        # Replace the original dataframe with the modified one in the dictionary
-        dfs[key] = df
+        dfs_markers[key] = pd.DataFrame(markers, index=df.index)
 
     result_df = pd.DataFrame(results)
     peak_count_df = pd.DataFrame(peak_counts)
 
+    if return_markers:
+        return result_df, peak_count_df, dfs_markers
     return result_df, peak_count_df
@@ -0,0 +1,290 @@
+"""
+Functions for running the data prep -> measures chain as a pipeline of memoized stages
+ - Each stage is a function from the functions modules plus the parameters it is called with
+ - Stage outputs are cached on disk under a content hash of the stage inputs and parameters
+ - Changing a parameter (e.g. the filter cutoff) only reruns that stage and the ones after it
+ - Editing the module of a stage function (or a package module it uses) also reruns it
+"""
+# Packages
+import hashlib
+import importlib
+import inspect
+import os
+import pickle
+import sys
+import time
+import types
+import numpy as np
+import pandas as pd
+
+from ._lazy import LazyModule
+
+# Defining a stage ----------------------------------------------------------
+
+
+def make_stage(name, func, returns_dfs=False, **params):
+    """
+    Creates a single pipeline stage.
+
+    Arguments:
+    - name: a short, unique name for the stage (used in the timing table and the results dictionary).
+    - func: the function to run. It is called as func(dfs, **params).
+    - returns_dfs: set to True for functions that return a *new* dictionary of dfs instead of modifying the
+      one passed in (e.g. stride.calc_stride_times). If the function returns a tuple, the first item is used as
+      the new dfs and the rest is kept as the stage result (e.g. stats.remove_outliers).
+    - params: the keyword arguments passed to func.
+
+    Example:
+    make_stage('filter', prep.apply_butter_lowpass_filter_to_dfs, columns=['res_g'], fs=1125, cutoff=50, order=4)
+    """
+    return {
+        'name': name,
+        'func': func,
+        'returns_dfs': returns_dfs,
+        'params': params,
+    }
+
+# Content hashing ----------------------------------------------------------
+
+
+def _update_hash(h, obj):
+    """
+    Feeds an object into a hashlib object in a way that is stable between sessions.
+    DataFrames/Series are hashed on their values, index, column names and dtypes (not their memory address).
+    """
+    if isinstance(obj, pd.DataFrame):
+        h.update(b'DataFrame')
+        h.update(repr(list(obj.columns)).encode())
+        h.update(repr([str(dtype) for dtype in obj.dtypes]).encode())
+        h.update(pd.util.hash_pandas_object(obj, index=True).values.tobytes())
+    elif isinstance(obj, pd.Series):
+        h.update(b'Series')
+        h.update(repr(obj.name).encode())
+        h.update(str(obj.dtype).encode())
+        h.update(pd.util.hash_pandas_object(obj, index=True).values.tobytes())
+    elif isinstance(obj, np.ndarray):
+        h.update(b'ndarray')
+        h.update(str(obj.dtype).encode())
+        h.update(repr(obj.shape).encode())
+        h.update(np.ascontiguousarray(obj).tobytes())
+    elif isinstance(obj, dict):
+        h.update(b'dict')
+        for key in sorted(obj.keys(), key=repr):
+            h.update(repr(key).encode())
+            _update_hash(h, obj[key])
+    elif isinstance(obj, (list, tuple)):
+        h.update(type(obj).__name__.encode())
+        for item in obj:
+            _update_hash(h, item)
+    elif callable(obj):
+        # Functions are identified by their name *and* their source code. For functions of this package that is the
+        # source of their module and every package module it uses (e.g. butter_lowpass_filter for
+        # apply_butter_lowpass_filter_to_dfs, or precision for data_prep), so editing a helper a stage calls
+        # invalidates the cached stage too
+        module_name = getattr(obj, '__module__', '') or ''
+        h.update(f'{module_name}.{getattr(obj, "__qualname__", repr(obj))}'.encode())
+        if module_name.split('.')[0] == __package__.split('.')[0]:
+            h.update(_package_source_hash(module_name).encode())
+        else:
+            try:
+                h.update(inspect.getsource(obj).encode())
+            except (OSError, TypeError):
+                pass
+    else:
+        h.update(repr(obj).encode())
+
+
+def _package_modules_used(module_name):
+    # Package modules a module imports (as modules, lazily with _lazy.lazy_module or 'from .x import y'), including
+    # itself
+    package = __package__.split('.')[0]
+    found = set()
+    to_visit = [module_name]
+    while to_visit:
+        name = to_visit.pop()
+        if name in found:
+            continue
+        found.add(name)
+        module = importlib.import_module(name)
+        for value in vars(module).values():
+            if isinstance(value, types.ModuleType):
+                used = value.__name__
+            elif isinstance(value, LazyModule):
+                used = value.__dict__['_name']
+            elif isinstance(value, (types.FunctionType, type)):
+                used = value.__module__
+            else:
+                continue
+            if used.split('.')[0] == package:
+                to_visit.append(used)
+    return sorted(found)
+
+
+def _package_source_hash(module_name):
+    """
+    Hash of the source files of a package module and every package module it uses.
+    """
+    h = hashlib.sha256()
+    for name in _package_modules_used(module_name):
+        file_path = getattr(sys.modules[name], '__file__', None)
+        if file_path is None:
+            continue
+        h.update(name.encode())
+        with open(file_path, 'rb') as f:
+            h.update(f.read())
+    return h.hexdigest()
+
+
+def hash_dfs(dfs):
+    """
+    Returns a hex digest of the content of a dictionary of DataFrames.
+    """
+    h = hashlib.sha256()
+    _update_hash(h, dfs)
+    return h.hexdigest()
+
+
+def _stage_hash(input_hash, stage):
+    """
+    The hash of a stage combines the hash of its input with the function and parameters of the stage.
+    Because the input of a stage is the output of the stage before it, chaining the hashes is equivalent to
+    hashing the actual input content (without having to hash every intermediate dictionary of dfs).
+    """
+    h = hashlib.sha256()
+    h.update(input_hash.encode())
+    _update_hash(h, stage['func'])
+    _update_hash(h, stage['returns_dfs'])
+    _update_hash(h, stage['params'])
+    return h.hexdigest()
+
+# Cache files ----------------------------------------------------------
+
+
+def _cache_paths(cache_dir, stage_name, stage_hash):
+    base = os.path.join(cache_dir, f'{stage_name}_{stage_hash[:16]}')
+    return base + '_dfs.pkl', base + '_result.pkl'
+
+
+def _write_pickle(obj, file_path):
+    # Write to a temporary file first so that an interrupted run never leaves a half written cache file behind
+    tmp_path = file_path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        pickle.dump(obj, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, file_path)
+
+
+def _read_pickle(file_path):
+    with open(file_path, 'rb') as f:
+        return pickle.load(f)
+
+# Run the pipeline ----------------------------------------------------------
+
+
+def run_pipeline(dfs, stages, cache_dir='cache/pipeline', use_cache=True):
+    """
+    Runs an ordered list of stages (see make_stage) on a dictionary of DataFrames.
+
+    Arguments:
+    - dfs: a dictionary of pandas dataframes (e.g. the output of file_import_gui.read_csv_files_gui).
+    - stages: a list of stages in the order they should run.
+    - cache_dir: folder where the output of each stage is stored.
+    - use_cache: set to False to bypass the cache: every stage is run and nothing is read from or written to the cache
+      (whatever is already cached is left as it is).
+
+    The first stage hash comes from the content of 'dfs'; every later stage hash comes from the hash before it plus
+    the function and parameters of the stage. On a rerun, the longest run of stages from the start that are already
+    cached is loaded from disk and only the stages after it are recomputed. So changing the filter cutoff only reruns
+    the filter stage and the stages after it.
+
+    NOTE: most of the functions in this package modify the dfs passed to them, so always use the dfs that are
+    returned here (a cached stage is loaded from disk and does not touch the dfs passed in).
+
+    Returns:
+    - dfs: the dictionary of DataFrames after the last stage.
+    - results: a dictionary of stage name -> whatever the stage function returned (None for most data prep functions).
+    - timing_df: a table with one row per stage (stage, hash, cached, wall_time_s, load_time_s).
+    """
+    names = [stage['name'] for stage in stages]
+    if len(set(names)) != len(names):
+        raise ValueError('Each stage needs a unique name.')
+
+    if use_cache and not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+
+    # Hash of each stage (only depends on the input content and the stage definitions, so it can be done up front)
+    stage_hashes = []
+    previous_hash = hash_dfs(dfs)
+    for stage in stages:
+        previous_hash = _stage_hash(previous_hash, stage)
+        stage_hashes.append(previous_hash)
+
+    # Find the last stage that can be loaded from the cache
+    # NOTE: every stage up to it needs a cached result so the results dictionary is complete
+    last_cached = -1
+    if use_cache:
+        for i, stage in enumerate(stages):
+            dfs_path, result_path = _cache_paths(
+                cache_dir, stage['name'], stage_hashes[i])
+            if not os.path.exists(result_path):
+                break
+            if os.path.exists(dfs_path):
+                last_cached = i
+
+    results = {}
+    timings = []
+
+    # Load cached stages
+    for i in range(last_cached + 1):
+        stage = stages[i]
+        dfs_path, result_path = _cache_paths(
+            cache_dir, stage['name'], stage_hashes[i])
+
+        start = time.perf_counter()
+        cached = _read_pickle(result_path)
+        if i == last_cached:
+            dfs = _read_pickle(dfs_path)
+        load_time = time.perf_counter() - start
+
+        results[stage['name']] = cached['result']
+        timings.append({
+            'stage': stage['name'],
+            'hash': stage_hashes[i][:16],
+            'cached': True,
+            'wall_time_s': cached['wall_time_s'],
+            'load_time_s': load_time,
+        })
+
+    # Run the remaining stages
+    for i in range(last_cached + 1, len(stages)):
+        stage = stages[i]
+
+        start = time.perf_counter()
+        output = stage['func'](dfs, **stage['params'])
+        wall_time = time.perf_counter() - start
+
+        if stage['returns_dfs']:
+            if isinstance(output, tuple):
+                dfs = output[0]
+                output = output[1] if len(output) == 2 else output[1:]
+            else:
+                dfs = output
+                output = None
+
+        results[stage['name']] = output
+        timings.append({
+            'stage': stage['name'],
+            'hash': stage_hashes[i][:16],
+            'cached': False,
+            'wall_time_s': wall_time,
+            'load_time_s': 0.0,
+        })
+
+        if use_cache:
+            dfs_path, result_path = _cache_paths(
+                cache_dir, stage['name'], stage_hashes[i])
+            _write_pickle(dfs, dfs_path)
+            _write_pickle(
+                {'result': output, 'wall_time_s': wall_time}, result_path)
+
+    timing_df = pd.DataFrame(timings)
+    return dfs, results, timing_df
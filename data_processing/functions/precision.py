@@ -0,0 +1,113 @@
+"""
+Functions for choosing the floating point precision of the IMU signals
+ - float64 (default): same as before
+ - float32: loaders parse sensor columns straight to float32 and the data prep / RMS functions keep float32
+
+The Blue Trident accelerometer data has nowhere near the 53 bits of precision of float64, so float32 halves the memory
+(and the memory bandwidth) of every signal column. Sums that need it (means, RMS, DFA, sample entropy) still
+accumulate in float64. Time columns are always kept as float64 (float32 can't hold timestamps to the sample).
+"""
+# Packages
+import re
+import numpy as np
+
+# Precision setting ----------------------------------------------------------
+
+
+_settings = {'float_dtype': np.dtype(np.float64)}
+
+# Columns matching this are time columns and always stay float64
+TIME_COLUMN_PATTERN = re.compile(r'time', re.IGNORECASE)
+
+
+def set_precision(precision):
+    """
+    Sets the precision used by the loaders: 'float32' or 'float64'.
+    """
+    if precision not in ('float32', 'float64'):
+        raise ValueError("precision must be 'float32' or 'float64'")
+    _settings['float_dtype'] = np.dtype(precision)
+
+
+def get_float_dtype():
+    return _settings['float_dtype']
+
+
+def is_time_column(column):
+    return bool(TIME_COLUMN_PATTERN.search(str(column)))
+
+# Casting ----------------------------------------------------------
+
+
+def float_column_dtypes(columns_and_dtypes, dtype=None):
+    """
+    Returns a {column: dtype} mapping for the float columns that should use the selected precision
+    (for passing to pd.read_csv(dtype=...)). Time columns are left out so they stay float64.
+    """
+    dtype = np.dtype(dtype) if dtype is not None else get_float_dtype()
+    return {column: dtype for column, column_dtype in columns_and_dtypes
+            if np.issubdtype(column_dtype, np.floating) and not is_time_column(column)}
+
+
+def cast_float_columns(dfs, dtype=None):
+    """
+    Casts the float (non-time) columns of each DataFrame in the dictionary to 'dtype' (default: the selected precision).
+    """
+    for key in dfs.keys():
+        df = dfs[key]
+        mapping = float_column_dtypes(df.dtypes.items(), dtype)
+        mapping = {column: column_dtype for column, column_dtype in mapping.items()
+                   if df[column].dtype != column_dtype}
+        if mapping:
+            dfs[key] = df.astype(mapping)
+
+
+def same_float_dtype(value, series):
+    """
+    Returns 'value' as a scalar of the series' float dtype, so arithmetic with a float64 result
+    (e.g. a mean accumulated in float64) doesn't upcast a float32 column.
+    """
+    if np.issubdtype(series.dtype, np.floating):
+        return series.dtype.type(value)
+    return value
+
+# Float32 vs float64 report ----------------------------------------------------------
+
+
+def precision_report(process_func, dfs, key_column='key', variable_column='variable', value_column='value'):
+    """
+    Runs the same processing in float64 and float32 and reports the difference for every exported variable.
+
+    Arguments:
+    - process_func: a function that takes a dictionary of dfs and returns a long table (key, variable, value),
+      e.g. lambda dfs: back.apply_rms_to_dfs(dfs, ['res_m/s/s']) after running the data prep functions on dfs.
+    - dfs: the raw dictionary of DataFrames (not modified, each precision gets its own deep copy).
+
+    Returns a table with one row per key/variable: value_float64, value_float32, abs_diff and rel_diff
+    (abs_diff / |value_float64|).
+    """
+    results = {}
+    for precision in ('float64', 'float32'):
+        dfs_copy = {key: df.copy(deep=True) for key, df in dfs.items()}
+        cast_float_columns(dfs_copy, precision)
+        results[precision] = process_func(dfs_copy)
+
+    report = results['float64'].merge(
+        results['float32'], on=[key_column, variable_column], how='outer', suffixes=('_float64', '_float32'))
+    report = report.rename(columns={
+        f'{value_column}_float64': 'value_float64',
+        f'{value_column}_float32': 'value_float32',
+    })
+    value_64 = report['value_float64'].astype(np.float64)
+    value_32 = report['value_float32'].astype(np.float64)
+    report['abs_diff'] = (value_32 - value_64).abs()
+    report['rel_diff'] = report['abs_diff'] / value_64.abs()
+
+    return report
+
+
+def dfs_memory_bytes(dfs):
+    """
+    Total memory of a dictionary of DataFrames (useful for checking the float32 saving).
+    """
+    return int(sum(df.memory_usage(deep=True).sum() for df in dfs.values()))
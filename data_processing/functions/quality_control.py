@@ -0,0 +1,193 @@
+"""
+Data quality checks for the IMU runs, run before the expensive stages (filtering, peaks, sample entropy)
+
+For every run a few vectorized passes over the time and acceleration columns find:
+ - short runs (fewer rows than 5 mins, what crop_df_five_mins warns about)
+ - dropped samples: gaps between time stamps longer than QC_LIMITS['gap_factor'] x the usual sample spacing
+ - non-monotonic time: time stamps that go backwards or repeat
+ - duplicate rows
+ - NaNs in the time and acceleration columns
+ - saturation: acceleration at the low-g sensor limit (+-16 g)
+
+qc_report gives one row per run with the counts, a pass/fail status and the reasons it failed.
+quarantine_files moves the files of failing runs out of the data folders so the cohort_cli jobs don't pick them up.
+
+Example:
+    dfs, filenames = gui.read_csv_files_from_dir('data/five_min_runs/run014/lowg_1125hz/back')
+    qc_df = qc.qc_report(dfs, sample_freq=1125, accel_columns=['ax_m/s/s', 'ay_m/s/s', 'az_m/s/s'])
+
+Read only: the dfs passed in are not modified.
+"""
+# Packages
+import os
+import shutil
+import warnings
+import numpy as np
+import pandas as pd
+
+G = 9.80665
+
+# A run fails when it is over any of these limits
+QC_LIMITS = {
+    'gap_factor': 1.5,                  # a time step over 1.5 x the usual one is a gap
+    'max_dropped_fraction': 0.01,       # dropped samples / expected samples
+    'max_gap_s': 1.0,                   # longest gap
+    'max_non_monotonic': 0,             # time steps <= 0
+    'max_duplicate_rows': 0,
+    'max_nan_fraction': 0.001,          # rows with a NaN in the time or acceleration columns
+    'max_saturated_fraction': 0.001,    # samples at the saturation limit (any axis)
+    'min_secs': 5 * 60,                 # shorter runs fail (same 5 mins as crop_df_five_mins)
+}
+
+# Checks ----------------------------------------------------------
+
+
+def time_checks(time, sample_freq, gap_factor=1.5):
+    """
+    Gaps and non-monotonic steps of a time column (secs).
+
+    The usual spacing is the median time step, so the checks also work if the sample rate is a bit off.
+    Returns a dictionary of the counts.
+    """
+    time = np.asarray(time, dtype=np.float64)
+    steps = np.diff(time)
+    finite = np.isfinite(steps)
+    usual_step = np.median(steps[finite & (steps > 0)]) if np.any(finite & (steps > 0)) else 1 / sample_freq
+
+    gaps = finite & (steps > gap_factor * usual_step)
+    return {
+        'measured_freq': 1 / usual_step,
+        'n_gaps': int(gaps.sum()),
+        'dropped_samples': int(np.round(steps[gaps] / usual_step).sum() - gaps.sum()),
+        'max_gap_s': float(steps[gaps].max()) if gaps.any() else 0.0,
+        'n_backwards': int((finite & (steps < 0)).sum()),
+        'n_repeated': int((steps == 0).sum()),
+    }
+
+
+def saturation_counts(values, limit, tolerance=0.001):
+    """
+    Samples of each column (rows x columns array) at or over +-limit.
+    The sensors clip a little under their limit, so anything within 'tolerance' (fraction) of it counts.
+    """
+    return (np.abs(values) >= limit * (1 - tolerance)).sum(axis=0)
+
+
+def check_run(df, sample_freq, time_column='time_s', accel_columns=('ax_m/s/s', 'ay_m/s/s', 'az_m/s/s'),
+              saturation_g=16, accel_units='m/s/s', gap_factor=1.5):
+    """
+    All the checks of one run. Returns a dictionary of the counts (see qc_report).
+    """
+    accel = df[list(accel_columns)].to_numpy(dtype=np.float64)
+    time = df[time_column].to_numpy(dtype=np.float64)
+
+    nan_rows = np.isnan(accel).any(axis=1) | np.isnan(time)
+    limit = saturation_g * G if accel_units == 'm/s/s' else saturation_g
+    saturated = saturation_counts(accel, limit)
+
+    return {
+        'rows': len(df),
+        'secs': len(df) / sample_freq,
+        **time_checks(time, sample_freq, gap_factor=gap_factor),
+        'duplicate_rows': int(df.duplicated().sum()),
+        'nan_rows': int(nan_rows.sum()),
+        'saturated_samples': int(saturated.sum()),
+        'max_abs_accel': float(np.nanmax(np.abs(accel))) if accel.size and not np.isnan(accel).all() else np.nan,
+    }
+
+
+def qc_failures(checks, limits=None):
+    """
+    Reasons a run fails (empty list if it passes) from its check_run counts.
+    """
+    limits = {**QC_LIMITS, **(limits or {})}
+    rows = max(checks['rows'], 1)
+    expected_samples = checks['rows'] + checks['dropped_samples']
+
+    failures = []
+    if checks['secs'] < limits['min_secs']:
+        failures.append(f"short run ({checks['secs']:.0f} secs)")
+    if checks['dropped_samples'] / max(expected_samples, 1) > limits['max_dropped_fraction']:
+        failures.append(f"{checks['dropped_samples']} dropped samples")
+    if checks['max_gap_s'] > limits['max_gap_s']:
+        failures.append(f"{checks['max_gap_s']:.2f} sec gap")
+    if checks['n_backwards'] + checks['n_repeated'] > limits['max_non_monotonic']:
+        failures.append(f"non-monotonic time ({checks['n_backwards']} backwards, {checks['n_repeated']} repeated)")
+    if checks['duplicate_rows'] > limits['max_duplicate_rows']:
+        failures.append(f"{checks['duplicate_rows']} duplicate rows")
+    if checks['nan_rows'] / rows > limits['max_nan_fraction']:
+        failures.append(f"{checks['nan_rows']} rows with NaNs")
+    if checks['saturated_samples'] / rows > limits['max_saturated_fraction']:
+        failures.append(f"{checks['saturated_samples']} saturated samples")
+    return failures
+
+# Quality report ----------------------------------------------------------
+
+
+def qc_report(dfs, sample_freq, time_column='time_s', accel_columns=('ax_m/s/s', 'ay_m/s/s', 'az_m/s/s'),
+              saturation_g=16, accel_units='m/s/s', limits=None):
+    """
+    This function checks the data quality of each run before processing.
+
+    Arguments:
+    - dfs: a dictionary of dataframes (raw runs, before cropping).
+    - sample_freq: sample rate (hz).
+    - time_column: time column (secs), default is 'time_s' (ch.3 files use 'timestamp').
+    - accel_columns: acceleration columns checked for NaNs and saturation.
+    - saturation_g: sensor range (g), default is the +-16 g of the low-g accelerometer.
+    - accel_units: 'm/s/s' or 'g' (units of the acceleration columns).
+    - limits: optional dictionary overriding values of QC_LIMITS.
+
+    If a column does not exist in a dataframe, a warning message is issued and the run fails.
+
+    The function returns a dataframe with one row per run: key, the counts of check_run, status ('pass' or 'fail')
+    and reasons (why it failed).
+    """
+    limits = {**QC_LIMITS, **(limits or {})}
+
+    rows = []
+    for key, df in dfs.items():
+        missing = [col for col in [time_column] + list(accel_columns) if col not in df.columns]
+        for col in missing:
+            warnings.warn(f"The column '{col}' does not exist in '{key}'")
+        if missing:
+            rows.append({'key': key, 'rows': len(df), 'status': 'fail',
+                         'reasons': 'missing columns: ' + ', '.join(missing)})
+            continue
+
+        checks = check_run(df, sample_freq, time_column=time_column, accel_columns=accel_columns,
+                           saturation_g=saturation_g, accel_units=accel_units, gap_factor=limits['gap_factor'])
+        failures = qc_failures(checks, limits)
+        rows.append({'key': key, **checks, 'status': 'fail' if failures else 'pass', 'reasons': '; '.join(failures)})
+
+    return pd.DataFrame(rows)
+
+# Quarantine ----------------------------------------------------------
+
+
+def quarantine_files(qc_df, file_paths, quarantine_dir):
+    """
+    Moves the files of the runs that failed QC into 'quarantine_dir' (keeping the folders they were in below it)
+    and writes why next to each of them ('{file}.qc.txt').
+
+    Arguments:
+    - qc_df: output of qc_report.
+    - file_paths: {key: file path} of the runs in qc_df.
+    - quarantine_dir: folder to move them to.
+
+    Returns a list of the new file paths.
+    """
+    moved = []
+    for _, row in qc_df[qc_df['status'] == 'fail'].iterrows():
+        file_path = file_paths[row['key']]
+        relative_path = os.path.relpath(os.path.abspath(file_path)).lstrip(os.sep)
+        if relative_path.startswith('..'):
+            relative_path = os.path.basename(file_path)
+        new_path = os.path.join(quarantine_dir, relative_path)
+        os.makedirs(os.path.dirname(new_path), exist_ok=True)
+        shutil.move(file_path, new_path)
+        with open(new_path + '.qc.txt', 'w') as f:
+            f.write(f"{row['reasons']}\n")
+        moved.append(new_path)
+        print(f"Quarantined '{file_path}': {row['reasons']}")
+    return moved
@@ -0,0 +1,316 @@
+"""
+Memory-aware scheduling of the cohort_cli jobs
+
+A 1125-1600hz run with all the derived columns can take GBs, so running one job per CPU can run out of memory
+(and fewer workers leave CPUs idle). This scheduler:
+ - estimates the peak memory (RSS) of each job from its input files (size and number of columns, or the index of a
+   .imuz archive), its sample rate
+   and the stages its pipeline runs (see PIPELINE_STAGES)
+ - only starts a job while the projected RSS (this process + the estimates of the running jobs) stays under the
+   budget, biggest jobs first
+ - measures the real peak RSS of each job and saves it with the prediction in a history file (JSON), so later
+   estimates of the same pipeline are corrected by how far off the earlier ones were
+
+Each job runs in a fresh worker process (max_tasks_per_child=1), so its peak RSS is its own and memory kept by
+one job doesn't carry over to the next. A worker killed for running out of memory only fails the jobs running at
+the time (they are kept in the history with the error), the rest carry on in a new pool.
+
+Example:
+    python -m functions.cohort_cli cohort.json --workers 8 --memory-budget 12GB
+"""
+# Packages
+import json
+import os
+import threading
+import time
+import warnings
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from concurrent.futures.process import BrokenProcessPool
+import numpy as np
+import psutil
+
+from . import file_import_gui as gui
+from . import imu_archive
+
+# Memory model ----------------------------------------------------------
+
+
+# Float columns each stage adds to every df (on top of the columns read from the CSV file)
+STAGE_COLUMNS = {
+    'prep': 6,              # res_m/s/s, ax_g, ay_g, az_g, res_g, time_s_scaled
+    'peaks': 2,             # peak indices/values and the thresholded copy
+    'mean_shift': 8,        # mean shifted accel and g columns and their resultants
+    'filter': 18,           # filtered raw and mean shifted columns
+    'control_entropy': 2,   # windows of the entropy column
+}
+
+# Stages each cohort_cli pipeline runs
+PIPELINE_STAGES = {
+    'ch3_tibia': ['prep', 'peaks'],
+    'ch3_low_back': ['prep', 'mean_shift', 'filter', 'peaks'],
+    'ch4_control_entropy': ['prep', 'control_entropy'],
+}
+
+# RSS of a worker that has imported cohort_cli and pandas but done nothing yet
+WORKER_BASE_BYTES = 100 * 1024**2
+# pandas keeps about this many copies of a df while adding columns (df.assign, .copy() in the prep functions)
+COPY_FACTOR = 2
+# read_csv needs about this many bytes on top of the parsed df for every byte of text
+READ_FACTOR = 1
+# Only the 5 min crop is processed (prep.crop_df_five_mins)
+RUN_SECS = 5 * 60
+# Bytes read from the start of each file to work out its columns and bytes per row
+SNIFF_BYTES = 64 * 1024
+
+# Estimates are corrected with this quantile of (measured / predicted) over the last HISTORY_WINDOW jobs of a
+# pipeline, once there are at least MIN_HISTORY of them
+HISTORY_WINDOW = 20
+MIN_HISTORY = 3
+CORRECTION_QUANTILE = 0.9
+MAX_HISTORY = 1000
+
+
+def csv_shape(file_path):
+    """
+    Estimated (rows, columns) of a CSV file from its size and the first SNIFF_BYTES, without reading it all.
+    """
+    with open(file_path, 'rb') as f:
+        head = f.read(SNIFF_BYTES)
+    lines = head.splitlines()
+    if not lines:
+        return 0, 0
+    n_columns = len(lines[0].split(b','))
+    # The last line read is probably cut off
+    data_lines = lines[1:-1] if len(lines) > 2 else lines[1:]
+    if not data_lines:
+        return 0, n_columns
+    bytes_per_row = np.mean([len(line) + 1 for line in data_lines])
+    rows = (os.path.getsize(file_path) - len(lines[0]) - 1) / bytes_per_row
+    return int(rows), n_columns
+
+
+def data_file_shape(file_path):
+    """
+    (rows, columns) of a CSV file (estimated, csv_shape) or a .imuz archive (from its index).
+    """
+    if file_path.lower().endswith(imu_archive.ARCHIVE_EXTENSION):
+        info = imu_archive.archive_info(file_path)
+        return info['n_rows'], len(info['columns'])
+    return csv_shape(file_path)
+
+
+def _job_files(job):
+    # {sensor: [data file paths]} (same files as cohort_cli.job_fingerprint)
+    files = {}
+    for sensor, directory in job['input_dirs'].items():
+        if os.path.isdir(directory):
+            files[sensor] = gui.data_files_in_dir(directory)
+    return files
+
+
+def predict_job_bytes(job):
+    """
+    Peak RSS (bytes) of a cohort_cli job from the memory model, before any correction from the history.
+
+    The sensors of a job are processed one after the other, so the peak is that of the biggest sensor:
+    every file of the sensor read at once (read_csv text + the parsed columns), then the 5 min crop with the
+    columns added by each stage of the pipeline.
+    """
+    sample_rate = job['params']['sample_rate']
+    added_columns = sum(STAGE_COLUMNS[stage]
+                        for stage in PIPELINE_STAGES.get(job['pipeline'], STAGE_COLUMNS))
+
+    peak = 0
+    for file_paths in _job_files(job).values():
+        read_bytes = 0
+        processed_bytes = 0
+        for file_path in file_paths:
+            rows, n_columns = data_file_shape(file_path)
+            # read_csv also needs memory for the text (archives are decompressed a chunk at a time)
+            text_bytes = 0 if file_path.lower().endswith(imu_archive.ARCHIVE_EXTENSION) else os.path.getsize(file_path)
+            read_bytes += READ_FACTOR * text_bytes + rows * n_columns * 8
+            rows_kept = min(rows, RUN_SECS * sample_rate)
+            processed_bytes += rows_kept * (n_columns + added_columns) * 8 * COPY_FACTOR
+        peak = max(peak, read_bytes, processed_bytes)
+
+    return WORKER_BASE_BYTES + peak
+
+# History ----------------------------------------------------------
+
+
+def load_history(file_path):
+    if file_path is None or not os.path.exists(file_path):
+        return []
+    with open(file_path) as f:
+        return json.load(f)
+
+
+def save_history(history, file_path):
+    output_dir = os.path.dirname(file_path)
+    if output_dir and not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    with open(file_path, 'w') as f:
+        json.dump(history[-MAX_HISTORY:], f, indent=2)
+
+
+def correction_factor(history, pipeline):
+    """
+    How much to scale the model's estimates for 'pipeline' by, from the measured / predicted peak RSS of its
+    last HISTORY_WINDOW jobs (1 until there are MIN_HISTORY of them).
+    """
+    # Failed jobs have no measured peak (peak_mb is None)
+    ratios = [record['peak_mb'] / record['predicted_mb'] for record in history
+              if record['pipeline'] == pipeline and record['predicted_mb'] > 0
+              and record.get('peak_mb') is not None][-HISTORY_WINDOW:]
+    if len(ratios) < MIN_HISTORY:
+        return 1.0
+    return float(np.quantile(ratios, CORRECTION_QUANTILE))
+
+
+def estimate_job_bytes(job, history=()):
+    """
+    Peak RSS (bytes) expected for a job: the memory model corrected by the history of its pipeline.
+    """
+    return predict_job_bytes(job) * correction_factor(history, job['pipeline'])
+
+# Budget ----------------------------------------------------------
+
+
+UNITS = {'kb': 1024, 'mb': 1024**2, 'gb': 1024**3, 'tb': 1024**4}
+
+
+def parse_memory(value):
+    """
+    Memory budget in bytes from '12GB', '500MB', '0.5TB' or a plain number of MB.
+    'auto' is 80% of the memory available now.
+    """
+    text = str(value).strip().lower()
+    if text == 'auto':
+        return int(psutil.virtual_memory().available * 0.8)
+    for unit, size in UNITS.items():
+        if text.endswith(unit):
+            return int(float(text[:-len(unit)]) * size)
+    return int(float(text) * UNITS['mb'])
+
+# Peak RSS of a job ----------------------------------------------------------
+
+
+def measure_peak_rss(fn, arg, interval_s=0.05):
+    """
+    Runs fn(arg) while sampling the RSS of this process in a background thread.
+    Returns (result, peak RSS in bytes).
+    """
+    process = psutil.Process()
+    peak = [process.memory_info().rss]
+    stop = threading.Event()
+
+    def sample():
+        while not stop.wait(interval_s):
+            peak[0] = max(peak[0], process.memory_info().rss)
+
+    sampler = threading.Thread(target=sample, daemon=True)
+    sampler.start()
+    try:
+        result = fn(arg)
+    finally:
+        stop.set()
+        sampler.join()
+    return result, max(peak[0], process.memory_info().rss)
+
+# Scheduler ----------------------------------------------------------
+
+
+def _history_record(job, predicted, estimate, start, peak_rss=None, error=None):
+    record = {
+        'job_id': job['job_id'],
+        'pipeline': job['pipeline'],
+        'sample_rate': job['params']['sample_rate'],
+        'input_mb': round(sum(os.path.getsize(file_path) for file_paths in _job_files(job).values()
+                              for file_path in file_paths) / 1024**2, 1),
+        'predicted_mb': round(predicted / 1024**2, 1),
+        'estimated_mb': round(estimate / 1024**2, 1),
+        # Unknown for a job that failed (e.g. its worker was killed for running out of memory)
+        'peak_mb': None if peak_rss is None else round(peak_rss / 1024**2, 1),
+        'secs': round(time.perf_counter() - start, 1),
+    }
+    if error is not None:
+        record['error'] = f'{type(error).__name__}: {error}'
+    return record
+
+
+def run_within_budget(jobs, fn, memory_budget, workers=None, history_file=None):
+    """
+    Runs fn(job) for every job in worker processes, starting a job only while the projected RSS stays under
+    'memory_budget' (bytes).
+
+    Arguments:
+    - jobs: list of cohort_cli jobs.
+    - fn: function run on each job (must be importable by the workers, e.g. cohort_cli.run_job).
+    - memory_budget: bytes for this process and all running jobs together (parse_memory).
+    - workers: most jobs running at once (default: number of CPUs).
+    - history_file: JSON file of the measured vs. predicted peak RSS of earlier jobs. It corrects the estimates
+      and the jobs run here (failed ones too) are added to it, even if the run stops early.
+
+    A job estimated to need more than the whole budget is run on its own, with a warning.
+    If a worker dies (e.g. killed by the OS for running out of memory) the jobs running in the pool fail and the
+    rest carry on in a new pool.
+
+    Yields (job, result, error) as the jobs finish (error is None unless fn raised or its worker died).
+    """
+    workers = workers or os.cpu_count()
+    history = load_history(history_file)
+
+    # Biggest first so the small jobs fill in around them
+    predicted = {id(job): predict_job_bytes(job) for job in jobs}
+    estimates = {id(job): predicted[id(job)] * correction_factor(history, job['pipeline']) for job in jobs}
+    pending = sorted(jobs, key=lambda job: estimates[id(job)], reverse=True)
+    main_rss = psutil.Process().memory_info().rss
+
+    def new_pool():
+        return ProcessPoolExecutor(max_workers=workers, max_tasks_per_child=1)
+
+    running = {}
+    executor = new_pool()
+    try:
+        while pending or running:
+            in_use = main_rss + sum(estimates[id(job)] for job, _, _ in running.values())
+            for job in list(pending):
+                if len(running) >= workers:
+                    break
+                estimate = estimates[id(job)]
+                if in_use + estimate > memory_budget and running:
+                    continue
+                if in_use + estimate > memory_budget:
+                    warnings.warn(f"{job['pipeline']} {job['job_id']} is estimated to need "
+                                  f"{estimate / 1024**2:.0f} MB, more than the memory budget. Running it on its own.")
+                try:
+                    future = executor.submit(measure_peak_rss, fn, job)
+                except BrokenProcessPool:
+                    # Broke since the last check, the jobs running in it fail when their futures are collected
+                    executor.shutdown(wait=False, cancel_futures=True)
+                    executor = new_pool()
+                    future = executor.submit(measure_peak_rss, fn, job)
+                pending.remove(job)
+                running[future] = (job, time.perf_counter(), executor)
+                in_use += estimate
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                job, start, job_executor = running.pop(future)
+                try:
+                    result, peak_rss = future.result()
+                except Exception as e:
+                    history.append(_history_record(job, predicted[id(job)], estimates[id(job)], start, error=e))
+                    if isinstance(e, BrokenProcessPool) and job_executor is executor:
+                        warnings.warn(f"A worker died while running {job['pipeline']} {job['job_id']} "
+                                      "(out of memory?). Carrying on in a new worker pool.")
+                        executor.shutdown(wait=False, cancel_futures=True)
+                        executor = new_pool()
+                    yield job, None, e
+                    continue
+                history.append(_history_record(job, predicted[id(job)], estimates[id(job)], start, peak_rss))
+                yield job, result, None
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+        if history_file is not None:
+            save_history(history, history_file)
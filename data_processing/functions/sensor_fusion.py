@@ -0,0 +1,176 @@
+"""
+Functions for fusing the low-g and high-g accelerometer streams of the IMeasureU Blue Trident sensors
+ - low-g: 1125hz, +/- 16 g, better resolution (and the gyroscope)
+ - high-g: 1600hz, +/- 200 g, coarser resolution
+
+At the tibia the low-g accelerometer clips on hard foot strikes, so peak impact values from the low-g stream alone are
+too low whenever it saturates. The fused signal uses the low-g stream everywhere except around saturated samples,
+where the high-g values are used instead.
+
+Steps for each pair of runs:
+1) Pair the low-g and high-g dfs of the same run by key (e.g. 'run014_light_prs_pre_00917_lowg' and '..._highg')
+2) Resample both streams to a common rate with a polyphase filter (scipy resample_poly, all columns in one call)
+3) Put both on one time grid covering the time both streams recorded (sensor timestamps, time_s)
+4) Replace low-g samples near saturation with the high-g values
+5) Carry the gyroscope columns (low-g stream) through on the same time grid
+
+The fused dfs have the same accel column names as the input, so the usual data prep (add_resultant_column,
+accel_to_gs_columns, ...) and peak_detection functions run on them unchanged.
+
+Read only: the input dfs are not modified, new dfs are returned.
+"""
+# Packages
+import re
+import numpy as np
+import pandas as pd
+import warnings
+
+from . import data_prep as prep
+
+G = 9.81  # standard acceleration due to gravity
+
+# Pairing low-g and high-g runs ----------------------------------------------------------
+
+
+STREAM_PATTERN = re.compile(r'_(lowg|highg)$')
+
+
+def pair_lowg_highg_keys(lowg_dfs, highg_dfs):
+    """
+    Pairs the keys of the low-g and high-g dictionaries by run (the key without the '_lowg' / '_highg' ending).
+
+    Returns a list of (run_key, lowg_key, highg_key). Runs missing from either stream are skipped with a warning.
+    """
+    lowg_runs = {STREAM_PATTERN.sub('', key): key for key in lowg_dfs.keys()}
+    highg_runs = {STREAM_PATTERN.sub('', key): key for key in highg_dfs.keys()}
+
+    pairs = []
+    for run_key, lowg_key in lowg_runs.items():
+        if run_key in highg_runs:
+            pairs.append((run_key, lowg_key, highg_runs[run_key]))
+        else:
+            warnings.warn(f"No high-g run found for '{lowg_key}'")
+    for run_key, highg_key in highg_runs.items():
+        if run_key not in lowg_runs:
+            warnings.warn(f"No low-g run found for '{highg_key}'")
+    return pairs
+
+# Resampling ----------------------------------------------------------
+
+
+# NOTE: the resampling itself is prep.resample_signals (polyphase, cached filter designs)
+
+
+def _on_time_grid(values, start_time, fs, grid):
+    # Linear interpolation of a regularly sampled stream onto the common grid (the streams start at different times,
+    # so the grids are offset by a fraction of a sample)
+    times = start_time + np.arange(values.shape[0]) / fs
+    return np.column_stack([np.interp(grid, times, values[:, i]) for i in range(values.shape[1])])
+
+# Saturation mask ----------------------------------------------------------
+
+
+def saturation_mask(values, range_g=16, threshold=0.98, margin_samples=5):
+    """
+    True for samples where any axis is at (or within 'threshold' of) the range of the accelerometer, widened by
+    'margin_samples' on each side (the samples next to clipping are already distorted by the sensor's own filter).
+    """
+    limit = threshold * range_g * G
+    mask = (np.abs(values) >= limit).any(axis=1)
+    if margin_samples > 0 and mask.any():
+        # Widen the mask with a moving max (a convolution with a window of ones)
+        mask = np.convolve(mask, np.ones(2 * margin_samples + 1),
+                           mode='same') > 0
+    return mask
+
+# Fuse low-g and high-g ----------------------------------------------------------
+
+
+def fuse_lowg_highg(lowg_dfs, highg_dfs, accel_columns=('ax_m/s/s', 'ay_m/s/s', 'az_m/s/s'),
+                    gyro_columns=('gx_deg/s', 'gy_deg/s', 'gz_deg/s'), time_column='time_s',
+                    lowg_fs=1125, highg_fs=1600, target_fs=1600, range_g=16, threshold=0.98, margin_samples=5):
+    """
+    This function fuses the low-g and high-g accelerometer streams of each run into one signal.
+
+    Arguments:
+    - lowg_dfs, highg_dfs: dictionaries of pandas dataframes (e.g. dfs_lt_lowg and dfs_lt_highg from the tibia notebook).
+    - accel_columns: the acceleration columns (m/s/s), same names in both streams.
+    - gyro_columns: gyroscope columns carried through from the low-g stream (any that don't exist are left out).
+    - time_column: sensor timestamps (secs) used to line the two streams up.
+    - lowg_fs, highg_fs: sample rates of the two streams.
+    - target_fs: sample rate of the fused signal, default is 1600hz (the high-g rate, so impacts keep their resolution).
+    - range_g: range of the low-g accelerometer, default is 16 g.
+    - threshold: a low-g sample counts as saturated once any axis is above threshold x range_g, default is 0.98.
+    - margin_samples: low-g samples either side of a saturated sample that are also replaced.
+
+    If a column in 'accel_columns' or the time column does not exist in a dataframe, a warning message is issued
+    and the run is skipped.
+
+    The function returns:
+    - fused_dfs: a dictionary of fused dfs (key is the run key ending in '_fused') with the time column, the accel and
+      gyro columns and a 'highg_filled' column (1 where the high-g values were used).
+    - a dataframe with the number and percent of samples filled from the high-g stream for each run (key, variable, value).
+    """
+    accel_columns = list(accel_columns)
+    fused_dfs = {}
+    results = []
+
+    for run_key, lowg_key, highg_key in pair_lowg_highg_keys(lowg_dfs, highg_dfs):
+        lowg_df = lowg_dfs[lowg_key]
+        highg_df = highg_dfs[highg_key]
+
+        missing = False
+        for key, df in ((lowg_key, lowg_df), (highg_key, highg_df)):
+            for col in accel_columns + [time_column]:
+                if col not in df.columns:
+                    warnings.warn(
+                        f"The column '{col}' does not exist in '{key}'")
+                    missing = True
+        if missing:
+            continue
+        gyro_present = [col for col in gyro_columns if col in lowg_df.columns]
+
+        # Common time grid: the part of the run both streams recorded, at the target rate
+        lowg_start = lowg_df[time_column].iloc[0]
+        highg_start = highg_df[time_column].iloc[0]
+        start = max(lowg_start, highg_start)
+        end = min(lowg_start + (len(lowg_df) - 1) / lowg_fs,
+                  highg_start + (len(highg_df) - 1) / highg_fs)
+        if end <= start:
+            warnings.warn(
+                f"'{lowg_key}' and '{highg_key}' don't overlap in time")
+            continue
+        grid = start + np.arange(int(np.floor((end - start) * target_fs)) + 1) / target_fs
+
+        # Low-g accel and gyro resampled together, high-g accel on its own
+        lowg_values = lowg_df[accel_columns + gyro_present].to_numpy(dtype=np.float64)
+        lowg_grid = _on_time_grid(prep.resample_signals(lowg_values, lowg_fs, target_fs),
+                                  lowg_start, target_fs, grid)
+        highg_grid = _on_time_grid(prep.resample_signals(highg_df[accel_columns].to_numpy(dtype=np.float64), highg_fs, target_fs),
+                                   highg_start, target_fs, grid)
+
+        # Saturation is found on the raw low-g samples and then put on the grid
+        # (any grid sample within one low-g sample of a saturated one is filled)
+        mask = saturation_mask(lowg_values[:, :len(accel_columns)], range_g=range_g,
+                               threshold=threshold, margin_samples=margin_samples)
+        lowg_times = lowg_start + np.arange(len(lowg_values)) / lowg_fs
+        grid_mask = np.interp(grid, lowg_times, mask.astype(np.float64)) > 0
+
+        accel = np.where(grid_mask[:, None],
+                         highg_grid, lowg_grid[:, :len(accel_columns)])
+
+        fused = {time_column: grid}
+        for i, col in enumerate(accel_columns):
+            fused[col] = accel[:, i]
+        for i, col in enumerate(gyro_present):
+            fused[col] = lowg_grid[:, len(accel_columns) + i]
+        fused['highg_filled'] = grid_mask.astype(np.int8)
+        fused_dfs[f'{run_key}_fused'] = pd.DataFrame(fused)
+
+        results.append({'key': f'{run_key}_fused', 'variable': 'highg_filled_samples',
+                        'value': int(grid_mask.sum())})
+        results.append({'key': f'{run_key}_fused', 'variable': 'highg_filled_pct',
+                        'value': 100 * grid_mask.mean()})
+
+    result_df = pd.DataFrame(results)
+    return fused_dfs, result_df
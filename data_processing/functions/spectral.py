@@ -0,0 +1,248 @@
+"""
+Functions for frequency domain measures of IMU runs
+ - Welch power spectral density (PSD) of every column of every run
+ - Step frequency and cadence from the dominant frequency (an FFT check on the peak based spm in calc_stride_times_vars)
+ - Harmonic ratio (even / odd harmonics of the stride frequency, which depends on the sensor location, see
+   CYCLES_PER_STRIDE)
+ - Band powers (e.g. active and impact bands) and the frequency below which most of the power is, as a guide for
+   the Butterworth cutoff
+
+How the work is batched:
+ - The window (e.g. hann) for a segment length is made once and cached (lru_cache), read only
+ - The segments of all columns of all runs are stacked and transformed by one rfft call per batch (scipy.fft, which
+   caches its FFT plan for the segment length between calls), and averaged per run with np.add.reduceat
+
+Read only: the dfs passed in are not modified.
+"""
+# Packages
+import numpy as np
+import pandas as pd
+import warnings
+from functools import lru_cache
+
+from ._lazy import lazy_module
+
+# scipy is imported the first time a spectrum is computed
+fft = lazy_module('scipy.fft')
+scipy_signal = lazy_module('scipy.signal')
+
+# Welch PSD ----------------------------------------------------------
+
+
+# Steps (same as scipy.signal.welch with its defaults: detrend='constant', scaling='density', one sided):
+# 1) Split each signal into overlapping segments of nperseg samples
+# 2) Take the mean off each segment and multiply by the window
+# 3) |rfft|^2 of every segment, scaled by 1 / (fs * sum(window^2)), doubled apart from 0 hz (and the Nyquist bin)
+# 4) Average the segments of each run
+
+
+@lru_cache(maxsize=None)
+def welch_window(nperseg, window='hann'):
+    """
+    The window for a segment length and its PSD scale, 1 / sum(window^2) (cached).
+    """
+    win = scipy_signal.get_window(window, nperseg)
+    # Read only so the cached window can't be changed by accident
+    win.flags.writeable = False
+    return win, 1.0 / np.sum(win ** 2)
+
+
+def welch_psd(signals, fs, nperseg, overlap=0.5, window='hann', max_elements=20_000_000):
+    """
+    Welch PSD of every signal in a list of (samples x columns) arrays (lengths can differ), all segments batched
+    through rfft together.
+
+    Returns (freqs, psds): psds is a (signals x freqs x columns) array. Signals shorter than nperseg are NaN.
+    """
+    win, scale = welch_window(nperseg, window)
+    hop = max(1, int(round(nperseg * (1 - overlap))))
+    freqs = fft.rfftfreq(nperseg, 1 / fs)
+    signals = [np.asarray(s, dtype=np.float64).reshape(len(s), -1) for s in signals]
+    n_columns = signals[0].shape[1]
+
+    # Segments of every signal, in order: (signal, segment start)
+    segments = [(i, start) for i, s in enumerate(signals)
+                for start in range(0, len(s) - nperseg + 1, hop)]
+    sums = np.zeros((len(signals), len(freqs), n_columns))
+    counts = np.bincount([i for i, _ in segments], minlength=len(signals))
+
+    batch_size = max(1, max_elements // (nperseg * n_columns))
+    for batch_start in range(0, len(segments), batch_size):
+        batch = segments[batch_start:batch_start + batch_size]
+        # (segments x columns x nperseg) so the FFT is along the last (contiguous) axis
+        stacked = np.stack([signals[i][start:start + nperseg].T for i, start in batch])
+        stacked = stacked - stacked.mean(axis=2, keepdims=True)
+        stacked *= win
+        power = np.abs(fft.rfft(stacked, axis=2)) ** 2
+
+        # Sum the segments of each signal in the batch (they are next to each other)
+        owners = np.array([i for i, _ in batch])
+        firsts = np.flatnonzero(np.r_[True, owners[1:] != owners[:-1]])
+        sums[owners[firsts]] += np.add.reduceat(power, firsts, axis=0).transpose(0, 2, 1)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        psds = sums / counts[:, None, None] * (scale / fs)
+    psds[:, 1:] *= 2
+    if nperseg % 2 == 0:
+        psds[:, -1] /= 2
+    return freqs, psds
+
+# Features from a PSD ----------------------------------------------------------
+
+
+def _peak_frequency(freqs, psd, band):
+    """
+    Frequency of the highest PSD bin (for every column) in the band, refined with a parabola through the log of the
+    peak bin and its neighbours (a windowed peak is close to a Gaussian, so this is less biased than a plain parabola).
+    """
+    in_band = np.flatnonzero((freqs >= band[0]) & (freqs <= band[1]))
+    best = in_band[np.argmax(psd[in_band], axis=0)]
+    columns = np.arange(psd.shape[1])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        before = np.log(psd[np.maximum(best - 1, 0), columns])
+        peak = np.log(psd[best, columns])
+        after = np.log(psd[np.minimum(best + 1, len(freqs) - 1), columns])
+        denominator = before - 2 * peak + after
+        shift = np.where(denominator < 0, 0.5 * (before - after) / denominator, 0.0)
+    return freqs[best] + shift * (freqs[1] - freqs[0])
+
+
+def harmonic_ratio(freqs, psd, stride_freq, n_harmonics=10, odd_over_even=None):
+    """
+    Harmonic ratio of every column: sum of the amplitudes of the even harmonics of the stride frequency over the
+    sum of the odd ones (the power of each harmonic is summed over its bin and the bins either side).
+
+    Columns flagged in 'odd_over_even' (e.g. the ML axis) are odd / even instead.
+    """
+    df = freqs[1] - freqs[0]
+    harmonics = np.arange(1, n_harmonics + 1)[:, None] * stride_freq[None, :]
+    bins = np.rint(harmonics / df).astype(np.intp)
+    bins = np.clip(bins[:, :, None] + np.array([-1, 0, 1]), 0, len(freqs) - 1)
+    columns = np.arange(psd.shape[1])[None, :, None]
+    # NaN past the Nyquist frequency (dropped from the sums)
+    amplitude = np.sqrt(np.where(harmonics[:, :, None] < freqs[-1],
+                                 psd[bins, columns], np.nan).sum(axis=2) * df)
+    even = np.nansum(amplitude[1::2], axis=0)
+    odd = np.nansum(amplitude[0::2], axis=0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ratio = even / odd
+        if odd_over_even is not None:
+            ratio = np.where(odd_over_even, 1 / ratio, ratio)
+    return ratio
+
+
+def band_power(freqs, psd, band):
+    """
+    Power of every column between band[0] and band[1] hz (None for the Nyquist frequency).
+    """
+    upper = freqs[-1] if band[1] is None else band[1]
+    in_band = (freqs >= band[0]) & (freqs <= upper)
+    return psd[in_band].sum(axis=0) * (freqs[1] - freqs[0])
+
+
+def power_cutoff_frequency(freqs, psd, fraction=0.99):
+    """
+    Frequency below which 'fraction' of the power of each column is (a common way to choose a filter cutoff).
+    """
+    cumulative = np.cumsum(psd, axis=0)
+    return freqs[np.argmax(cumulative >= fraction * cumulative[-1], axis=0)]
+
+# Spectral measures for specified columns for each df in a dictionary ----------------------------------------------------------
+
+
+DEFAULT_BANDS = {
+    'active': (0.5, 8),
+    'impact': (9, 20),
+}
+
+# Cycles of the dominant (PSD peak) frequency per stride at each sensor location: the low back accelerates once per
+# step (twice per stride), a tibia once per stride (at its own foot strike)
+CYCLES_PER_STRIDE = {
+    'low_back': 2,
+    'back': 2,
+    'tibia': 1,
+    'left_tibia': 1,
+    'right_tibia': 1,
+}
+
+
+def apply_spectral_to_dfs(dfs, columns, fs, window_s=4.0, overlap=0.5, window='hann', step_band=(1.0, 4.0),
+                          n_harmonics=10, ml_columns=(), bands=None, power_fraction=0.99, sensor_location='low_back'):
+    """
+    This function calculates frequency domain measures of the specified columns in each dataframe in the input dictionary.
+
+    Arguments:
+    - dfs: a dictionary of pandas dataframes. The keys are the names of the dataframes and the values are the dataframes themselves.
+    - columns: a list of column names.
+    - fs: sample rate (hz) of all the dfs.
+    - window_s: Welch segment length in secs, default is 4 secs (0.25 hz resolution). overlap: default is 0.5 (50%).
+    - window: window of each segment, default is 'hann'.
+    - step_band: the dominant frequency is the PSD peak in this band (hz), default is 1-4 hz.
+    - n_harmonics: harmonics of the stride frequency used for the harmonic ratio, default is 10.
+    - ml_columns: columns where the harmonic ratio is odd / even harmonics (the ML axis), e.g. ['ml_m/s/s'].
+    - bands: dictionary of {name: (low hz, high hz)} band powers (high None is the Nyquist frequency),
+      default is active 0.5-8 hz and impact 9-20 hz.
+    - power_fraction: fraction of power for '{col}_cutoff_freq', default is 0.99.
+    - sensor_location: where the IMU was worn, a key of CYCLES_PER_STRIDE, default is 'low_back'.
+      At the low back the dominant frequency is the step frequency (the stride frequency is half of it), at the tibia
+      it is the stride frequency.
+
+    If a column in 'columns' does not exist in a dataframe, a warning message is issued and the column is skipped.
+    Runs shorter than one segment are skipped with a warning.
+
+    The function returns a dataframe in the long format (key, variable, value) like apply_rms_to_dfs with the variables
+    '{col}_step_freq' (hz), '{col}_cadence' (steps per min), '{col}_harmonic_ratio', '{col}_power_{band}' and
+    '{col}_cutoff_freq'.
+    """
+    bands = DEFAULT_BANDS if bands is None else bands
+    if sensor_location not in CYCLES_PER_STRIDE:
+        raise ValueError(
+            f"Unknown sensor_location '{sensor_location}', use one of {list(CYCLES_PER_STRIDE)}")
+    cycles_per_stride = CYCLES_PER_STRIDE[sensor_location]
+    nperseg = int(round(window_s * fs))
+
+    # One (samples x columns) array per run/column set; grouped by column set so runs with the same columns are batched
+    groups = {}
+    for key in dfs.keys():
+        df = dfs[key]
+        key_columns = []
+        for col in columns:
+            if col in df.columns:
+                key_columns.append(col)
+            else:
+                warnings.warn(f"The column '{col}' does not exist in '{key}'")
+        if not key_columns:
+            continue
+        if len(df) < nperseg:
+            warnings.warn(f"'{key}' is shorter than one {window_s} sec segment")
+            continue
+        groups.setdefault(tuple(key_columns), []).append(key)
+
+    results = []
+    for key_columns, keys in groups.items():
+        freqs, psds = welch_psd([dfs[key][list(key_columns)].to_numpy() for key in keys], fs, nperseg,
+                                overlap=overlap, window=window)
+        odd_over_even = np.array([col in ml_columns for col in key_columns])
+
+        for key, psd in zip(keys, psds):
+            stride_freq = _peak_frequency(freqs, psd, step_band) / cycles_per_stride
+            measures = {
+                'step_freq': stride_freq * 2,
+                'cadence': stride_freq * 2 * 60,
+                'harmonic_ratio': harmonic_ratio(freqs, psd, stride_freq, n_harmonics, odd_over_even),
+            }
+            for name, band in bands.items():
+                measures[f'power_{name}'] = band_power(freqs, psd, band)
+            measures['cutoff_freq'] = power_cutoff_frequency(
+                freqs, psd, power_fraction)
+
+            for i, col in enumerate(key_columns):
+                for measure, values in measures.items():
+                    results.append({
+                        'key': key,
+                        'variable': f'{col}_{measure}',
+                        'value': values[i]
+                    })
+
+    result_df = pd.DataFrame(results)
+    return result_df
@@ -1,10 +1,18 @@
 """
 Functions for calculating statistical measures
+
+What each function does to the dictionary of dfs passed in:
+ - create_summary_tbl: read only, returns a new summary table
+ - remove_outliers: read only, returns a new dictionary of new (filtered) dfs and a table of row counts
 """
 # Packages ---
 import pandas as pd
 import numpy as np
-import scipy.stats as stats
+
+from ._lazy import lazy_module
+
+# scipy.stats is imported the first time it is used
+stats = lazy_module('scipy.stats')
 
 # Creates table with summary stats ----------------------------------------------------------
 
@@ -80,7 +88,8 @@ def remove_outliers(dfs, column_of_values, summary_table, id_column, lower_thres
     row_counts = []
 
     for key in dfs.keys():
-        df = dfs[key].copy()  # create a copy of the dataframe
+        # NOTE: no copy needed here, the boolean filter below already returns a new dataframe
+        df = dfs[key]
         lower_threshold = summary_table.loc[summary_table[id_column]
                                             == key, lower_threshold_column].values[0]
         upper_threshold = summary_table.loc[summary_table[id_column]
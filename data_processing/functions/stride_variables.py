@@ -1,12 +1,20 @@
 """
 Functions for calculating stride variables during running
+
+What each function does to the dictionary of dfs passed in:
+ - calc_stride_times: read only, returns a new dictionary of new dfs
+ - calc_stride_times_vars: read only, returns a new result table
 """
 # Packages ---
-import nolds
 import numpy as np
 import pandas as pd
 import warnings
 
+from ._lazy import lazy_module
+
+# nolds is imported the first time it is used
+nolds = lazy_module('nolds')
+
 # Stride Times (ST) Column ----------------------------------------------------------
 
 
@@ -21,11 +29,11 @@ def calc_stride_times(dfs, time_column):
     """
     dfs_with_st = {}
     for key in dfs.keys():
-        df = dfs[key].copy()  # creates a new copy of the dataframe
-        df['stride_times'] = df[time_column].diff()
+        # assign returns a new dataframe so the original is never modified
+        df = dfs[key].assign(stride_times=dfs[key][time_column].diff())
         # drop rows with NA in 'stride_times'
         # NOTE: The first row will always be an NA
-        df.dropna(subset=['stride_times'], inplace=True)
+        df = df.dropna(subset=['stride_times'])
         dfs_with_st[key] = df
 
     return dfs_with_st
@@ -62,7 +70,8 @@ def calc_stride_times_vars(dfs, stride_times_column, total_run_time_mins):
 
             # Calculate FSI via DFA
             try:
-                fsi = nolds.dfa(df[stride_times_column].values)
+                fsi = nolds.dfa(
+                    df[stride_times_column].to_numpy(dtype=np.float64))
             except Exception as e:
                 fsi = np.nan  # Insert a NaN if the DFA calculation fails
                 print(f"Failed to calculate DFA for key {key}. Error: {e}")
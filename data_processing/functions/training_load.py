@@ -0,0 +1,262 @@
+"""
+Functions for pre-aggregating the training load variables for the Shiny app (shiny_app/app.R)
+ - Day (D1-D5) and week (Light Week / Heavy Week) of each run type, same rules as the app
+ - Daily totals per subject and variable (IMU variables and eTRIMP)
+ - Rolling acute:chronic workload ratio (ACWR) over the training days
+ - Weekly totals, training monotony (mean / SD of the daily loads, Foster 1998) and strain (total x monotony)
+
+The tables are written once (CSV, which is what the app reads) so the app can load them directly
+instead of re-reading and re-aggregating imu_training_load_variables.xlsx every time it starts (and every time an
+input changes). Re-run this after the results store changes: the app goes back to the Excel file when the tables
+are older than it.
+
+Usage (from the data_processing folder):
+    python -m functions.training_load data/processed_variables/imu_training_load_variables.xlsx ../shiny_app/data \
+        --etrimp data/polar_hr/results/etrimp.csv
+
+Read only: returns new tables.
+"""
+# Packages
+import argparse
+import os
+import numpy as np
+import pandas as pd
+
+# Day and week of each run type ----------------------------------------------------------
+
+
+# Same order as the app (shiny_app/app.R)
+RUN_TYPE_ORDER = ['lightd1', 'lightd2', 'lightd3', 'lightd4', 'light_prs_pre', 'light_prs_post',
+                  'heavyd1_prs_pre', 'heavyd1_prs_post', 'heavyd2_prs_pre', 'heavyd2_prs_post',
+                  'heavyd3_prs_pre', 'heavyd3_prs_post', 'heavyd4_prs_pre', 'heavyd4_prs_post',
+                  'heavy_prs_pre', 'heavy_prs_post']
+
+DAYS_PER_WEEK = 5
+WEEKS = ['Light Week', 'Heavy Week']
+
+# Rolling windows (training days) of the acute and chronic load. The study is only 10 training days, so the chronic
+# load is one training week and the acute load the last 2 days: ACWR then starts on D5 of the Light Week and runs
+# through the Heavy Week (a 10 day chronic window would only give a value on the last day).
+ACUTE_DAYS = 2
+CHRONIC_DAYS = DAYS_PER_WEEK
+
+
+def add_day_and_week(df):
+    """
+    Returns a copy of the table (with a run_type column) with the columns:
+    - day_num: 'D1'-'D4' from the run type, 'D5' for the prs assessments at the end of each week
+    - run_week: 'Light Week' or 'Heavy Week'
+    - day_index: training day 1-10 (light week days 1-5, heavy week days 6-10)
+    """
+    df = df.copy()
+    run_type = df['run_type'].str.lower()
+    day = run_type.str.extract(r'd(\d+)', expand=False)
+    day = day.where(~run_type.isin(['light_prs_pre', 'light_prs_post', 'heavy_prs_pre', 'heavy_prs_post']), '5')
+    df['day_num'] = 'D' + day
+    df['run_week'] = np.select([run_type.str.startswith('light'), run_type.str.startswith('heavy')], WEEKS, None)
+    week_offset = np.select([run_type.str.startswith('light'), run_type.str.startswith('heavy')],
+                            [0, DAYS_PER_WEEK], np.nan)
+    df['day_index'] = pd.to_numeric(day, errors='coerce') + week_offset
+    return df
+
+
+def etrimp_to_long(etrimp_df):
+    """
+    The eTRIMP results of the heart rate notebook (sub_id, run_type, ..., etrimp) in the same long format as the
+    results store (sub_id, run_type, sensor, variable, value).
+    """
+    return pd.DataFrame({
+        'sub_id': etrimp_df['sub_id'],
+        'run_type': etrimp_df['run_type'].str.lower(),
+        'sensor': 'polar_hr',
+        'variable': 'etrimp',
+        'value': etrimp_df['etrimp'],
+    })
+
+# App table ----------------------------------------------------------
+
+
+def prepare_app_tbl(df, drop_unverified=False):
+    """
+    The table the app builds from the results store: day_num and run_week added, verified and sensor columns
+    dropped, rows in the app's run type order.
+    """
+    if drop_unverified and 'verified' in df.columns:
+        df = df[df['verified'] != 'n']
+    df = add_day_and_week(df.drop(columns=['verified', 'sensor'], errors='ignore'))
+    order = pd.Categorical(df['run_type'], categories=RUN_TYPE_ORDER, ordered=True)
+    df = df.iloc[np.argsort(order.codes, kind='stable')]
+    return df.drop(columns='day_index').reset_index(drop=True)
+
+
+def weekly_values_tbl(app_df, swc_factor=1.0):
+    """
+    The table behind the app's weekly plot: the app table without the post run assessments, with each subject's
+    mean, SD and smallest worthwhile change bounds (mean +- swc_factor x SD, over all their runs) of every variable.
+    """
+    grouped = app_df.groupby(['sub_id', 'variable'])['value']
+    swc_df = pd.DataFrame({'avg': grouped.mean(), 'sd': grouped.std(ddof=1)})
+    swc_df['swc'] = swc_df['sd'] * swc_factor
+    swc_df['swc_upper_bound'] = swc_df['avg'] + swc_df['swc']
+    swc_df['swc_lower_bound'] = swc_df['avg'] - swc_df['swc']
+
+    df = app_df.merge(swc_df.reset_index(), on=['sub_id', 'variable'], how='left')
+    return df[~df['run_type'].str.endswith('post')].reset_index(drop=True)
+
+
+def run_types_wide_tbl(app_df):
+    """
+    The table behind the app's comparison tab: one row per subject and variable, one column per run type (in the
+    app's order) with the value.
+    """
+    wide = app_df.pivot_table(index=['sub_id', 'variable'], columns='run_type', values='value', aggfunc='mean')
+    columns = [run_type for run_type in RUN_TYPE_ORDER if run_type in wide.columns]
+    columns += [run_type for run_type in wide.columns if run_type not in columns]
+    wide = wide[columns].reset_index()
+    wide.columns.name = None
+    return wide
+
+# Daily and weekly load ----------------------------------------------------------
+
+
+def daily_load_tbl(df, variables=None, include_post=False, acute_days=ACUTE_DAYS, chronic_days=CHRONIC_DAYS,
+                   min_periods=None):
+    """
+    Daily totals and rolling acute:chronic workload ratio per subject and variable.
+
+    Arguments:
+    - df: long format table (sub_id, run_type, variable, value), e.g. the results store plus etrimp_to_long.
+    - variables: variables to aggregate, default is all of them.
+    - include_post: include the post run assessments (the app leaves them out), default is False.
+    - acute_days, chronic_days: rolling windows (training days) of the acute and chronic load, default 2 and 5
+      (see ACUTE_DAYS and CHRONIC_DAYS).
+    - min_periods: days with a value needed for a rolling mean, default is the whole window.
+
+    Every subject and variable gets all 10 training days (missing days are NaN) so the rolling windows are in days,
+    not rows. ACWR is the acute rolling mean divided by the chronic rolling mean (coupled).
+    """
+    if variables is not None:
+        df = df[df['variable'].isin(variables)]
+    if not include_post:
+        df = df[~df['run_type'].str.lower().str.endswith('post')]
+    df = add_day_and_week(df)
+    df = df.dropna(subset=['day_index'])
+
+    totals = df.groupby(['sub_id', 'variable', 'day_index'])['value'].sum(min_count=1)
+
+    # Full grid of training days for every subject and variable
+    groups = totals.index.droplevel('day_index').unique()
+    days = np.arange(1, DAYS_PER_WEEK * len(WEEKS) + 1, dtype=np.float64)
+    grid = pd.MultiIndex.from_tuples([(sub_id, variable, day) for sub_id, variable in groups for day in days],
+                                     names=['sub_id', 'variable', 'day_index'])
+    daily = totals.reindex(grid).rename('total').reset_index()
+
+    grouped = daily.groupby(['sub_id', 'variable'], sort=False)['total']
+    daily['acute'] = grouped.rolling(acute_days, min_periods=min_periods or acute_days).mean() \
+        .reset_index(level=[0, 1], drop=True)
+    daily['chronic'] = grouped.rolling(chronic_days, min_periods=min_periods or chronic_days).mean() \
+        .reset_index(level=[0, 1], drop=True)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        daily['acwr'] = daily['acute'] / daily['chronic']
+
+    week = ((daily['day_index'] - 1) // DAYS_PER_WEEK).astype(int)
+    daily.insert(2, 'run_week', np.array(WEEKS, dtype=object)[week])
+    daily.insert(3, 'day_num', 'D' + ((daily['day_index'] - 1) % DAYS_PER_WEEK + 1).astype(int).astype(str))
+    daily['day_index'] = daily['day_index'].astype(int)
+    return daily
+
+
+def weekly_load_tbl(daily):
+    """
+    Weekly total, mean, SD, training monotony (mean / SD) and strain (total x monotony) of the daily totals per
+    subject, variable and week.
+    """
+    grouped = daily.groupby(['sub_id', 'variable', 'run_week'], sort=False)['total']
+    weekly = pd.DataFrame({
+        'days': grouped.count(),
+        'total': grouped.sum(min_count=1),
+        'mean': grouped.mean(),
+        'sd': grouped.std(ddof=1),
+    })
+    with np.errstate(divide='ignore', invalid='ignore'):
+        weekly['monotony'] = weekly['mean'] / weekly['sd']
+    weekly['strain'] = weekly['total'] * weekly['monotony']
+    return weekly.reset_index()
+
+# Writing the tables ----------------------------------------------------------
+
+
+def write_tables(tables, output_dir):
+    """
+    Writes each table to '{output_dir}/training_load_{name}.csv' (the files shiny_app/app.R loads).
+    Returns the paths written.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    paths = []
+    for name, table in tables.items():
+        path = os.path.join(output_dir, f'training_load_{name}.csv')
+        table.to_csv(path, index=False)
+        paths.append(path)
+    return paths
+
+
+def create_training_load_tbls(results_df, etrimp_df=None, variables=None, acute_days=ACUTE_DAYS,
+                              chronic_days=CHRONIC_DAYS, drop_unverified=False):
+    """
+    This function creates the pre-aggregated tables for the app from the results store.
+
+    Arguments:
+    - results_df: the 'variables' sheet of imu_training_load_variables.xlsx.
+    - etrimp_df: optional eTRIMP results of the heart rate notebook (data/polar_hr/results/etrimp.csv).
+    - variables, acute_days, chronic_days: see daily_load_tbl (eTRIMP is always included when given).
+    - drop_unverified: leave out rows with verified == 'n', default is False (same as the app).
+
+    The function returns a dictionary of tables:
+    - long: the app table (sub_id, run_type, variable, value, day_num, run_week), IMU variables only
+    - weekly_values: the app's weekly plot table (weekly_values_tbl)
+    - run_types_wide: the app's comparison tab table (run_types_wide_tbl)
+    - daily: daily totals with the acute and chronic load and ACWR (with eTRIMP when given)
+    - weekly: weekly totals, monotony and strain (with eTRIMP when given)
+    """
+    if drop_unverified and 'verified' in results_df.columns:
+        results_df = results_df[results_df['verified'] != 'n']
+    load_df = results_df
+    if etrimp_df is not None:
+        load_df = pd.concat([results_df, etrimp_to_long(etrimp_df)], ignore_index=True)
+        if variables is not None:
+            variables = list(variables) + ['etrimp']
+
+    app_df = prepare_app_tbl(results_df)
+    daily = daily_load_tbl(load_df, variables=variables, acute_days=acute_days, chronic_days=chronic_days)
+    return {
+        'long': app_df,
+        'weekly_values': weekly_values_tbl(app_df),
+        'run_types_wide': run_types_wide_tbl(app_df),
+        'daily': daily,
+        'weekly': weekly_load_tbl(daily),
+    }
+
+# Command line ----------------------------------------------------------
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Pre-aggregate the training load variables for the Shiny app.')
+    parser.add_argument('results_file', help='results store (imu_training_load_variables.xlsx)')
+    parser.add_argument('output_dir', help='folder the tables are written to (e.g. the app data folder)')
+    parser.add_argument('--sheet-name', default='variables', help='sheet of the results store')
+    parser.add_argument('--etrimp', default=None, help='eTRIMP results (csv) to include')
+    parser.add_argument('--acute-days', type=int, default=ACUTE_DAYS)
+    parser.add_argument('--chronic-days', type=int, default=CHRONIC_DAYS)
+    args = parser.parse_args(argv)
+
+    results_df = pd.read_excel(args.results_file, sheet_name=args.sheet_name)
+    etrimp_df = pd.read_csv(args.etrimp) if args.etrimp else None
+    tables = create_training_load_tbls(results_df, etrimp_df, acute_days=args.acute_days,
+                                       chronic_days=args.chronic_days)
+    for path in write_tables(tables, args.output_dir):
+        print(f'Data has been saved successfully to {path}.')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,385 @@
+"""
+Watches the data folders and processes new sensor downloads as they land (asyncio service)
+
+Instead of waiting for someone to open a notebook, this runs next to the data and:
+ - polls the folders of the cohort_cli jobs (data/five_min_runs/...) and the Polar HR folder (data/polar_hr)
+   every 'poll_s' secs (os.scandir in a thread, no extra packages needed, works on network drives)
+ - waits until a file has stopped changing (same size and modified time) for 'settle_s' secs before using it, so
+   files still being copied off a sensor are left alone
+ - queues a job once all of its files have settled and its output is not up to date (same fingerprint stamps as
+   cohort_cli --resume, so restarting the watcher doesn't redo anything)
+ - runs the jobs in a process pool, 'workers' at a time. The queue holds at most 'queue_size' jobs: when many files
+   land at once the scanning waits for room (backpressure) instead of piling up work. If a worker process dies
+   (e.g. killed when the machine runs out of memory) the pool is replaced and each job that was running in it is
+   run again on its own worker, so only the job that really breaks it is recorded as failed and the service carries on
+ - writes the results in batches from one task (everything finished since the last write in one go), so the results
+   store is only written by one writer: the IMU variables of each job replace its earlier rows in 'results_file'
+   (like cohort_cli) and the eTRIMP of each HR session replaces its row in data/polar_hr/results/etrimp.csv (like the
+   ch.4_heart_rate notebook), so jobs re-run when more files land don't duplicate results
+
+Usage (from the data_processing folder, same manifest as cohort_cli):
+    python -m functions.watcher cohort.json --hr-dir data/polar_hr --workers 2
+"""
+# Packages
+import argparse
+import asyncio
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import pandas as pd
+
+from . import cohort_cli as cohort
+from . import data_prep as prep
+from . import file_import_gui as gui
+from . import heart_rate as hr
+
+# HR jobs ----------------------------------------------------------
+
+
+HR_PIPELINE = 'hr_etrimp'
+
+
+def hr_jobs(hr_dir, output_dir, max_hr_file=None, session_end='0:34:00'):
+    """
+    One job per Polar HR file in 'hr_dir' (max_hr.csv and the results folder are left out).
+    The jobs look like the cohort_cli jobs, so the same fingerprint stamps decide if they need running.
+    """
+    max_hr_file = max_hr_file or os.path.join(hr_dir, 'max_hr.csv')
+    jobs = []
+    for file_path in gui.data_files_in_dir(hr_dir):
+        name = os.path.splitext(os.path.basename(file_path))[0]
+        # Skip max_hr.csv and temporary files (e.g. '~$...' while the file is open in Excel)
+        if os.path.abspath(file_path) == os.path.abspath(max_hr_file) or name.startswith(('.', '~')):
+            continue
+        jobs.append({
+            'pipeline': HR_PIPELINE,
+            'job_id': name,
+            'input_files': [file_path],
+            'output_path': os.path.join(output_dir, HR_PIPELINE, f'{name}.csv'),
+            'params': {'max_hr_file': max_hr_file, 'session_end': session_end},
+        })
+    return jobs
+
+
+def run_hr_job(job):
+    """
+    eTRIMP of one HR session in the layout of data/polar_hr/results/etrimp.csv (sub_id, run_type, zones, etrimp).
+    """
+    fingerprint = cohort.job_fingerprint(job)
+    dfs, _ = gui.read_csv_files(job['input_files'])
+    dfs = hr.prep_hr_data(dfs, session_end=job['params']['session_end'])
+    etrimp_df = hr.calculate_eTRIMP(dfs, pd.read_csv(job['params']['max_hr_file']))
+
+    # Same export steps as the notebook
+    etrimp_df.insert(0, 'sub_id', etrimp_df['key'].apply(lambda x: x.split('_')[0]))
+    etrimp_df.insert(1, 'run_type', etrimp_df['key'].apply(lambda x: '_'.join(x.split('_')[1:])).str.upper())
+    etrimp_df = etrimp_df.drop(['key', 'max_hr'], axis=1)
+
+    os.makedirs(os.path.dirname(job['output_path']), exist_ok=True)
+    etrimp_df.to_csv(job['output_path'], index=False)
+    return etrimp_df, fingerprint
+
+
+def process_job(job):
+    # Runs in a worker process
+    if job['pipeline'] == HR_PIPELINE:
+        return run_hr_job(job)
+    return cohort.run_job(job)
+
+
+def upsert_etrimp(etrimp_df, file_path):
+    """
+    Writes the eTRIMP rows to 'file_path', replacing the rows of the same sessions (sub_id, run_type).
+    """
+    if os.path.exists(file_path):
+        existing_df = pd.read_csv(file_path)
+        sessions = set(zip(etrimp_df['sub_id'], etrimp_df['run_type']))
+        keep = [session not in sessions for session in zip(existing_df['sub_id'], existing_df['run_type'])]
+        etrimp_df = pd.concat([existing_df[keep], etrimp_df], ignore_index=True)
+    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+    etrimp_df.to_csv(file_path, index=False)
+
+# File settling ----------------------------------------------------------
+
+
+class SettleTracker:
+    """
+    Remembers the size and modified time of every file seen and since when they haven't changed.
+    A file seen for the first time counts as unchanged since its modified time, so files that were already there
+    when the watcher started (e.g. --once) don't have to wait another 'settle_s'.
+    """
+
+    def __init__(self, settle_s):
+        self.settle_s = settle_s
+        self._files = {}
+
+    def update(self, stats, now):
+        # stats: {file path: (size, mtime_ns)} of every file found this scan, now: time.monotonic()
+        files = {}
+        for path, stat in stats.items():
+            if path in self._files:
+                previous_stat, since = self._files[path]
+                files[path] = (stat, since if previous_stat == stat else now)
+            else:
+                # mtime is wall clock time, 'since' is monotonic time
+                age_s = max(time.time() - stat[1] / 1e9, 0)
+                files[path] = (stat, now - age_s)
+        self._files = files
+
+    def settled(self, path, now):
+        if path not in self._files:
+            return False
+        return now - self._files[path][1] >= self.settle_s
+
+
+def scan_files(directories):
+    """
+    {file path: (size, mtime_ns)} of the data files (CSV and .imuz) in each folder.
+    """
+    stats = {}
+    for directory in directories:
+        if not os.path.isdir(directory):
+            continue
+        for file_path in gui.data_files_in_dir(directory):
+            try:
+                file_stat = os.stat(file_path)
+            except FileNotFoundError:
+                # Moved (e.g. quarantined) between listing and stat
+                continue
+            stats[file_path] = (file_stat.st_size, file_stat.st_mtime_ns)
+    return stats
+
+# Watcher ----------------------------------------------------------
+
+
+class DirectoryWatcher:
+    """
+    The watcher service (see the notes at the top).
+
+    Arguments:
+    - jobs: cohort_cli jobs (cohort_cli.expand_jobs) and/or HR jobs (hr_jobs is called again on every scan for
+      'hr_dir', so new HR files are picked up).
+    - results_file, sheet_name: results store the IMU variables are written to (None to only write job outputs).
+    - hr_dir, hr_output_dir, etrimp_file, max_hr_file: Polar HR folder and where the eTRIMP goes.
+    - workers: jobs running at once. queue_size: most jobs waiting to run.
+    - poll_s: secs between scans. settle_s: secs a file must stay unchanged before it is used.
+    """
+
+    def __init__(self, jobs, results_file=None, sheet_name='variables', hr_dir=None, hr_output_dir=None,
+                 etrimp_file=None, max_hr_file=None, workers=2, queue_size=8, poll_s=5, settle_s=30):
+        self.jobs = list(jobs)
+        self.results_file = results_file
+        self.sheet_name = sheet_name
+        self.hr_dir = hr_dir
+        self.hr_output_dir = hr_output_dir or cohort.DEFAULT_OUTPUT_DIR
+        self.etrimp_file = etrimp_file or (os.path.join(hr_dir, 'results', 'etrimp.csv') if hr_dir else None)
+        self.max_hr_file = max_hr_file
+        self.workers = workers
+        self.queue_size = queue_size
+        self.poll_s = poll_s
+        self.tracker = SettleTracker(settle_s)
+        # Jobs queued, running or waiting to be written (by job_id), and the fingerprint of jobs that failed
+        self._active = set()
+        self._failed = {}
+        self.statuses = []
+        self._executor = None
+
+    def _current_jobs(self):
+        jobs = list(self.jobs)
+        if self.hr_dir is not None and os.path.isdir(self.hr_dir):
+            jobs.extend(hr_jobs(self.hr_dir, self.hr_output_dir, max_hr_file=self.max_hr_file))
+        return jobs
+
+    def _scan(self):
+        """
+        Scans the folders (runs in a thread) and returns the jobs that are ready to run.
+        """
+        jobs = self._current_jobs()
+        directories = {directory for job in jobs for directory in job.get('input_dirs', {}).values()}
+        directories |= {os.path.dirname(file_path) for job in jobs for file_path in job.get('input_files', [])}
+        now = time.monotonic()
+        self.tracker.update(scan_files(sorted(directories)), now)
+
+        ready = []
+        for job in jobs:
+            key = (job['pipeline'], job['job_id'])
+            files = cohort._input_files(job)
+            if key in self._active or not files or not all(self.tracker.settled(path, now) for path in files):
+                continue
+            if cohort.is_up_to_date(job):
+                continue
+            if self._failed.get(key) == cohort.job_fingerprint(job):
+                # Failed with these exact files before, wait for them to change
+                continue
+            ready.append(job)
+        return ready
+
+    async def _scanner(self, queue, stop):
+        while not stop.is_set():
+            for job in await asyncio.to_thread(self._scan):
+                self._active.add((job['pipeline'], job['job_id']))
+                # Waits here when the queue is full (backpressure)
+                await queue.put(job)
+            try:
+                await asyncio.wait_for(stop.wait(), timeout=self.poll_s)
+            except asyncio.TimeoutError:
+                pass
+
+    def _replace_pool(self, broken_executor):
+        # Every job running in a broken pool fails, only the first worker to see it replaces the pool
+        if self._executor is broken_executor:
+            broken_executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = ProcessPoolExecutor(max_workers=self.workers)
+
+    async def _run_job(self, job):
+        loop = asyncio.get_running_loop()
+        executor = self._executor
+        try:
+            return await loop.run_in_executor(executor, process_job, job)
+        except BrokenProcessPool:
+            self._replace_pool(executor)
+        print(f"A worker died while running {job['pipeline']} {job['job_id']} (out of memory?). "
+              "Running it again on its own.")
+        # On its own worker, so if it breaks again it is this job (not one running next to it) that fails
+        solo_executor = ProcessPoolExecutor(max_workers=1)
+        try:
+            return await loop.run_in_executor(solo_executor, process_job, job)
+        finally:
+            solo_executor.shutdown(wait=False)
+
+    async def _worker(self, queue, results):
+        while True:
+            job = await queue.get()
+            try:
+                df_export, fingerprint = await self._run_job(job)
+            except Exception as e:
+                print(f"Failed to process {job['pipeline']} {job['job_id']}. Error: {e}")
+                key = (job['pipeline'], job['job_id'])
+                self._failed[key] = await asyncio.to_thread(cohort.job_fingerprint, job)
+                self._active.discard(key)
+                self.statuses.append({'job_id': job['job_id'], 'pipeline': job['pipeline'],
+                                      'status': f'failed: {e}', 'rows': None})
+            else:
+                await results.put((job, df_export, fingerprint))
+            finally:
+                queue.task_done()
+
+    def _write_results(self, finished):
+        """
+        Writes a batch of finished jobs to the results store and stamps them (runs in a thread).
+        Returns {(pipeline, job_id): error} of the jobs whose results couldn't be written (they are not stamped,
+        so the next scan runs them again).
+        """
+        stores = [
+            (lambda job: job['pipeline'] != HR_PIPELINE, self.results_file,
+             lambda df: prep.upsert_df_to_excel(df, self.results_file, self.sheet_name)),
+            (lambda job: job['pipeline'] == HR_PIPELINE, self.etrimp_file,
+             lambda df: upsert_etrimp(df, self.etrimp_file)),
+        ]
+        errors = {}
+        for in_store, file_path, write in stores:
+            store_jobs = [(job, df) for job, df, _ in finished if in_store(job)]
+            tables = [df for _, df in store_jobs if not df.empty]
+            if file_path is None or not tables:
+                continue
+            try:
+                write(pd.concat(tables, ignore_index=True))
+            except Exception as e:
+                errors.update({(job['pipeline'], job['job_id']): e for job, _ in store_jobs})
+
+        # Only stamp jobs as done once their results are in the results store
+        for job, _, fingerprint in finished:
+            if (job['pipeline'], job['job_id']) not in errors:
+                cohort.write_stamp(job, fingerprint)
+        return errors
+
+    async def _writer(self, results):
+        while True:
+            finished = [await results.get()]
+            # Everything else that finished in the meantime goes in the same write
+            while not results.empty():
+                finished.append(results.get_nowait())
+            try:
+                errors = await asyncio.to_thread(self._write_results, finished)
+            except Exception as e:
+                errors = {(job['pipeline'], job['job_id']): e for job, _, _ in finished}
+            for job, df_export, _ in finished:
+                key = (job['pipeline'], job['job_id'])
+                if key in errors:
+                    status = f'failed to write results: {errors[key]}'
+                    print(f"Failed to write the results of {job['pipeline']} {job['job_id']}. Error: {errors[key]}")
+                else:
+                    status = 'processed'
+                    print(f"Processed {job['pipeline']} {job['job_id']} ({len(df_export)} rows)")
+                self.statuses.append({'job_id': job['job_id'], 'pipeline': job['pipeline'],
+                                      'status': status, 'rows': len(df_export)})
+                self._active.discard(key)
+                results.task_done()
+
+    async def run(self, stop=None, once=False):
+        """
+        Runs until 'stop' (an asyncio.Event) is set. once=True scans once, processes the jobs that are ready and returns.
+        Returns a table with one row per job processed (job_id, pipeline, status, rows).
+        """
+        stop = stop or asyncio.Event()
+        queue = asyncio.Queue(maxsize=self.queue_size)
+        # Bounded too, so a slow results store holds up the workers (and so the scanning) instead of piling up
+        results = asyncio.Queue(maxsize=self.queue_size)
+
+        # Replaced by _replace_pool if a worker dies
+        self._executor = ProcessPoolExecutor(max_workers=self.workers)
+        tasks = [asyncio.create_task(self._worker(queue, results)) for _ in range(self.workers)]
+        tasks.append(asyncio.create_task(self._writer(results)))
+        try:
+            if once:
+                for job in await asyncio.to_thread(self._scan):
+                    self._active.add((job['pipeline'], job['job_id']))
+                    await queue.put(job)
+            else:
+                await self._scanner(queue, stop)
+            # Finish what is already queued
+            await queue.join()
+            await results.join()
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            self._executor.shutdown(wait=True, cancel_futures=True)
+
+        return pd.DataFrame(self.statuses, columns=['job_id', 'pipeline', 'status', 'rows'])
+
+# Command line ----------------------------------------------------------
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Watch the data folders and process new sensor files as they land.')
+    parser.add_argument('manifest', nargs='?', default=None,
+                        help='cohort manifest (JSON, same as cohort_cli) with the IMU jobs to watch')
+    parser.add_argument('--hr-dir', default=None, help='Polar HR folder to watch, e.g. data/polar_hr')
+    parser.add_argument('--workers', type=int, default=2, help='jobs running at once')
+    parser.add_argument('--queue-size', type=int, default=8, help='most jobs waiting to run')
+    parser.add_argument('--poll-s', type=float, default=5, help='secs between scans of the folders')
+    parser.add_argument('--settle-s', type=float, default=30,
+                        help='secs a file must stay unchanged before it is processed')
+    parser.add_argument('--once', action='store_true',
+                        help='process what is ready now and exit (files changed in the last --settle-s secs are left)')
+    args = parser.parse_args(argv)
+
+    manifest = cohort.load_manifest(args.manifest) if args.manifest else {'jobs': []}
+    watcher = DirectoryWatcher(
+        cohort.expand_jobs(manifest), results_file=manifest.get('results_file'),
+        sheet_name=manifest.get('sheet_name', 'variables'), hr_dir=args.hr_dir,
+        hr_output_dir=manifest.get('output_dir', cohort.DEFAULT_OUTPUT_DIR), workers=args.workers,
+        queue_size=args.queue_size, poll_s=args.poll_s, settle_s=args.settle_s)
+
+    try:
+        status_df = asyncio.run(watcher.run(once=args.once))
+    except KeyboardInterrupt:
+        status_df = pd.DataFrame(watcher.statuses)
+    print(status_df.to_string(index=False))
+
+
+if __name__ == '__main__':
+    main()